@@ -0,0 +1,126 @@
+import sys, json, time, sqlite3
+from .database import get_schema
+from .codecache import CodeCache
+from .common import InnerReference
+from .turn import Turn
+from .util import makeid
+from .serialization import FORMATS, JSON_BACKEND
+from . import pack
+
+# Microbenchmarks, for comparing implementations on this machine. Run them
+# with 'python -m qruntime.bench [NAME..]'. They use an in-memory database
+# and never start a node.
+
+class _BenchServer:
+    # what a Turn needs from its server
+    vatid = "vat0"
+    journal = None
+    def __init__(self):
+        self.code_cache = CodeCache()
+    def is_congested(self, target_vatid):
+        return False
+    def check_message(self, target_vatid, msg):
+        pass
+
+def make_turn():
+    db = sqlite3.connect(":memory:")
+    db.executescript(get_schema(2))
+    return Turn(_BenchServer(), db)
+
+def make_memory(turn, entries, references=0):
+    """A Memory-like dict with 'entries' records, the first 'references' of
+    which hold an InnerReference."""
+    data = {}
+    for i in range(entries):
+        value = {"name": "entry %d" % i,
+                 "count": i,
+                 "ratio": i / 7.0,
+                 "tags": ["alpha", "beta", str(i)],
+                 "owner": None,
+                 }
+        if i < references:
+            value["owner"] = turn.get_reference(("vat1", "urb0-%d" % i))
+        data["key-%d" % i] = value
+    return data
+
+def best_of(f, repeat=3, number=3):
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        for j in range(number):
+            f()
+        times.append((time.time() - start) / number)
+    return min(times)
+
+def _legacy_pack(turn, data):
+    # what pack_memory() used to do: a fresh nonce and encoder per call,
+    # and a .replace() over the whole output
+    nonce = "__power_%s__" % makeid()
+    def default(obj):
+        if isinstance(obj, InnerReference):
+            return {nonce: "reference",
+                    "swissnum": turn.get_swissnum_for_object(obj)}
+        raise TypeError(repr(obj))
+    return json.JSONEncoder(default=default).encode(data).replace(
+        nonce, "__power__")
+
+def bench_pack(out):
+    # A Memory is packed as a whole when it is still a single string, and
+    # one key at a time after that (see memory.py), so both matter
+    out.write("pack_memory(), milliseconds per Memory:\n")
+    out.write("%8s %6s %8s %10s %10s %10s\n" % ("entries", "refs", "packed",
+                                                "json.dumps", "legacy",
+                                                "packer"))
+    for (entries, references) in [(10000, 0), (10000, 100), (100000, 0)]:
+        t = make_turn()
+        data = make_memory(t, entries, references)
+        assert (json.loads(_legacy_pack(t, data))
+                == json.loads(pack.pack_memory(t, data)))
+        values = data.values()
+        for (how, packs) in [
+            ("whole", (lambda f: f(data))),
+            ("per-key", (lambda f: [f(value) for value in values])),
+            ]:
+            baseline = "-"
+            if not references:
+                baseline = "%.2f" % (1000*best_of(lambda: packs(json.dumps)))
+            legacy = best_of(lambda: packs(lambda v: _legacy_pack(t, v)))
+            packer = best_of(lambda: packs(lambda v: pack.pack_memory(t, v)))
+            out.write("%8d %6d %8s %10s %10.2f %10.2f\n"
+                      % (entries, references, how, baseline, 1000*legacy,
+                         1000*packer))
+
+def bench_codec(out):
+    # each value_format, on the same Memories, packed per key (as turns
+    # write them) and as a whole (as a new Memory is written)
+    out.write("value formats, milliseconds per Memory, and bytes"
+              " (JSON decoded with %s):\n" % JSON_BACKEND)
+    out.write("%8s %6s %8s %8s %10s %10s %10s\n" % ("entries", "refs",
+                                                   "packed", "format",
+                                                   "encode", "decode",
+                                                   "bytes"))
+    for (entries, references) in [(10000, 0), (10000, 100)]:
+        t = make_turn()
+        data = make_memory(t, entries, references)
+        values = data.values()
+        for (how, items) in [("whole", [data]), ("per-key", values)]:
+            for name in sorted(FORMATS):
+                t.value_format = FORMATS[name]
+                packed = [pack.pack_memory(t, value) for value in items]
+                encode = best_of(lambda: [pack.pack_memory(t, value)
+                                          for value in items])
+                decode = best_of(lambda: [pack.unpack_memory(t, p)
+                                          for p in packed])
+                out.write("%8d %6d %8s %8s %10.2f %10.2f %10d\n"
+                          % (entries, references, how, name, 1000*encode,
+                             1000*decode, sum([len(p) for p in packed])))
+
+BENCHMARKS = {"pack": bench_pack,
+              "codec": bench_codec}
+
+def main(args, out=sys.stdout):
+    for name in args or sorted(BENCHMARKS):
+        BENCHMARKS[name](out)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
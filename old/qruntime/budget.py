@@ -0,0 +1,189 @@
+import os, time, signal
+import resource
+
+# Inner code runs synchronously, so a runaway urbject would stall everything
+# else the node does. Each turn therefore gets a Budget: limits on its wall
+# time, CPU time, and memory growth (resident set size). The node config
+# holds the defaults (NULL columns use the ones below), and the
+# `urbject_budgets` table can override any of them for a single urbject.
+#
+# A Meter enforces the budget while the turn runs: an interval timer
+# (SIGALRM) checks the turn's usage every CHECK_INTERVAL seconds, and raises
+# BudgetExceeded in the middle of the inner code once a limit is passed.
+# Like KeyboardInterrupt, it isn't an Exception, so 'except Exception:'
+# won't catch it. It is raised again on every tick if the inner code
+# catches it anyway, and Turn.start_turn() raises it again when the inner
+# code returns, so an over-budget turn is always rolled back. The timer is
+# disarmed before the turn is committed or rolled back. Signals only work on
+# the main thread: elsewhere, usage is only checked when the inner code
+# returns. (The ticks also cut short any time.sleep() in the inner code.)
+# The Turn holds the meter while it updates its own bookkeeping (the records
+# and Memories that a rollback undoes) and while it uses the caches that all
+# turns share, so a tick can't leave any of those half-done: a tick that
+# arrives meanwhile is postponed until the hold is released.
+#
+# Every turn's usage is added to the `urbject_usage` table, for
+# get_usage().
+
+DEFAULT_WALL_LIMIT = 5.0 # seconds
+DEFAULT_CPU_LIMIT = 2.0 # seconds
+DEFAULT_MEMORY_LIMIT = 100*1000*1000 # bytes
+CHECK_INTERVAL = 0.01
+
+class BudgetExceeded(BaseException):
+    pass
+
+def get_cpu_time():
+    t = os.times()
+    return t[0] + t[1]
+
+_page_size = resource.getpagesize()
+
+def get_memory_usage():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * _page_size
+    except (EnvironmentError, ValueError, IndexError):
+        # peak, not current, and in kilobytes (on linux)
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+class Budget:
+    def __init__(self, wall_limit=None, cpu_limit=None, memory_limit=None):
+        self.wall_limit = wall_limit or DEFAULT_WALL_LIMIT
+        self.cpu_limit = cpu_limit or DEFAULT_CPU_LIMIT
+        self.memory_limit = memory_limit or DEFAULT_MEMORY_LIMIT
+
+class Meter:
+    def __init__(self, budget):
+        self.budget = budget
+        self.exceeded = None # or a description of the limit that was passed
+        self._old_handler = None
+        self._armed = False
+        self._held = 0
+        self._missed = False
+
+    def start(self):
+        self._wall_start = time.time()
+        self._cpu_start = get_cpu_time()
+        self._memory_start = get_memory_usage()
+        self.max_memory = 0
+        try:
+            self._old_handler = signal.signal(signal.SIGALRM, self._tick)
+        except ValueError:
+            return # not the main thread
+        # don't interrupt system calls (sqlite, mostly)
+        signal.siginterrupt(signal.SIGALRM, False)
+        signal.setitimer(signal.ITIMER_REAL, CHECK_INTERVAL, CHECK_INTERVAL)
+        self._armed = True
+
+    def _tick(self, signum, frame):
+        if self._held:
+            self._missed = True
+            return
+        self.check()
+
+    def hold(self):
+        """Postpone ticks until the matching release()."""
+        self._held += 1
+
+    def release(self):
+        self._held -= 1
+        if not self._held and self._missed and self._armed:
+            self._missed = False
+            self.check()
+
+    def measure(self):
+        self.wall_time = time.time() - self._wall_start
+        self.cpu_time = get_cpu_time() - self._cpu_start
+        memory = get_memory_usage() - self._memory_start
+        self.max_memory = max(self.max_memory, memory)
+        return memory
+
+    def check(self):
+        """Raise BudgetExceeded if the turn is over its budget."""
+        memory = self.measure()
+        b = self.budget
+        if self.wall_time > b.wall_limit:
+            self.exceeded = "wall time %.3fs" % self.wall_time
+        elif self.cpu_time > b.cpu_limit:
+            self.exceeded = "cpu time %.3fs" % self.cpu_time
+        elif memory > b.memory_limit:
+            self.exceeded = "memory %d bytes" % memory
+        if self.exceeded:
+            raise BudgetExceeded(self.exceeded)
+
+    def stop(self):
+        """Disarm the timer. Safe to call more than once."""
+        if self._armed:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, self._old_handler)
+            self._armed = False
+        self._missed = False
+
+    def get_usage(self):
+        return {"wall_time": self.wall_time,
+                "cpu_time": self.cpu_time,
+                "max_memory": self.max_memory,
+                }
+
+class Budgets:
+    def __init__(self, db):
+        self.db = db
+        self.defaults = (None, None, None)
+        self._budgets = {} # urbjid -> Budget
+
+    def set_defaults(self, wall_limit=None, cpu_limit=None,
+                     memory_limit=None):
+        self.defaults = (wall_limit, cpu_limit, memory_limit)
+        self._budgets.clear()
+
+    def get_budget(self, urbjid=None):
+        if urbjid not in self._budgets:
+            limits = self.defaults
+            if urbjid is not None:
+                c = self.db.cursor()
+                c.execute("SELECT `wall_limit`,`cpu_limit`,`memory_limit`"
+                          " FROM `urbject_budgets` WHERE `urbjid`=?",
+                          (urbjid,))
+                row = c.fetchone()
+                if row:
+                    limits = [override or default
+                              for (override, default) in zip(row, limits)]
+            self._budgets[urbjid] = Budget(*limits)
+        return self._budgets[urbjid]
+
+    def set_budget(self, urbjid, wall_limit=None, cpu_limit=None,
+                   memory_limit=None, commit=True):
+        c = self.db.cursor()
+        c.execute("INSERT OR REPLACE INTO `urbject_budgets` VALUES (?,?,?,?)",
+                  (urbjid, wall_limit, cpu_limit, memory_limit))
+        if commit:
+            self.db.commit()
+        self._budgets.pop(urbjid, None)
+
+    def record_usage(self, urbjid, usage, aborted):
+        # not committed: this rides along with the turn
+        c = self.db.cursor()
+        args = (int(bool(aborted)), usage["wall_time"], usage["cpu_time"],
+                usage["max_memory"], urbjid)
+        c.execute("UPDATE `urbject_usage` SET `turns`=`turns`+1,"
+                  " `aborted`=`aborted`+?, `wall_time`=`wall_time`+?,"
+                  " `cpu_time`=`cpu_time`+?,"
+                  " `max_memory`=MAX(`max_memory`,?)"
+                  " WHERE `urbjid`=?", args)
+        if not c.rowcount:
+            c.execute("INSERT INTO `urbject_usage`"
+                      " (`turns`,`aborted`,`wall_time`,`cpu_time`,"
+                      "  `max_memory`,`urbjid`)"
+                      " VALUES (1,?,?,?,?,?)", args)
+
+    def get_usage(self, urbjid):
+        c = self.db.cursor()
+        c.execute("SELECT `turns`,`aborted`,`wall_time`,`cpu_time`,"
+                  " `max_memory` FROM `urbject_usage` WHERE `urbjid`=?",
+                  (urbjid,))
+        row = c.fetchone()
+        if not row:
+            return None
+        return dict(zip(["turns", "aborted", "wall_time", "cpu_time",
+                         "max_memory"], row))
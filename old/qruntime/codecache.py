@@ -0,0 +1,82 @@
+import imp, marshal, sqlite3
+from collections import OrderedDict
+from hashlib import sha256
+
+# Every invocation of an urbject needs its code compiled. The code is
+# immutable, so we keep the compiled code objects in an LRU cache keyed by
+# the sha256 of the source (the same "codeid" that get_object_graph()
+# reports). Only compilation is cached: each invocation still executes the
+# module body in a fresh namespace, so invocations can't share state through
+# module globals.
+#
+# If given a db, the cache also stores the marshalled bytecode in the
+# `compiled_code` table, so a restarted node doesn't have to recompile its
+# hot urbjects. Those rows are tagged with the interpreter's bytecode magic
+# number, and ignored by any other interpreter. They are written but not
+# committed: they ride along with the next commit.
+
+class CodeCache:
+    def __init__(self, max_entries=500, db=None):
+        self.max_entries = max_entries
+        self.db = db
+        self._magic = sqlite3.Binary(imp.get_magic())
+        self._entries = OrderedDict() # codeid -> code object
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.loads = 0 # misses satisfied by the db
+
+    def get_codeid(self, code):
+        if isinstance(code, unicode):
+            code = code.encode("utf-8")
+        return sha256(code).hexdigest()
+
+    def get(self, code):
+        """Return a code object for the given source."""
+        codeid = self.get_codeid(code)
+        if codeid in self._entries:
+            self.hits += 1
+            obj = self._entries.pop(codeid)
+        else:
+            self.misses += 1
+            obj = self._load(codeid)
+            if obj is None:
+                obj = compile(code, "<code %s>" % codeid, "exec")
+                self._store(codeid, obj)
+            while len(self._entries) >= self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        self._entries[codeid] = obj # most-recently-used goes last
+        return obj
+
+    def _load(self, codeid):
+        if not self.db:
+            return None
+        c = self.db.cursor()
+        c.execute("SELECT `bytecode` FROM `compiled_code`"
+                  " WHERE `codeid`=? AND `magic`=?", (codeid, self._magic))
+        row = c.fetchone()
+        if not row:
+            return None
+        self.loads += 1
+        return marshal.loads(str(row[0]))
+
+    def _store(self, codeid, obj):
+        if not self.db:
+            return
+        c = self.db.cursor()
+        c.execute("INSERT OR REPLACE INTO `compiled_code` VALUES (?,?,?)",
+                  (codeid, self._magic, sqlite3.Binary(marshal.dumps(obj))))
+
+    def get_stats(self):
+        lookups = self.hits + self.misses
+        hit_ratio = 0.0
+        if lookups:
+            hit_ratio = float(self.hits) / lookups
+        return {"entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": hit_ratio,
+                "evictions": self.evictions,
+                "loads": self.loads,
+                }
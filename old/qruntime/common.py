@@ -1,14 +1,77 @@
+from collections import MutableMapping
 
 class InnerReference:
     def __init__(self, turn):
         self._turn = turn
     def sendOnly(self, args):
         return self._turn.sendOnly(self, args)
+    def send(self, args):
+        # returns an InnerPromise for the result
+        return self._turn.send(self, args)
     def call(self, args):
         return self._turn.local_sync_call(self, args)
+    def congested(self):
+        # True if messages sent to this reference would be deferred
+        return self._turn.congested(self)
+
+class InnerPromise:
+    # see promise.py
+    def __init__(self, turn):
+        self._turn = turn
+    def sendOnly(self, args):
+        return self._turn.sendOnly(self, args)
+    def send(self, args):
+        return self._turn.send(self, args)
+    def is_resolved(self):
+        return self._turn.is_resolved(self)
+    def get_result(self):
+        # raises ValueError if it is unresolved or broken
+        return self._turn.get_result(self)
 
 class NativePower:
     def __init__(self, f):
         self.f = f
     def __call__(self, *args, **kwargs):
         return self.f(*args, **kwargs)
+
+class MemoryProxy(MutableMapping):
+    """The top-level dict of a Memory, as seen by inner code. It knows which
+    keys exist, but loads each value (with load_value(key), which returns
+    (value, value_json)) on first access."""
+    def __init__(self, keys, load_value=None, values=None):
+        self._keys = set(keys)
+        self._original_keys = frozenset(keys)
+        self._load_value = load_value
+        self._values = values or {} # key -> value, loaded or assigned
+        self._loaded_json = {} # key -> value_json, as loaded
+    def __getitem__(self, key):
+        if key not in self._values:
+            if key not in self._keys:
+                raise KeyError(key)
+            value, value_json = self._load_value(key)
+            self._values[key] = value
+            self._loaded_json[key] = value_json
+        return self._values[key]
+    def __setitem__(self, key, value):
+        self._keys.add(key)
+        self._values[key] = value
+    def __delitem__(self, key):
+        if key not in self._keys:
+            raise KeyError(key)
+        self._keys.remove(key)
+        self._values.pop(key, None)
+    def __iter__(self):
+        return iter(list(self._keys))
+    def __len__(self):
+        return len(self._keys)
+    def __repr__(self):
+        return repr(dict(self))
+
+    # these are for the Turn, when it writes back the changes
+    def get_touched(self):
+        # (key, value, loaded_json) for everything that might have changed.
+        # loaded_json is None for assigned keys.
+        return [(key, value, self._loaded_json.get(key))
+                for (key, value) in self._values.items()]
+    def get_deleted(self):
+        return self._original_keys - self._keys
@@ -0,0 +1,57 @@
+import zlib
+
+# Message bodies (JSON, often with large and repetitive args) can be
+# compressed before they are boxed. The v1 message header has a flags byte,
+# which holds the number of the codec that was used (0 means uncompressed).
+# Each Vat advertises the names of the codecs it can decompress (in its
+# ACKs), and senders only use a codec that the recipient has advertised.
+#
+# New codecs are added to the table with register_codec(). Codec numbers go
+# over the wire, so they must never be reused for something else.
+
+NONE = 0
+
+_codecs = {} # number -> (name, compress, decompress)
+
+def register_codec(number, name, compress, decompress):
+    """Add a codec. compress(data) returns the compressed string.
+    decompress(data, max_length) returns the original string, and must raise
+    ValueError rather than produce more than max_length bytes."""
+    assert 0 < number < 256, number
+    assert number not in _codecs, number
+    _codecs[number] = (name, compress, decompress)
+
+def get_codec_names():
+    return sorted([name for (name, _, _) in _codecs.values()])
+
+def choose_codec(their_names):
+    """Return the number of a codec that the peer (who advertised
+    their_names) can decompress, or NONE."""
+    for number in sorted(_codecs):
+        if _codecs[number][0] in their_names:
+            return number
+    return NONE
+
+def compress(number, data):
+    return _codecs[number][1](data)
+
+def decompress(number, data, max_length):
+    if number == NONE:
+        return data
+    if number not in _codecs:
+        raise ValueError("unknown codec %d" % number)
+    return _codecs[number][2](data, max_length)
+
+def _zlib_decompress(data, max_length):
+    d = zlib.decompressobj()
+    try:
+        out = d.decompress(data, max_length)
+    except zlib.error, e:
+        raise ValueError("bad zlib data: %s" % e)
+    if not d.unconsumed_tail:
+        out += d.flush()
+    if d.unconsumed_tail or len(out) > max_length:
+        raise ValueError("decompressed data is too large")
+    return out
+
+register_codec(1, "zlib", zlib.compress, _zlib_decompress)
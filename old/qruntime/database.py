@@ -1,5 +1,5 @@
 
-import os, sys
+import os, sys, base64
 import sqlite3 as sqlite
 
 class DBError(Exception):
@@ -10,6 +10,25 @@ def get_schema(version):
                              "db-schemas", "v%d.sql" % version)
     return open(schema_fn, "r").read()
 
+def get_upgrader(new_version):
+    schema_fn = os.path.join(os.path.dirname(__file__),
+                             "db-schemas", "upgrade-to-v%d.sql" % new_version)
+    return open(schema_fn, "r").read()
+
+def _b64decode(s):
+    return sqlite.Binary(base64.b64decode(s))
+
+def upgrade_db(db, version):
+    # each step is a script (in a single transaction) that brings the
+    # database to the next version
+    db.create_function("b64decode", 1, _b64decode)
+    c = db.cursor()
+    while version < VERSION:
+        c.executescript(get_upgrader(version+1))
+        version += 1
+    return version
+
+VERSION = 2
 
 def get_db(dbfile, stderr=sys.stderr):
     """Open or create the given db file. The parent directory must exist.
@@ -22,7 +41,6 @@ def get_db(dbfile, stderr=sys.stderr):
     except (EnvironmentError, sqlite.OperationalError), e:
         raise DBError("Unable to create/open db file %s: %s" % (dbfile, e))
 
-    VERSION = 1
     c = db.cursor()
     if must_create:
         schema = get_schema(VERSION)
@@ -38,6 +56,12 @@ def get_db(dbfile, stderr=sys.stderr):
         # Perhaps it was created with an old version, or it might be junk.
         raise DBError("db file is unusable: %s" % e)
 
+    if version < VERSION:
+        try:
+            version = upgrade_db(db, version)
+        except sqlite.DatabaseError, e:
+            raise DBError("Unable to upgrade db from version %s: %s"
+                          % (version, e))
     if version != VERSION:
         raise DBError("Unable to handle db version %s" % version)
 
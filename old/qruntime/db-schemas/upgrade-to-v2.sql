@@ -0,0 +1,126 @@
+-- run by database.py to upgrade a v1 database, in a single transaction. It
+-- provides the b64decode() function.
+BEGIN;
+
+ALTER TABLE `node` ADD COLUMN `max_message_size` INTEGER;
+ALTER TABLE `node` ADD COLUMN `turn_wall_limit` REAL;
+ALTER TABLE `node` ADD COLUMN `turn_cpu_limit` REAL;
+ALTER TABLE `node` ADD COLUMN `turn_memory_limit` INTEGER;
+ALTER TABLE `node` ADD COLUMN `turn_workers` INTEGER;
+ALTER TABLE `node` ADD COLUMN `value_format` STRING;
+
+ALTER TABLE `vat_urls` RENAME TO `vat_urls_v1`;
+CREATE TABLE `vat_urls`
+(
+ `vatid` VARCHAR(256), -- "pk0-base32.."
+ `url` VARCHAR(512),
+ UNIQUE (`vatid`, `url`)
+);
+INSERT OR IGNORE INTO `vat_urls` SELECT `vatid`, `url` FROM `vat_urls_v1`;
+DROP TABLE `vat_urls_v1`;
+
+-- queued messages were base64-encoded v0 messages, which peers still accept
+ALTER TABLE `outbound_messages` RENAME TO `outbound_messages_v1`;
+CREATE TABLE `outbound_messages` -- unACKed messages
+(
+ `to_vatid` STRING, -- "pk0-base32.."
+ `last_sent` INTEGER, -- seconds since epoch
+ `msgnum` INTEGER,
+ `message` BLOB -- boxed (in v1 format) and ready to ship
+);
+INSERT INTO `outbound_messages`
+ SELECT `to_vatid`, `last_sent`, `msgnum`, b64decode(`message_b64`)
+ FROM `outbound_messages_v1`;
+DROP TABLE `outbound_messages_v1`;
+
+CREATE INDEX `outbound_messages_to_vatid` ON `outbound_messages`
+ (`to_vatid`, `msgnum`);
+
+CREATE TABLE `outbound_schedule` -- retry state, one row per vat with
+                                 -- pending messages
+(
+ `to_vatid` VARCHAR(256) UNIQUE, -- "pk0-base32.."
+ `backoff_level` INTEGER, -- consecutive failed delivery attempts
+ `next_retry` INTEGER -- seconds since epoch
+);
+
+CREATE INDEX `outbound_schedule_next_retry` ON `outbound_schedule`
+ (`next_retry`);
+
+CREATE UNIQUE INDEX `inbound_messages_key` ON `inbound_messages`
+ (`from_vatid`, `msgnum`);
+
+CREATE TABLE `inbound_early_messages` -- received out of order, waiting for
+                                      -- the gap to be filled
+(
+ `from_vatid` STRING, -- "pk0-base32.."
+ `msgnum` INTEGER,
+ `message_json` STRING, -- decrypted
+ UNIQUE (`from_vatid`, `msgnum`)
+);
+
+-- existing Memories keep their `data_json`, and are split into
+-- `memory_keys` when they are next written (see memory.py)
+CREATE TABLE `memory_keys` -- one row per top-level key, see memory.py
+(
+ `memid` VARCHAR(256), -- "mem0-base32.."
+ `key` TEXT,
+ `value_json` TEXT, -- not STRING: its NUMERIC affinity would turn "1" into 1
+ PRIMARY KEY (`memid`, `key`)
+);
+
+CREATE TABLE `memory_journal` -- changes not yet folded into `memory_keys`
+(
+ `seqnum` INTEGER PRIMARY KEY AUTOINCREMENT,
+ `memid` VARCHAR(256), -- "mem0-base32.."
+ `key` TEXT,
+ `value_json` TEXT -- NULL if the key was deleted
+);
+
+CREATE INDEX `memory_journal_key` ON `memory_journal` (`memid`, `key`);
+
+CREATE TABLE `urbject_budgets` -- overrides the node's turn budgets
+(
+ `urbjid` VARCHAR(256) PRIMARY KEY, -- "urb0-base32.."
+ `wall_limit` REAL, -- NULL for the node's limit
+ `cpu_limit` REAL,
+ `memory_limit` INTEGER
+);
+
+CREATE TABLE `urbject_usage` -- totals over all of an urbject's turns
+(
+ `urbjid` VARCHAR(256) PRIMARY KEY, -- "urb0-base32.."
+ `turns` INTEGER,
+ `aborted` INTEGER, -- turns that went over budget
+ `wall_time` REAL,
+ `cpu_time` REAL,
+ `max_memory` INTEGER -- largest growth during a single turn
+);
+
+CREATE TABLE `promises` -- result promises, see promise.py
+(
+ `promid` VARCHAR(256) PRIMARY KEY, -- "prm0-base32.."
+ `decider_vatid` VARCHAR(256), -- the vat that resolves it
+ `state` VARCHAR(16), -- "unresolved", "fulfilled", or "broken"
+ `resolution_json` TEXT -- packed result, or the problem if broken
+);
+
+CREATE TABLE `promise_messages` -- sent to promises before they resolved
+(
+ `seqnum` INTEGER PRIMARY KEY AUTOINCREMENT,
+ `promid` VARCHAR(256), -- "prm0-base32.."
+ `message_json` TEXT
+);
+
+CREATE INDEX `promise_messages_promid` ON `promise_messages` (`promid`);
+
+CREATE TABLE `compiled_code` -- a cache, see codecache.py
+(
+ `codeid` VARCHAR(64) PRIMARY KEY, -- sha256(code) in hex
+ `magic` BLOB, -- imp.get_magic() of the interpreter that compiled it
+ `bytecode` BLOB -- marshal.dumps(code object)
+);
+
+UPDATE `version` SET `version`=2;
+
+COMMIT;
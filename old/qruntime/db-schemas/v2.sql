@@ -0,0 +1,167 @@
+CREATE TABLE `version`
+(
+ `version` INTEGER -- contains one row, set to 2
+);
+
+CREATE TABLE `node` -- contains one row
+(
+ `webport` STRING,
+ `pubkey` STRING, -- "pk0-base32..", nacl public key
+ `privkey` STRING, -- "sk0-base32..", nacl private key
+ `max_message_size` INTEGER, -- largest inbound body, NULL for the default
+ -- per-turn budgets (see budget.py), NULL for the defaults
+ `turn_wall_limit` REAL, -- seconds
+ `turn_cpu_limit` REAL, -- seconds
+ `turn_memory_limit` INTEGER, -- bytes
+ `turn_workers` INTEGER, -- worker processes for turns, NULL or 0 for none
+ `value_format` STRING -- "json" or "binary" (see serialization.py)
+);
+
+CREATE TABLE `webui_initial_nonces`
+(
+ `nonce` STRING
+);
+
+CREATE TABLE `webui_access_tokens`
+(
+ `token` STRING
+);
+
+CREATE TABLE `vat_urls`
+(
+ `vatid` VARCHAR(256), -- "pk0-base32.."
+ `url` VARCHAR(512),
+ UNIQUE (`vatid`, `url`)
+);
+
+CREATE TABLE `outbound_msgnums`
+(
+ `to_vatid` VARCHAR(256) UNIQUE, -- "pk0-base32.."
+ `next_msgnum` INTEGER -- one higher than last ACKed message
+);
+
+CREATE TABLE `outbound_messages` -- unACKed messages
+(
+ `to_vatid` STRING, -- "pk0-base32.."
+ `last_sent` INTEGER, -- seconds since epoch
+ `msgnum` INTEGER,
+ `message` BLOB -- boxed (in v1 format) and ready to ship
+);
+
+CREATE INDEX `outbound_messages_to_vatid` ON `outbound_messages`
+ (`to_vatid`, `msgnum`);
+
+CREATE TABLE `outbound_schedule` -- retry state, one row per vat with
+                                 -- pending messages
+(
+ `to_vatid` VARCHAR(256) UNIQUE, -- "pk0-base32.."
+ `backoff_level` INTEGER, -- consecutive failed delivery attempts
+ `next_retry` INTEGER -- seconds since epoch
+);
+
+CREATE INDEX `outbound_schedule_next_retry` ON `outbound_schedule`
+ (`next_retry`);
+
+CREATE TABLE `inbound_msgnums`
+(
+ `from_vatid` VARCHAR(256) UNIQUE, -- "pk0-base32.."
+ `next_msgnum` INTEGER -- one higher than last checkpointed message
+);
+
+CREATE TABLE `inbound_messages` -- undelivered messages
+(
+ `from_vatid` STRING, -- "pk0-base32.."
+ `msgnum` INTEGER,
+ `message_json` STRING -- decrypted
+);
+
+CREATE UNIQUE INDEX `inbound_messages_key` ON `inbound_messages`
+ (`from_vatid`, `msgnum`);
+
+CREATE TABLE `inbound_early_messages` -- received out of order, waiting for
+                                      -- the gap to be filled
+(
+ `from_vatid` STRING, -- "pk0-base32.."
+ `msgnum` INTEGER,
+ `message_json` STRING, -- decrypted
+ UNIQUE (`from_vatid`, `msgnum`)
+);
+
+CREATE TABLE `memory`
+(
+ `memid` VARCHAR(256) UNIQUE, -- "mem0-base32.."
+ `data_json` STRING -- NULL if the contents are in `memory_keys`
+);
+
+CREATE TABLE `memory_keys` -- one row per top-level key, see memory.py
+(
+ `memid` VARCHAR(256), -- "mem0-base32.."
+ `key` TEXT,
+ `value_json` TEXT, -- not STRING: its NUMERIC affinity would turn "1" into 1
+ PRIMARY KEY (`memid`, `key`)
+);
+
+CREATE TABLE `memory_journal` -- changes not yet folded into `memory_keys`
+(
+ `seqnum` INTEGER PRIMARY KEY AUTOINCREMENT,
+ `memid` VARCHAR(256), -- "mem0-base32.."
+ `key` TEXT,
+ `value_json` TEXT -- NULL if the key was deleted
+);
+
+CREATE INDEX `memory_journal_key` ON `memory_journal` (`memid`, `key`);
+
+CREATE TABLE `power`
+(
+ `powid` VARCHAR(256) UNIQUE, -- "pow0-base32.."
+ `power_json` STRING
+);
+
+CREATE TABLE `urbjects`
+(
+ `urbjid` VARCHAR(256) UNIQUE, -- "urb0-base32.."
+ `powid` VARCHAR(256), -- "pow0-base32.."
+ `code` STRING
+);
+
+CREATE TABLE `urbject_budgets` -- overrides the node's turn budgets
+(
+ `urbjid` VARCHAR(256) PRIMARY KEY, -- "urb0-base32.."
+ `wall_limit` REAL, -- NULL for the node's limit
+ `cpu_limit` REAL,
+ `memory_limit` INTEGER
+);
+
+CREATE TABLE `urbject_usage` -- totals over all of an urbject's turns
+(
+ `urbjid` VARCHAR(256) PRIMARY KEY, -- "urb0-base32.."
+ `turns` INTEGER,
+ `aborted` INTEGER, -- turns that went over budget
+ `wall_time` REAL,
+ `cpu_time` REAL,
+ `max_memory` INTEGER -- largest growth during a single turn
+);
+
+CREATE TABLE `promises` -- result promises, see promise.py
+(
+ `promid` VARCHAR(256) PRIMARY KEY, -- "prm0-base32.."
+ `decider_vatid` VARCHAR(256), -- the vat that resolves it
+ `state` VARCHAR(16), -- "unresolved", "fulfilled", or "broken"
+ `resolution_json` TEXT -- packed result, or the problem if broken
+);
+
+CREATE TABLE `promise_messages` -- sent to promises before they resolved
+(
+ `seqnum` INTEGER PRIMARY KEY AUTOINCREMENT,
+ `promid` VARCHAR(256), -- "prm0-base32.."
+ `message_json` TEXT
+);
+
+CREATE INDEX `promise_messages_promid` ON `promise_messages` (`promid`);
+
+CREATE TABLE `compiled_code` -- a cache, see codecache.py
+(
+ `codeid` VARCHAR(64) PRIMARY KEY, -- sha256(code) in hex
+ `magic` BLOB, -- imp.get_magic() of the interpreter that compiled it
+ `bytecode` BLOB -- marshal.dumps(code object)
+);
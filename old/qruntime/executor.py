@@ -1,52 +1,367 @@
 
-import json
-from hashlib import sha256
+import json, traceback
 from twisted.application import service
 from twisted.python import log
-from .urbject import create_power_for_memid, Urbject
+from .urbject import create_power_for_memid
 from .pack import list_authorities
-from .turn import Turn
-from .memory import create_memory
+from .turn import Turn, apply_effects
+from .memory import create_memory, Memory
+from .codecache import CodeCache
+from .records import RecordCache
+from .groupcommit import GroupCommitter
+from .journal import MemoryJournal
+from .budget import Budgets, BudgetExceeded
+from .workers import WorkerPool, TurnFailed, effects_from_text
+from .scheduler import predict_footprint, ConflictTracker
+from .promise import (process_promise_message, resolve_promise,
+                      resolved_message, create_promise, check_result,
+                      BROKEN)
+from .outbound import PeerCongested, MessageTooLarge, BadVatid
+from .serialization import JSON, dumps_message
 from . import util
 
+# Turns don't commit (see turn.py). After each turn, process_request() asks
+# for a commit within commit_window seconds, and commits are shared: one
+# commit covers every turn that finished in the meantime (up to commit_batch
+# of them), so a busy vat pays one fsync per batch of turns instead of
+# several per turn. deliver_inbound_messages() also flushes at the end of
+# each batch. Outbound messages queued by a turn are only released for
+# delivery once it has been committed.
+#
+# With journal_memory=True, turns append their Memory changes to a journal
+# instead of rewriting them in place (see journal.py).
+#
+# Each turn runs within a budget (see budget.py). A turn that goes over its
+# budget is rolled back and its message is retired, just as if the inner
+# code had finished without doing anything.
+#
+# After use_workers(), turns run in a pool of worker processes instead (see
+# workers.py), and process_request() returns a Deferred that fires once the
+# turn's effects have been applied. A worker reads from its own connection,
+# so everything written so far is committed before each turn is handed
+# over. Turns whose Memories don't overlap run in parallel, and a turn that
+# read a Memory changed by one applied in the meantime is run again (see
+# scheduler.py): the comms Server asks can_start() and is_saturated()
+# before handing over each message.
+#
+# An invoke message may carry a result promise (see promise.py), which the
+# turn resolves. If the turn goes over its budget or raises an exception,
+# the promise is broken instead, and the message is retired like any other:
+# the failure has been reported to whoever was waiting for it. (A failed
+# turn without a result promise still raises. In the reactor its message is
+# kept; a worker's is retired too, so its sender isn't stuck behind it.)
+# A message whose reply_to isn't a vatid is dropped before it runs. A turn
+# that sends to a reference with a bogus vatid fails before writing
+# anything, and its message is retired even without a result promise:
+# running it again would only fail the same way.
+# Messages sent to promises, and resolutions of the promises we hold, are
+# bookkeeping: they don't run a turn, even with workers.
+#
+# Turns pack new and changed Memories and powers in value_format (see
+# serialization.py), which the node config can set to BINARY. Messages
+# carry their args as a nested "args" object, but those queued by a turn
+# of this vat (and messages from older vats) hold packed "args_json".
+
 class ExecutionServer(service.Service):
+    commit_window = 0.01
+    commit_batch = 100
+    journal_memory = False
+    journal_max_entries = 100
+    journal_max_bytes = 1000*1000
+    value_format = JSON
+
     def __init__(self, db, vatid, comms):
         self.db = db
         self.vatid = vatid
         self._comms_server = comms
+        self.code_cache = CodeCache(db=db)
+        self.records = RecordCache(db)
+        self.commits = GroupCommitter(db, self.commit_window,
+                                      self.commit_batch)
+        self.budgets = Budgets(db)
+        self.journal = None
+        if self.journal_memory:
+            self.journal = MemoryJournal(db, self.commits,
+                                         self.journal_max_entries,
+                                         self.journal_max_bytes)
+        self.pool = None
+        self.tracker = ConflictTracker()
+        self._next_token = 0
         self._debug_processed_counter = 0
 
+    def use_workers(self, count, dbfile):
+        self.pool = WorkerPool(dbfile, self.vatid, count)
+
+    def startService(self):
+        service.Service.startService(self)
+        if self.pool:
+            self.pool.start()
+
+    def stopService(self):
+        if self.journal:
+            self.journal.compact()
+        self.commits.flush()
+        service.Service.stopService(self)
+        if self.pool:
+            return self.pool.stop()
+
     def process_request(self, msg, from_vatid):
         # main request-execution handler
         log.msg("PROCESS %s" % (msg,))
+        if str(msg["command"]) in ("send_promise", "resolved"):
+            process_promise_message(self.db, self, msg, from_vatid)
+            self._turn_done()
+            return None
+        if msg.get("result"):
+            try:
+                self.check_vatid(msg.get("reply_to"))
+            except BadVatid, e:
+                log.msg("ignoring message from %s: bad reply_to: %s"
+                        % (from_vatid, e))
+                self._turn_done()
+                return None
+        result = self._get_result(msg)
+        if result:
+            if not check_result(self.db, result[0], self.vatid, from_vatid):
+                log.msg("ignoring message from %s: result %s is already in"
+                        " use" % (from_vatid, result[0]))
+                self._turn_done()
+                return None
+            # we decide it, so messages sent to it can wait here
+            create_promise(self.db, result[0], self.vatid)
+        if self.pool:
+            return self._dispatch_turn(msg, from_vatid)
         try:
             self._process_request(msg, from_vatid)
         except:
             # TODO: think through exception handling
             raise
+        self._turn_done()
+
+    def _turn_done(self):
         self._debug_processed_counter += 1
+        d = self.commits.commit_soon()
+        d.addCallback(lambda _: self._comms_server.messages_committed())
+        d.addErrback(log.err)
 
     def _process_request(self, msg, from_vatid):
         # really, you should ignore from_vatid
         command = str(msg["command"])
+        result = self._get_result(msg)
         if command == "execute":
             memid = str(msg["memid"])
-            powid = create_power_for_memid(self.db, memid)
-            t = Turn(self, self.db)
-            t.start_turn(msg["code"], powid, msg["args_json"], from_vatid)
+            powid = create_power_for_memid(self.db, memid, commit=False)
+            self._run_turn(None, msg["code"], powid, msg, from_vatid,
+                           result)
             return
         if command == "invoke":
             urbjid = str(msg["urbjid"])
-            u = Urbject(self.db, urbjid)
-            code, powid = u.get_code_and_powid()
-            t = Turn(self, self.db)
-            t.start_turn(code, powid, msg["args_json"], from_vatid)
+            code, powid = self.records.get_urbject(urbjid)
+            self._run_turn(urbjid, code, powid, msg, from_vatid, result)
             return
         #raise ValueError("unknown command '%s'" % command)
         log.msg("ignored command '%s'" % command)
 
+    def _get_result(self, msg):
+        if msg.get("result"):
+            return (str(msg["result"]), str(msg["reply_to"]))
+        return None
+
+    def _break_result(self, result, problem):
+        if result:
+            (promid, reply_to) = result
+            resolve_promise(self.db, self, promid, reply_to, BROKEN,
+                            json.dumps(problem))
+
+    def _run_turn(self, urbjid, code, powid, msg, from_vatid, result=None):
+        t = Turn(self, self.db, self.records, value_format=self.value_format)
+        aborted = False
+        try:
+            t.start_turn(code, powid, msg.get("args_json"), from_vatid,
+                         budget=self.budgets.get_budget(urbjid),
+                         result=result, args=msg.get("args"))
+        except BudgetExceeded, e:
+            log.msg("turn of %s aborted: over budget (%s)" % (urbjid, e))
+            aborted = True
+            self._break_result(result, "over budget (%s)" % (e,))
+        except PeerCongested:
+            raise
+        except BadVatid, e:
+            log.msg("turn of %s failed: %s" % (urbjid, e))
+            self._break_result(result, "turn failed: %s" % (e,))
+        except Exception, e:
+            if not result:
+                raise
+            log.err(None, "turn of %s failed" % (urbjid,))
+            problem = traceback.format_exception_only(type(e), e)[-1]
+            self._break_result(result, "turn failed: %s" % problem.strip())
+        finally:
+            if urbjid and t.meter:
+                self.budgets.record_usage(urbjid, t.meter.get_usage(),
+                                          aborted)
+        log.msg("TURN %s" % (t.get_report(),))
+
+    def _predict_footprint(self, msg):
+        command = str(msg["command"])
+        if command == "execute":
+            return set([str(msg["memid"])])
+        if command == "invoke":
+            return predict_footprint(self.records, self.vatid,
+                                     str(msg["urbjid"]))
+        return set()
+
+    def can_start(self, msg):
+        """Can this message's turn start now, alongside the turns that are
+        already running?"""
+        if not self.pool:
+            return True
+        return not self.tracker.overlaps(self._predict_footprint(msg))
+
+    def is_saturated(self):
+        """Is every worker already busy?"""
+        return bool(self.pool) and self.tracker.running() >= self.pool.size
+
+    def _dispatch_turn(self, msg, from_vatid):
+        command = str(msg["command"])
+        if command == "execute":
+            urbjid = None
+            code = msg["code"]
+            powid = create_power_for_memid(self.db, str(msg["memid"]),
+                                           commit=False)
+        elif command == "invoke":
+            urbjid = str(msg["urbjid"])
+            code, powid = self.records.get_urbject(urbjid)
+        else:
+            log.msg("ignored command '%s'" % command)
+            return None
+        # the worker must see everything we've written so far
+        self.commits.flush()
+        budget = self.budgets.get_budget(urbjid)
+        request = {"code": code,
+                   "powid": powid,
+                   "from_vatid": from_vatid,
+                   "budget": [budget.wall_limit, budget.cpu_limit,
+                              budget.memory_limit],
+                   "result": self._get_result(msg),
+                   "value_format": self.value_format,
+                   }
+        for key in ("args_json", "args"):
+            if key in msg:
+                request[key] = msg[key]
+        token = self._next_token
+        self._next_token += 1
+        d = self._start_worker_turn(token, self._predict_footprint(msg),
+                                    request, urbjid)
+        def _finished(res):
+            self.tracker.finished(token)
+            return res
+        d.addBoth(_finished)
+        def _failed(f):
+            # the comms Server retires the message, so anyone waiting for
+            # the result must hear about it now
+            if not f.check(PeerCongested):
+                self._break_result(request["result"],
+                                   "turn failed: %s" % f.getErrorMessage())
+            return f
+        d.addErrback(_failed)
+        return d
+
+    def _start_worker_turn(self, token, predicted, request, urbjid):
+        self.tracker.start(token, predicted)
+        d = self.pool.run_turn(request, request["budget"][0])
+        d.addCallback(self._worker_turn_finished, token, predicted, request,
+                      urbjid)
+        return d
+
+    def _worker_turn_finished(self, response, token, predicted, request,
+                              urbjid):
+        if self.tracker.conflicted(token, response.get("footprint", [])):
+            # it read a Memory that another turn changed after it started,
+            # so its results are stale. Run it again, on the current state.
+            log.msg("turn of %s conflicted, running it again" % (urbjid,))
+            self.commits.flush()
+            return self._start_worker_turn(token, predicted, request, urbjid)
+        aborted = response.get("aborted")
+        if urbjid and "usage" in response:
+            self.budgets.record_usage(urbjid, response["usage"], aborted)
+        if "error" in response:
+            if not request["result"]:
+                raise TurnFailed(response["error"])
+            log.msg("turn of %s failed: %s" % (urbjid, response["error"]))
+            problem = response["error"].strip().splitlines()[-1]
+            self._fail_worker_turn(request["result"], problem)
+            return
+        if aborted:
+            log.msg("turn of %s aborted: over budget (%s)"
+                    % (urbjid, aborted))
+            self._break_result(request["result"],
+                               "over budget (%s)" % (aborted,))
+            self._turn_done()
+            return
+        # like Turn._commit_turn(), defer or fail the turn before writing
+        # anything
+        effects = effects_from_text(response["effects"])
+        try:
+            self._check_effects(effects)
+        except MessageTooLarge, e:
+            if not request["result"]:
+                raise
+            log.msg("turn of %s failed: %s" % (urbjid, e))
+            self._fail_worker_turn(request["result"],
+                                   "MessageTooLarge: %s" % (e,))
+            return
+        except BadVatid, e:
+            log.msg("turn of %s failed: %s" % (urbjid, e))
+            self._fail_worker_turn(request["result"], str(e))
+            return
+        apply_effects(self.db, self, effects)
+        self.tracker.applied([effect[1] for effect in effects
+                              if effect[0] == "memory_keys"])
+        log.msg("TURN %s" % (response["report"],))
+        self._turn_done()
+
+    def check_vatid(self, vatid):
+        self._comms_server.check_vatid(vatid)
+
+    def check_message(self, target_vatid, msg):
+        """Raise BadVatid, PeerCongested or MessageTooLarge if a turn can't
+        send 'msg' (a dict) to target_vatid now. Turns check each message
+        before they write anything."""
+        self.check_vatid(target_vatid)
+        if self.is_congested(target_vatid):
+            raise PeerCongested(target_vatid)
+        if target_vatid != self.vatid:
+            size = len(dumps_message(msg))
+            self._comms_server.check_message_size(target_vatid, size)
+
+    def _fail_worker_turn(self, result, problem):
+        # the failure is reported through the result promise, and the
+        # message is retired
+        self._break_result(result, "turn failed: %s" % problem)
+        self._turn_done()
+
+    def _check_effects(self, effects):
+        # like Turn._commit_turn(), for a worker's turn
+        for effect in effects:
+            if effect[0] == "message":
+                self.check_message(effect[1], effect[2])
+            elif effect[0] == "resolve":
+                (promid, reply_to, state, resolution_json) = effect[1:]
+                self.check_message(reply_to,
+                                   resolved_message(promid, state,
+                                                    resolution_json))
+
+    def is_congested(self, target_vatid):
+        return self._comms_server.is_congested(target_vatid)
+
     def send_message(self, target_vatid, msg):
-        self._comms_server.send_message(target_vatid, msg)
+        # 'msg' is a dict. This is only called by a Turn, so the message is
+        # queued without committing.
+        if target_vatid == self.vatid:
+            self._comms_server.queue_loopback(msg)
+        else:
+            self._comms_server.queue_message(target_vatid,
+                                             dumps_message(msg))
 
     # debug / CLI tools, triggered by 'poke'
 
@@ -54,13 +369,13 @@ class ExecutionServer(service.Service):
         msg = {"command": "execute",
                "memid": memid,
                "code": code,
-               "args_json": json.dumps(args)}
+               "args": args}
         self._comms_server.send_message(vatid, json.dumps(msg))
 
     def send_invoke(self, vatid, urbjid, args):
         msg = {"command": "invoke",
                "urbjid": urbjid,
-               "args_json": json.dumps(args)}
+               "args": args}
         self._comms_server.send_message(vatid, json.dumps(msg))
 
     def poke(self, body):
@@ -69,7 +384,7 @@ class ExecutionServer(service.Service):
             vatid, urbjid = util.parse_spid(send_msg["spid"])
             msg = {"command": "invoke",
                    "urbjid": urbjid,
-                   "args_json": send_msg["args"]}
+                   "args": json.loads(send_msg["args"])}
             self._comms_server.send_message(vatid, json.dumps(msg))
             return "message sent"
         if body.startswith("create-memory"):
@@ -87,6 +402,9 @@ class ExecutionServer(service.Service):
             args = {"foo": 12}
             self.send_invoke(vatid, urbjid, args)
             return "invoke sent"
+        if body.startswith("usage "):
+            cmd, urbjid = body.strip().split()
+            return json.dumps(self.budgets.get_usage(urbjid))
         self._comms_server.trigger_inbound()
         self._comms_server.trigger_outbound()
         return "I am poked"
@@ -112,7 +430,7 @@ class ExecutionServer(service.Service):
         for (urbjid,powid,code) in c.fetchall():
             graph[urbjid] = {"type": "urbject",
                              "powid": powid,
-                             "codeid": sha256(code).hexdigest()}
+                             "codeid": self.code_cache.get_codeid(code)}
         c.execute("SELECT `powid`,`power_json` FROM `power`")
         for (powid,power_json) in c.fetchall():
             powers = []
@@ -124,8 +442,9 @@ class ExecutionServer(service.Service):
                                "swissnum": swissnum})
             graph[powid] = {"type": "power",
                             "powers": powers}
-        c.execute("SELECT `memid`,`data_json` FROM `memory`")
-        for (memid,data_json) in c.fetchall():
+        c.execute("SELECT `memid` FROM `memory`")
+        for (memid,) in c.fetchall():
+            data_json = Memory(self.db, memid).get_raw_data()
             powers = []
             for (power_type, swissnum) in list_authorities(data_json, False):
                 if power_type == "reference":
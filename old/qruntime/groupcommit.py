@@ -0,0 +1,47 @@
+from twisted.internet import reactor, defer
+from twisted.python import failure
+
+# Accepting an inbound message means writing it to the database, and we
+# can't ACK it until that write is durable. Rather than paying for a full
+# commit (and fsync) per message, the GroupCommitter collects everyone who
+# needs a commit during a short window (or until max_pending of them have
+# accumulated), performs a single commit, and then fires all of their
+# Deferreds at once.
+
+class GroupCommitter:
+    def __init__(self, db, window=0.005, max_pending=100, clock=reactor):
+        self.db = db
+        self.window = window
+        self.max_pending = max_pending
+        self._clock = clock
+        self._timer = None
+        self._waiters = []
+        self.commits = 0
+
+    def commit_soon(self):
+        """Return a Deferred that fires (with None) once everything written
+        to the database so far has been committed."""
+        d = defer.Deferred()
+        self._waiters.append(d)
+        if len(self._waiters) >= self.max_pending:
+            self.flush()
+        elif not self._timer:
+            self._timer = self._clock.callLater(self.window, self.flush)
+        return d
+
+    def flush(self):
+        if self._timer:
+            if self._timer.active():
+                self._timer.cancel()
+            self._timer = None
+        waiters, self._waiters = self._waiters, []
+        try:
+            self.db.commit()
+            self.commits += 1
+        except:
+            f = failure.Failure()
+            for d in waiters:
+                d.errback(f)
+            return
+        for d in waiters:
+            d.callback(None)
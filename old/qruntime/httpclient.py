@@ -0,0 +1,118 @@
+from StringIO import StringIO
+from urlparse import urlparse
+from twisted.application import service
+from twisted.internet import reactor, defer
+from twisted.web.client import (Agent, HTTPConnectionPool, FileBodyProducer,
+                                readBody)
+from twisted.web.http_headers import Headers
+from twisted.web import error
+
+# All vat-to-vat traffic goes through a single DeliveryClient, which keeps
+# persistent (HTTP/1.1 keep-alive) connections to each peer URL, so busy
+# vats don't pay a TCP handshake for every batch of messages. Idle
+# connections are kept warm (up to max_idle_per_host of them) for
+# idle_timeout seconds, after which the pool closes them. Independently, at
+# most max_connections_per_host requests may be in flight to any one
+# host:port at a time: further requests wait their turn.
+
+class _CountingPool(HTTPConnectionPool):
+    # HTTPConnectionPool doesn't tell anyone whether a request got a cached
+    # connection or a new one, so count the new ones ourselves
+    def __init__(self, reactor, persistent=True):
+        HTTPConnectionPool.__init__(self, reactor, persistent)
+        self.connections_used = 0
+        self.new_connections = 0
+
+    def getConnection(self, key, endpoint):
+        self.connections_used += 1
+        return HTTPConnectionPool.getConnection(self, key, endpoint)
+
+    def _newConnection(self, key, endpoint):
+        self.new_connections += 1
+        return HTTPConnectionPool._newConnection(self, key, endpoint)
+
+class DeliveryClient(service.Service):
+    def __init__(self, max_idle_per_host=2, max_connections_per_host=4,
+                 idle_timeout=60, timeout=60, _reactor=reactor):
+        self._reactor = _reactor
+        self.pool = _CountingPool(_reactor, persistent=True)
+        self.pool.maxPersistentPerHost = max_idle_per_host
+        self.pool.cachedConnectionTimeout = idle_timeout
+        # vat messages are not idempotent, don't replay them on a stale
+        # connection. The sender will retry the whole batch instead.
+        self.pool.retryAutomatically = False
+        self.agent = Agent(_reactor, pool=self.pool)
+        self.max_connections_per_host = max_connections_per_host
+        self.timeout = timeout
+        self._host_limits = {} # (scheme,host,port) -> DeferredSemaphore
+        self.requests = 0
+        self.failures = 0
+        self._in_flight = set() # Deferreds, fired when each post is done
+
+    def stopService(self):
+        # a post that is still running will put its connection back into
+        # the pool when it finishes, so wait for those before closing them
+        service.Service.stopService(self)
+        d = defer.DeferredList(list(self._in_flight))
+        d.addCallback(lambda _: self.pool.closeCachedConnections())
+        return d
+
+    def _get_limit(self, url):
+        u = urlparse(url)
+        key = (u.scheme, u.hostname, u.port)
+        if key not in self._host_limits:
+            limit = defer.DeferredSemaphore(self.max_connections_per_host)
+            self._host_limits[key] = limit
+        return self._host_limits[key]
+
+    def post(self, url, body):
+        """POST 'body' to 'url'. Returns a Deferred that fires with the
+        response body, or errbacks if the request fails, times out, or gets
+        a non-200 response."""
+        self.requests += 1
+        d = self._get_limit(url).run(self._post, url, body)
+        def _failed(f):
+            self.failures += 1
+            return f
+        d.addErrback(_failed)
+        done = defer.Deferred()
+        self._in_flight.add(done)
+        def _finished(res):
+            self._in_flight.discard(done)
+            done.callback(None)
+            return res
+        d.addBoth(_finished)
+        return d
+
+    def _post(self, url, body):
+        d = self.agent.request("POST", url,
+                               Headers({"content-type":
+                                        ["application/octet-stream"]}),
+                               FileBodyProducer(StringIO(body)))
+        timer = self._reactor.callLater(self.timeout, d.cancel)
+        def _got_response(response):
+            d2 = readBody(response)
+            def _check(body):
+                if response.code != 200:
+                    raise error.Error(response.code, response.phrase, body)
+                return body
+            d2.addCallback(_check)
+            return d2
+        d.addCallback(_got_response)
+        def _done(res):
+            if timer.active():
+                timer.cancel()
+            return res
+        d.addBoth(_done)
+        return d
+
+    def get_stats(self):
+        idle = sum([len(conns) for conns in self.pool._connections.values()])
+        return {"requests": self.requests,
+                "failures": self.failures,
+                "new_connections": self.pool.new_connections,
+                "reused_connections": (self.pool.connections_used
+                                       - self.pool.new_connections),
+                "idle_connections": idle,
+                "hosts": len(self._host_limits),
+                }
@@ -0,0 +1,86 @@
+from twisted.internet import reactor
+from twisted.python import log
+from .memory import Memory
+from .serialization import from_db
+
+# In journaled mode, a Turn appends its Memory changes to the
+# `memory_journal` table (in the turn's own transaction) instead of
+# rewriting `memory_keys`. Appends are sequential and proportional to the
+# change, but every read of a Memory has to overlay its journal, so the
+# MemoryJournal keeps track of how much each Memory has accumulated. Once a
+# Memory has more than max_entries journal rows, or more than max_bytes of
+# journaled values, it is folded into `memory_keys` shortly afterwards.
+# Folding is written to the open transaction and committed through the
+# GroupCommitter, like a turn.
+#
+# The journal is also a stream of every change, in order: read_journal()
+# returns the rows after a given seqnum, for incremental backup or
+# replication. Folding deletes rows, so a tailer must keep up (or use larger
+# thresholds).
+
+def read_journal(db, after_seqnum=0, limit=1000):
+    """Return a list of (seqnum, memid, key, value_json) for the journal
+    rows after 'after_seqnum'. value_json is None for a deleted key."""
+    c = db.cursor()
+    c.execute("SELECT `seqnum`,`memid`,`key`,`value_json`"
+              " FROM `memory_journal` WHERE `seqnum`>?"
+              " ORDER BY `seqnum` LIMIT ?", (after_seqnum, limit))
+    return [(seqnum, memid, key, from_db(value_json))
+            for (seqnum, memid, key, value_json) in c.fetchall()]
+
+class MemoryJournal:
+    def __init__(self, db, committer, max_entries=100, max_bytes=1000*1000,
+                 clock=reactor):
+        self.db = db
+        self._committer = committer
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._clock = clock
+        self._timer = None
+        self._pending = {} # memid -> [entries, bytes]
+        self._due = set() # memids waiting to be folded
+        self.appends = 0
+        self.compactions = 0
+        c = db.cursor()
+        c.execute("SELECT `memid`, COUNT(*), SUM(LENGTH(`value_json`))"
+                  " FROM `memory_journal` GROUP BY `memid`")
+        for (memid, entries, size) in c.fetchall():
+            self._add(memid, entries, size or 0)
+
+    def _add(self, memid, entries, size):
+        pending = self._pending.setdefault(memid, [0, 0])
+        pending[0] += entries
+        pending[1] += size
+        if pending[0] > self.max_entries or pending[1] > self.max_bytes:
+            self._due.add(memid)
+            if not self._timer:
+                self._timer = self._clock.callLater(0, self.compact)
+
+    def append(self, memory, changed, deleted):
+        """Journal the changes to a Memory, without committing. Returns the
+        number of bytes appended."""
+        size = memory.append_journal(changed, deleted)
+        self.appends += 1
+        self._add(memory.memid, len(changed) + len(deleted), size)
+        return size
+
+    def compact(self):
+        if self._timer:
+            if self._timer.active():
+                self._timer.cancel()
+            self._timer = None
+        due, self._due = self._due, set()
+        for memid in due:
+            Memory(self.db, memid).fold_journal()
+            del self._pending[memid]
+            self.compactions += 1
+        if due:
+            self._committer.commit_soon().addErrback(log.err)
+
+    def get_stats(self):
+        return {"memories": len(self._pending),
+                "entries": sum([p[0] for p in self._pending.values()]),
+                "bytes": sum([p[1] for p in self._pending.values()]),
+                "appends": self.appends,
+                "compactions": self.compactions,
+                }
@@ -0,0 +1,68 @@
+from collections import OrderedDict
+from nacl import crypto_box_beforenm, crypto_box_afternm, \
+     crypto_box_open_afternm, crypto_box_PUBLICKEYBYTES
+from . import util
+
+# crypto_box(msg, nonce, pk, sk) does a Curve25519 scalar multiplication
+# (to derive the shared key) on every call. The shared key only depends upon
+# the two keypairs, so we compute it once per peer with crypto_box_beforenm,
+# then use the cheap crypto_box_afternm/crypto_box_open_afternm for each
+# message. We also remember the peer's decoded (binary) pubkey, so we don't
+# have to base32-decode their vatid every time. The cache is bounded, and
+# evicts the least-recently-used peer.
+
+class SharedKeyCache:
+    def __init__(self, privkey, max_entries=1000):
+        self._privkey = privkey
+        self.max_entries = max_entries
+        self._entries = OrderedDict() # vatid -> (pubkey, shared_key)
+        self._vatids = {} # pubkey -> vatid, for everything in _entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _get(self, vatid):
+        if vatid in self._entries:
+            self.hits += 1
+            entry = self._entries.pop(vatid)
+        else:
+            self.misses += 1
+            pubkey = util.from_ascii(vatid, "pk0-", encoding="base32")
+            assert len(pubkey) == crypto_box_PUBLICKEYBYTES
+            entry = (pubkey, crypto_box_beforenm(pubkey, self._privkey))
+            while len(self._entries) >= self.max_entries:
+                old_vatid, (old_pubkey, _) = self._entries.popitem(False)
+                del self._vatids[old_pubkey]
+                self.evictions += 1
+            self._vatids[pubkey] = vatid
+        self._entries[vatid] = entry # most-recently-used goes last
+        return entry
+
+    def get_vatid(self, pubkey):
+        # binary-format messages carry the binary pubkey, so this is the
+        # reverse mapping. It doesn't count as a hit or a miss: the box/open
+        # that follows will do that.
+        if pubkey in self._vatids:
+            return self._vatids[pubkey]
+        assert len(pubkey) == crypto_box_PUBLICKEYBYTES
+        return util.to_ascii(pubkey, "pk0-", encoding="base32")
+
+    def get_pubkey(self, vatid):
+        return self._get(vatid)[0]
+
+    def get_shared_key(self, vatid):
+        return self._get(vatid)[1]
+
+    def box(self, vatid, msg, nonce):
+        return crypto_box_afternm(msg, nonce, self.get_shared_key(vatid))
+
+    def open(self, vatid, encbody, nonce):
+        return crypto_box_open_afternm(encbody, nonce,
+                                       self.get_shared_key(vatid))
+
+    def get_stats(self):
+        return {"entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                }
@@ -1,36 +1,178 @@
-
 import json
 from . import util
+from .serialization import to_db, from_db, to_json
+
+# A Memory's contents are a JSON object. New Memories start out as a single
+# `data_json` string in the `memory` table. The first time a Turn changes
+# one, it is converted to one `memory_keys` row per top-level key (and its
+# `data_json` is set to NULL). After that, Turns load only the keys they
+# touch, and only write back the keys that changed, so an urbject with a
+# large map pays for the entries it uses, not for all of them.
+# get_raw_data() and get_data() still return the whole object, in either
+# representation.
+#
+# In journaled mode (see journal.py), changes are appended to the
+# `memory_journal` table instead: one row per changed key, NULL for a
+# deleted key, so a turn's write is proportional to what it changed. The
+# reads below overlay a Memory's journal rows on its `memory_keys`, and
+# fold_journal() merges them (which the MemoryJournal does for any Memory
+# whose journal has grown too large).
+#
+# Each stored value may be in any format (see serialization.py): the
+# methods here read and write them as packed strings, and get_raw_data()
+# and get_data() convert them to JSON.
 
 def create_memory(db, contents={}):
     return create_raw_memory(db, json.dumps(contents))
 
-def create_raw_memory(db, contents_json):
-    memid = util.makeid("mem0-")
+def create_raw_memory(db, contents_json, commit=True, memid=None):
+    memid = memid or util.makeid("mem0-")
     c = db.cursor()
-    c.execute("INSERT INTO `memory` VALUES (?,?)", (memid, contents_json))
-    db.commit()
+    c.execute("INSERT INTO `memory` VALUES (?,?)",
+              (memid, to_db(contents_json)))
+    if commit:
+        db.commit()
     return memid
 
+def json_key(key):
+    # JSON object keys are strings: json.dumps() turns 1 into "1", etc
+    if isinstance(key, basestring):
+        return key
+    return json.loads(json.dumps({key: None})).keys()[0]
+
 class Memory:
     def __init__(self, db, memid):
         self.db = db
         self.memid = memid
 
-    def get_raw_data(self):
+    def get_blob(self):
+        """Return the single-string contents, or None if they are stored
+        as separate keys."""
         c = self.db.cursor()
         c.execute("SELECT `data_json` FROM `memory` WHERE `memid`=?",
                   (self.memid,))
-        return c.fetchone()[0]
+        return from_db(c.fetchone()[0])
 
-    def get_data(self):
+    def _get_journal(self):
+        c = self.db.cursor()
+        c.execute("SELECT `key`,`value_json` FROM `memory_journal`"
+                  " WHERE `memid`=? ORDER BY `seqnum`", (self.memid,))
+        return [(key, from_db(value_json))
+                for (key, value_json) in c.fetchall()]
+
+    def _get_values(self):
         c = self.db.cursor()
-        c.execute("SELECT `data_json` FROM `memory`"
+        c.execute("SELECT `key`,`value_json` FROM `memory_keys`"
                   " WHERE `memid`=?", (self.memid,))
-        return json.loads(c.fetchone()[0])
+        values = dict([(key, from_db(value_json))
+                       for (key, value_json) in c.fetchall()])
+        for (key, value_json) in self._get_journal():
+            if value_json is None:
+                values.pop(key, None)
+            else:
+                values[key] = value_json
+        return values
+
+    def get_raw_data(self):
+        data_json = self.get_blob()
+        if data_json is not None:
+            return to_json(data_json)
+        # this matches the json.dumps() of the equivalent dict
+        return "{%s}" % ", ".join(["%s: %s" % (json.dumps(key),
+                                               to_json(value_json))
+                                   for (key, value_json)
+                                   in self._get_values().items()])
+
+    def get_data(self):
+        return json.loads(self.get_raw_data())
+
+    def get_keys(self):
+        c = self.db.cursor()
+        c.execute("SELECT `key` FROM `memory_keys` WHERE `memid`=?",
+                  (self.memid,))
+        keys = [key for (key,) in c.fetchall()]
+        journal = self._get_journal()
+        if not journal:
+            return keys
+        keys = set(keys)
+        for (key, value_json) in journal:
+            if value_json is None:
+                keys.discard(key)
+            else:
+                keys.add(key)
+        return list(keys)
+
+    def get_raw_value(self, key):
+        c = self.db.cursor()
+        c.execute("SELECT `value_json` FROM `memory_journal`"
+                  " WHERE `memid`=? AND `key`=?"
+                  " ORDER BY `seqnum` DESC LIMIT 1", (self.memid, key))
+        row = c.fetchone()
+        if not row:
+            c.execute("SELECT `value_json` FROM `memory_keys`"
+                      " WHERE `memid`=? AND `key`=?", (self.memid, key))
+            row = c.fetchone()
+        return from_db(row[0])
 
-    def save(self, packed):
+    def save(self, packed, commit=True):
         c = self.db.cursor()
         c.execute("UPDATE `memory` SET `data_json`=? WHERE `memid`=?",
-                  (packed, self.memid))
-        self.db.commit()
+                  (to_db(packed), self.memid))
+        c.execute("DELETE FROM `memory_keys` WHERE `memid`=?", (self.memid,))
+        c.execute("DELETE FROM `memory_journal` WHERE `memid`=?",
+                  (self.memid,))
+        if commit:
+            self.db.commit()
+
+    def save_keys(self, changed, deleted, commit=True):
+        """Write the given {key: value_json} and delete the given keys. A
+        single-string Memory is converted: 'changed' must hold all of its
+        keys."""
+        # journal rows would hide these changes, so merge them first
+        self.fold_journal()
+        c = self.db.cursor()
+        c.execute("UPDATE `memory` SET `data_json`=NULL WHERE `memid`=?",
+                  (self.memid,))
+        for (key, value_json) in changed.items():
+            c.execute("INSERT OR REPLACE INTO `memory_keys` VALUES (?,?,?)",
+                      (self.memid, json_key(key), to_db(value_json)))
+        for key in deleted:
+            c.execute("DELETE FROM `memory_keys` WHERE `memid`=? AND `key`=?",
+                      (self.memid, json_key(key)))
+        if commit:
+            self.db.commit()
+
+    def append_journal(self, changed, deleted):
+        """Like save_keys(), but append the changes to the journal, without
+        committing. Returns the number of bytes appended."""
+        c = self.db.cursor()
+        c.execute("UPDATE `memory` SET `data_json`=NULL WHERE `memid`=?",
+                  (self.memid,))
+        size = 0
+        for (key, value_json) in changed.items():
+            c.execute("INSERT INTO `memory_journal`"
+                      " (`memid`,`key`,`value_json`) VALUES (?,?,?)",
+                      (self.memid, json_key(key), to_db(value_json)))
+            size += len(value_json)
+        for key in deleted:
+            c.execute("INSERT INTO `memory_journal`"
+                      " (`memid`,`key`,`value_json`) VALUES (?,?,NULL)",
+                      (self.memid, json_key(key)))
+        return size
+
+    def fold_journal(self):
+        """Merge this Memory's journal into its keys, without committing."""
+        journal = self._get_journal()
+        if not journal:
+            return
+        c = self.db.cursor()
+        for (key, value_json) in journal:
+            if value_json is None:
+                c.execute("DELETE FROM `memory_keys`"
+                          " WHERE `memid`=? AND `key`=?", (self.memid, key))
+            else:
+                c.execute("INSERT OR REPLACE INTO `memory_keys`"
+                          " VALUES (?,?,?)",
+                          (self.memid, key, to_db(value_json)))
+        c.execute("DELETE FROM `memory_journal` WHERE `memid`=?",
+                  (self.memid,))
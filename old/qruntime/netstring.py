@@ -7,15 +7,53 @@ class _NetstringParser(NetstringReceiver):
     def stringReceived(self, msg):
         self.messages.append(msg)
 
+class TooLong(ValueError):
+    # data that is too large to accept, as opposed to malformed data
+    pass
+
 def make_netstring(msg):
     assert isinstance(msg, str)
     return "%d:%s," % (len(msg), msg)
 
 def split_netstrings(s):
     p = _NetstringParser()
+    # no netstring can be longer than the string that contains it, and the
+    # default limit (99999) is too small for batched messages
+    p.MAX_LENGTH = max(len(s), 1)
     p.messages = messages = []
     p.makeConnection(_EmptyTransport())
     p.dataReceived(s)
     if p._remainingData:
         raise ValueError("leftover data: %d bytes" % len(p._remainingData))
     return messages
+
+def read_netstrings(f, max_length):
+    """Yield each netstring from the file-like object 'f', one at a time,
+    so the caller never holds more than one of them in memory. Raises
+    ValueError for malformed data, or TooLong (a ValueError) for a netstring
+    that would be longer than max_length."""
+    max_digits = len(str(max_length))
+    while True:
+        digits = ""
+        while True:
+            c = f.read(1)
+            if not c:
+                if digits:
+                    raise ValueError("truncated netstring length")
+                return
+            if c == ":":
+                break
+            if not c.isdigit():
+                raise ValueError("bad netstring length")
+            if len(digits) >= max_digits:
+                raise TooLong("netstring too long")
+            digits += c
+        if not digits:
+            raise ValueError("bad netstring length")
+        length = int(digits)
+        if length > max_length:
+            raise TooLong("netstring too long: %d bytes" % length)
+        data = f.read(length)
+        if len(data) != length or f.read(1) != ",":
+            raise ValueError("truncated netstring")
+        yield data
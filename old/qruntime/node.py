@@ -1,6 +1,7 @@
 from twisted.python import log
 from twisted.application import service
 from . import database, web
+from .serialization import FORMATS
 
 class Node(service.MultiService):
     def __init__(self, basedir, dbfile):
@@ -32,7 +33,19 @@ class Node(service.MultiService):
         from . import server
         pubkey_s = self.get_node_config("pubkey")
         privkey_s = self.get_node_config("privkey")
-        self.server = server.Server(self.db, pubkey_s, privkey_s)
+        max_message_size = self.get_node_config("max_message_size")
+        self.server = server.Server(self.db, pubkey_s, privkey_s,
+                                    max_message_size)
+        self.server.executor.budgets.set_defaults(
+            self.get_node_config("turn_wall_limit"),
+            self.get_node_config("turn_cpu_limit"),
+            self.get_node_config("turn_memory_limit"))
+        value_format = self.get_node_config("value_format")
+        if value_format:
+            self.server.executor.value_format = FORMATS[value_format]
+        workers = self.get_node_config("turn_workers")
+        if workers:
+            self.server.executor.use_workers(workers, self.dbfile)
         self.server.setServiceParent(self)
 
     def init_webport(self):
@@ -0,0 +1,217 @@
+import time
+from twisted.python import log
+from .netstring import make_netstring
+
+# Each peer Vat gets one PeerSender, which owns the outbound queue for that
+# Vat. It is a small state machine: when IDLE, a flush() pulls every pending
+# (unACKed) boxed message out of the database, packs them into a single
+# envelope (a concatenation of netstrings, one per boxed message), and POSTs
+# the envelope to the peer. While that POST is outstanding we are SENDING,
+# and any further flush() requests are merely remembered: when the response
+# (a concatenation of boxed ACKs) arrives, we retire whatever was ACKed and
+# then, if more messages were queued in the meantime, flush again. So a peer
+# with N queued messages costs one HTTP request, not N (or N*N). The outcome
+# of each attempt is reported to the RetryScheduler, which decides when to
+# try again. To keep envelopes below the receiver's size limit, an envelope
+# holds at most MAX_BATCH_SIZE bytes of messages (but always at least one):
+# the rest go out in the next envelope, as soon as this one is ACKed.
+#
+# If the peer has several URLs, each envelope goes to the best one first,
+# and to the others only on failure, or if the best one is slow to answer
+# (see urlhealth.py). The first ACK completes the attempt.
+#
+# Flow control: an envelope carries at most server.max_inflight_messages
+# messages. Each PeerSender also keeps track of how much is queued for its
+# peer. When that reaches server.max_queued_messages or
+# server.max_queued_bytes (the high watermark), the peer is "congested":
+# turns that would send to it are deferred (they raise PeerCongested when
+# they try to commit), until ACKs bring the queue back below half of both
+# limits (the low watermark).
+
+IDLE = "idle"
+SENDING = "sending"
+
+MAX_BATCH_SIZE = 1000*1000
+
+class PeerCongested(Exception):
+    def __init__(self, vatid):
+        Exception.__init__(self, "peer %s is congested" % vatid)
+        self.vatid = vatid
+
+class MessageTooLarge(Exception):
+    def __init__(self, vatid, size):
+        Exception.__init__(self, "message of %d bytes is too large for %s"
+                           % (size, vatid))
+        self.vatid = vatid
+
+class BadVatid(Exception):
+    def __init__(self, vatid):
+        Exception.__init__(self, "%r is not a vatid" % (vatid,))
+        self.vatid = vatid
+
+class PeerSender:
+    def __init__(self, server, vatid):
+        self._server = server
+        self.vatid = vatid
+        self.state = IDLE
+        self._flush_requested = False
+        self._batch_truncated = False
+        self.congested = False
+        self._load_queue_stats()
+
+    def _load_queue_stats(self):
+        c = self._server.db.cursor()
+        c.execute("SELECT COUNT(*), SUM(LENGTH(`message`))"
+                  " FROM `outbound_messages` WHERE `to_vatid`=?",
+                  (self.vatid,))
+        (count, size) = c.fetchone()
+        self.queued_messages = count
+        self.queued_bytes = size or 0
+        self._update_congestion()
+
+    def _update_congestion(self):
+        max_messages = self._server.max_queued_messages
+        max_bytes = self._server.max_queued_bytes
+        if not self.congested:
+            if (self.queued_messages >= max_messages
+                or self.queued_bytes >= max_bytes):
+                self.congested = True
+        elif (self.queued_messages <= max_messages//2
+              and self.queued_bytes <= max_bytes//2):
+            self.congested = False
+            self._server.peer_decongested(self.vatid)
+
+    def message_queued(self, size):
+        self.queued_messages += 1
+        self.queued_bytes += size
+        self._update_congestion()
+
+    def messages_acked(self):
+        self._load_queue_stats()
+
+    def flush(self):
+        if self.state == SENDING:
+            self._flush_requested = True
+            return
+        self._flush_requested = False
+        self._send()
+
+    def _send(self):
+        if not self._has_pending():
+            return
+        c = self._server.db.cursor()
+        c.execute("SELECT DISTINCT `url` FROM `vat_urls`"
+                  " WHERE `vatid` = ?", (self.vatid,))
+        urls = [str(res[0]) for res in c.fetchall()]
+        if not urls:
+            log.msg("warning: sending msg to vatid %s but have no URL"
+                    % self.vatid)
+            self._server.retry.delivery_failed(self.vatid)
+            return
+        # walk the queue rather than fetching all of it: we only need the
+        # first MAX_BATCH_SIZE bytes
+        self._batch_truncated = False
+        msgnums = []
+        pieces = []
+        size = 0
+        rows = self._server.db.cursor()
+        rows.execute("SELECT `msgnum`, `message` FROM `outbound_messages`"
+                     " WHERE `to_vatid`=?"
+                     " ORDER BY `msgnum`"
+                     " LIMIT ?", (self.vatid,
+                                  self._server.max_inflight_messages+1))
+        for (msgnum, boxed) in rows:
+            piece = make_netstring(str(boxed))
+            if (len(pieces) >= self._server.max_inflight_messages
+                or (pieces and size + len(piece) > MAX_BATCH_SIZE)):
+                self._batch_truncated = True
+                break
+            msgnums.append(msgnum)
+            pieces.append(piece)
+            size += len(piece)
+        rows.close()
+        envelope = "".join(pieces)
+        c.execute("UPDATE `outbound_messages` SET `last_sent`=?"
+                  " WHERE `to_vatid`=? AND `msgnum`<=?",
+                  (int(time.time()), self.vatid, msgnums[-1]))
+        self._server.db.commit()
+        self.state = SENDING
+        _HedgedDelivery(self, self._server.url_health.rank(urls), envelope,
+                        msgnums)
+
+    def _has_pending(self):
+        c = self._server.db.cursor()
+        c.execute("SELECT `msgnum` FROM `outbound_messages`"
+                  " WHERE `to_vatid`=? LIMIT 1", (self.vatid,))
+        return bool(c.fetchall())
+
+    def _done(self, succeeded):
+        self.state = IDLE
+        # any ACK resets the retry timer, otherwise we back off
+        if succeeded:
+            self._server.retry.delivery_succeeded(self.vatid,
+                                                  self._has_pending())
+        else:
+            self._server.retry.delivery_failed(self.vatid)
+        if self._flush_requested or (succeeded and self._batch_truncated):
+            self.flush()
+
+class _HedgedDelivery:
+    """Send one envelope to a ranked list of URLs, calling sender._done()
+    exactly once: with True when the first ACK arrives, or with False once
+    every URL has failed."""
+    def __init__(self, sender, urls, envelope, msgnums):
+        self._sender = sender
+        self._server = sender._server
+        self._health = self._server.url_health
+        self._remaining = list(urls)
+        self._envelope = envelope
+        self._msgnums = msgnums
+        self._outstanding = 0
+        self._finished = False
+        self._timer = None
+        self._next()
+
+    def _cancel_timer(self):
+        if self._timer and self._timer.active():
+            self._timer.cancel()
+        self._timer = None
+
+    def _next(self):
+        self._cancel_timer()
+        url = self._remaining.pop(0)
+        self._outstanding += 1
+        started = self._health.clock.seconds()
+        d = self._server.client.post(url, self._envelope)
+        d.addCallback(self._server._outbound_response, self._sender.vatid,
+                      self._msgnums)
+        d.addCallbacks(self._succeeded, self._failed,
+                       callbackArgs=(url, started), errbackArgs=(url,))
+        if self._remaining:
+            self._timer = self._health.clock.callLater(
+                self._health.hedge_delay(url), self._hedge)
+
+    def _hedge(self):
+        self._timer = None
+        self._health.hedges += 1
+        self._next()
+
+    def _succeeded(self, _, url, started):
+        self._outstanding -= 1
+        self._health.succeeded(url, self._health.clock.seconds() - started)
+        if not self._finished:
+            self._finished = True
+            self._cancel_timer()
+            self._sender._done(True)
+
+    def _failed(self, f, url):
+        self._outstanding -= 1
+        self._health.failed(url)
+        self._server._outbound_error(f)
+        if self._finished:
+            return
+        if self._remaining:
+            self._next() # fail over right away
+        elif not self._outstanding:
+            self._finished = True
+            self._sender._done(False)
@@ -1,79 +1,121 @@
 
 import json
+from json.encoder import c_make_encoder, encode_basestring_ascii
 from twisted.python import log
-from .util import makeid
-from .common import InnerReference, NativePower
-
-class _PowerEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, NativePower) and self._power_packing._allow_native:
-            p = self._power_packing
-            name = p._turn.get_swissnum_for_object(obj)
-            return {p._nonce: "native", "swissnum": name}
+from .common import InnerReference, InnerPromise, NativePower, MemoryProxy
+from .serialization import (JSON, BINARY, PowerRef, binary_encoder,
+                            decode_binary, get_format, from_db, to_template,
+                            json_loads)
+
+# Packing turns inner objects (InnerReference, InnerPromise, and for powers
+# NativePower) into {"__power__": TYPE, "swissnum": ..} dicts, in a single
+# json encoding pass: the encoder's default() hook emits each marker
+# directly. Inner code must not be able to forge a marker by submitting a
+# dict with a "__power__" key of its own, but the C encoder has no per-key
+# hook. Instead, we count the markers we emitted: any other "__power__"
+# key in the output shows up as an extra '"__power__": ' (a raw quote can't
+# appear inside an encoded string, so this can only be a key), and a single
+# str.count() finds it. When the data holds no inner objects at all,
+# default() is never called, and packing costs exactly as much as
+# json.dumps() plus that count. Each Turn keeps its _Packers (with and
+# without NativePowers, per format) in turn.packers, so nothing is built
+# per call. Most packing is of small values (one Memory key at a time, or
+# args), so the _Packer calls the C encoder directly, rather than paying
+# for JSONEncoder.encode() to build a new one each time.
+#
+# Memories and powers are packed in the Turn's value_format (see
+# serialization.py). The BINARY format has its own type for powers, so it
+# needs no markers and no count. Args are always JSON, since another vat
+# reads them. Unpacking reads any format.
+
+POWER_KEY = '"__power__": ' # as written by the default separators
+
+class _Packer:
+    def __init__(self, turn, allow_native, value_format=JSON):
+        self._turn = turn
+        self._allow_native = allow_native
+        self._format = value_format
+        if value_format == BINARY:
+            self._binary_encoder = binary_encoder(self._replace)
+        self._markers = 0
+        self._encoder = json.JSONEncoder(default=self._default)
+        self._c_encoder = None
+        if c_make_encoder:
+            # the same arguments that JSONEncoder.iterencode() would use
+            self._circular = {} # id -> obj, while encoding
+            self._c_encoder = c_make_encoder(self._circular, self._default,
+                                             encode_basestring_ascii, None,
+                                             ": ", ", ", False, False, True)
+
+    def _replace(self, obj):
+        # returns a PowerRef, or plain data to encode instead of 'obj'
         if isinstance(obj, InnerReference):
-            p = self._power_packing
-            refid = p._turn.get_swissnum_for_object(obj)
-            return {p._nonce: "reference", "swissnum": refid}
-        return json.JSONEncoder.default(self, obj)
-    def _iterencode_dict(self, dct, markers=None):
-        # prevent dicts with keys named "__power__". The nonce-based defense
-        # we have here is driven by Javascript's JSON.stringify which makes
-        # it easy to prohibit specific key names. In python, we could do this
-        # by overriding _iterencode_dict. There's not a lot of point, though,
-        # since python code is unconfined anyways (they could just
-        # monkeypatch us to remove this check, etc).
-        if "__power__" in dct:
+            ptype = "reference"
+        elif isinstance(obj, InnerPromise):
+            ptype = "promise"
+        elif isinstance(obj, NativePower) and self._allow_native:
+            ptype = "native"
+        elif isinstance(obj, MemoryProxy):
+            # a Memory that isn't shared (see Turn.put_memory) is copied
+            return dict(obj)
+        elif isinstance(obj, PowerRef):
+            return obj # see pack_power()
+        else:
+            return json.JSONEncoder.default(self._encoder, obj) # raises
+        return PowerRef(ptype, self._turn.get_swissnum_for_object(obj))
+
+    def _default(self, obj):
+        replacement = self._replace(obj)
+        if isinstance(replacement, PowerRef):
+            self._markers += 1
+            return {"__power__": replacement.ptype,
+                    "swissnum": replacement.swissnum}
+        return replacement
+
+    def pack(self, value):
+        if self._format == BINARY:
+            return self._binary_encoder(value)
+        self._markers = 0
+        if self._c_encoder:
+            self._circular.clear() # in case the last one raised
+            packed = "".join(self._c_encoder(value, 0))
+        else:
+            packed = self._encoder.encode(value)
+        if packed.count(POWER_KEY) != self._markers:
             raise ValueError("forbidden __power__ in serializing data")
-        return json.JSONEncoder._iterencode_dict(self, dct, markers)
+        return packed
 
-class _Packing:
-    def __init__(self, turn, allow_native, allow_memory):
-        self._turn = turn
-        self._allow_native = allow_native
-        self._allow_memory = allow_memory
-        # we translate _nonce into "__power__" when we're done, and otherwise
-        # prohibit "__power__" as a property name. This prevents inner code
-        # from turning swissnums into references by submitting tricky data
-        # for serialization.
-        self._nonce = "__power_%s__" % makeid()
-        self._enc = _PowerEncoder()
-        self._enc._power_packing = self
-
-    def _build_fake_memory(self, old_memory):
-        memid = self._turn.put_memory(old_memory)
-        return {self._nonce: "memory", "swissnum": memid}
-
-    def _pack(self, child_power):
-        if self._allow_memory:
-            # we handle a top-level Memory object by pretending that the
-            # original data contains a {__power__:memory} dict. We must
-            # modify a copy, not the original.
-            child_power, old_child_power = {}, child_power
-            for k in old_child_power: # shallow copy
-                if k == "memory":
-                    old_memory = old_child_power[k]
-                    if old_memory is not None:
-                        child_power[k] = self._build_fake_memory(old_memory)
-                else:
-                    child_power[k] = old_child_power[k]
-
-        return self._enc.encode(child_power).replace(self._nonce, "__power__")
+def _get_packer(turn, allow_native, value_format=JSON):
+    key = (allow_native, value_format)
+    if key not in turn.packers:
+        turn.packers[key] = _Packer(turn, allow_native, value_format)
+    return turn.packers[key]
 
 def pack_power(turn, child_power):
     # updates turn.swissnums, turn.native_powers, and turn.memories . Returns
     # inner_power.
-    p = _Packing(turn, allow_native=True, allow_memory=True)
-    return p._pack(child_power)
+    #
+    # we handle a top-level Memory object by replacing it with a PowerRef,
+    # which packs like any other power. We must modify a copy, not the
+    # original.
+    child_power, old_child_power = {}, child_power
+    for k in old_child_power: # shallow copy
+        if k == "memory":
+            old_memory = old_child_power[k]
+            if old_memory is not None:
+                memid = turn.put_memory(old_memory)
+                child_power[k] = PowerRef("memory", memid)
+        else:
+            child_power[k] = old_child_power[k]
+    return _get_packer(turn, True, turn.value_format).pack(child_power)
 
 def pack_memory(turn, child_power):
     # updates turn.swissnums . Returns data. You need to update turn.memories
-    p = _Packing(turn, allow_native=False, allow_memory=False)
-    return p._pack(child_power)
+    return _get_packer(turn, False, turn.value_format).pack(child_power)
 
 def pack_args(turn, child_power):
     # updates turn.swissnums . Returns inner_power.
-    p = _Packing(turn, allow_native=False, allow_memory=False)
-    return p._pack(child_power)
+    return _get_packer(turn, False).pack(child_power)
 
 class Unpacking:
     def __init__(self, turn, allow_native, allow_memory):
@@ -81,31 +123,50 @@ class Unpacking:
         self._allow_native = allow_native
         self._allow_memory = allow_memory
 
-    def unpack(self, power_json):
+    def _hook(self, dct):
+        if "__power__" not in dct:
+            return dct
+        ptype = dct["__power__"]
+        if ptype == "native" and self._allow_native:
+            name = dct["swissnum"]
+            return self.turn.get_native_power(name)
+        if ptype == "memory":
+            if not self._allow_memory:
+                raise ValueError("only one Memory per Power")
+            self._allow_memory = False
+            memid = dct["swissnum"]
+            return self.turn.get_memory(memid) # data
+        if ptype == "reference":
+            refid = tuple(dct["swissnum"])
+            return self.turn.get_reference(refid) # InnerReference
+        if ptype == "promise":
+            refid = tuple(dct["swissnum"])
+            return self.turn.get_promise(refid) # InnerPromise
+        raise ValueError("unknown power type '%s'" % (ptype,))
+
+    def unpack(self, packed):
         # create the inner object. Adds anything necessary to the Turn
-        def hook(dct):
-            if "__power__" not in dct:
-                return dct
-            ptype = dct["__power__"]
-            if ptype == "native" and self._allow_native:
-                name = dct["swissnum"]
-                return self.turn.get_native_power(name)
-            if ptype == "memory":
-                if not self._allow_memory:
-                    raise ValueError("only one Memory per Power")
-                self._allow_memory = False
-                memid = dct["swissnum"]
-                return self.turn.get_memory(memid) # data
-            if ptype == "reference":
-                refid = tuple(dct["swissnum"])
-                return self.turn.get_reference(refid) # InnerReference
-            raise ValueError("unknown power type '%s'" % (ptype,))
+        packed = from_db(packed)
         try:
-            unpacked = json.loads(power_json, object_hook=hook)
+            if get_format(packed) == BINARY:
+                # its only maps with "__power__" are powers
+                return decode_binary(packed, self._hook)
+            return json_loads(packed, object_hook=self._hook)
         except:
-            log.msg("unpack_power exception, power_json='%s'" % power_json)
+            log.msg("unpack_power exception, packed=%r" % (packed,))
             raise
-        return unpacked
+
+    def rebind(self, template):
+        # same as unpack(json.dumps(template)), without the JSON: 'template'
+        # is the plain json.loads() of a power_json (or to_template() of any
+        # packed value), and is not modified.
+        # Like the object_hook, we convert children before their parents.
+        if isinstance(template, dict):
+            return self._hook(dict([(k, self.rebind(v))
+                                    for (k, v) in template.iteritems()]))
+        if isinstance(template, list):
+            return [self.rebind(v) for v in template]
+        return template
 
 def unpack_power(turn, power_json):
     # updates turn.swissnums, turn.native_powers, and turn.memories . Returns
@@ -113,6 +174,11 @@ def unpack_power(turn, power_json):
     up = Unpacking(turn, allow_native=True, allow_memory=True)
     return up.unpack(power_json)
 
+def rebind_power(turn, template):
+    # like unpack_power(), but from a cached template (see records.py)
+    up = Unpacking(turn, allow_native=True, allow_memory=True)
+    return up.rebind(template)
+
 def unpack_memory(turn, power_json):
     # updates turn.swissnums . Returns data. You need to update turn.memories
     up = Unpacking(turn, allow_native=False, allow_memory=False)
@@ -123,18 +189,29 @@ def unpack_args(turn, power_json):
     up = Unpacking(turn, allow_native=False, allow_memory=False)
     return up.unpack(power_json)
 
+def rebind_args(turn, template):
+    # like unpack_args(), for the "args" of a message (see serialization.py)
+    up = Unpacking(turn, allow_native=False, allow_memory=False)
+    return up.rebind(template)
+
 
-def list_authorities(power_json, is_args):
+def list_authorities(packed, is_args):
     authorities = set()
-    def hook(dct):
-        power_type = dct.get("__power__")
-        if power_type is not None:
+    def walk(value):
+        if isinstance(value, dict):
+            power_type = value.get("__power__")
+            if power_type is None:
+                for v in value.values():
+                    walk(v)
+                return
             if power_type in ("native", "memory") and is_args:
                 raise ValueError("bad power type in args '%s'" % (power_type,))
-            swissnum = dct["swissnum"]
+            swissnum = value["swissnum"]
             if isinstance(swissnum, list): # refid
                 swissnum = tuple(swissnum)
             authorities.add( (power_type, swissnum) )
-        return dct
-    json.loads(power_json, object_hook=hook) # results ignored
+        elif isinstance(value, list):
+            for v in value:
+                walk(v)
+    walk(to_template(packed))
     return authorities
@@ -0,0 +1,218 @@
+import json
+from twisted.python import log
+from .serialization import dumps_message
+from .outbound import BadVatid
+
+# ref.send(args) is like ref.sendOnly(args), but returns an InnerPromise for
+# the result: whatever the target's call() returns. The sending Turn picks
+# the promid, records the promise (as 'unresolved') in its `promises`
+# table, and adds "result": promid and "reply_to": its own vatid to the
+# invoke message. The vat that runs that invocation (the decider) resolves
+# the promise when the turn finishes: "fulfilled" with the packed return
+# value, or "broken" (with a description of the problem) if the turn went
+# over its budget or raised an exception. It records the resolution in its
+# own `promises` table, and tells the sending vat with a "resolved"
+# message.
+#
+# Messages can be sent to a promise before it is resolved (promise
+# pipelining): promise.send(args) sends a "send_promise" message to the
+# decider, which is already (or soon will be) holding the resolution. So a
+# chain like ref.send(a).send(b).send(c) goes to a remote vat as three
+# messages in one envelope, instead of costing a round trip per step. The
+# decider forwards each one to whatever the promise resolved to: a
+# reference is invoked (with the same result promise), and a promise is
+# sent to in turn. Messages that arrive before the promise is resolved are
+# kept in `promise_messages` until it is. The decider records each promise
+# when the invoke that carries it arrives, so a promid it has never heard
+# of is either early (its invoke is still on the way) or bogus: at most
+# MAX_UNKNOWN_MESSAGES of those wait, and the rest are rejected, breaking
+# their result promises. A promise that resolved to plain data can't
+# receive messages, so their result promises are broken too.
+#
+# Once the sending vat knows that a promise resolved to a reference, its
+# later sends go straight to that reference. Inner code can read the
+# resolution with promise.is_resolved() and promise.get_result(), in a
+# later turn (e.g. after storing the promise in its Memory). Only the
+# sending vat learns the resolution: a promise passed to another vat can
+# still be sent to, but looks unresolved there. Like urbjids, promids are
+# unguessable, so knowing one is the authority to use it. A resolution is
+# only accepted from the promise's decider, though, and only once. And a
+# message that names a promise this vat already knows as its result is
+# refused (see check_result()): otherwise anyone who learned the promid
+# could resolve it.
+
+UNRESOLVED = "unresolved"
+FULFILLED = "fulfilled"
+BROKEN = "broken"
+
+MAX_UNKNOWN_MESSAGES = 1000
+
+def create_promise(db, promid, decider_vatid):
+    c = db.cursor()
+    c.execute("INSERT OR IGNORE INTO `promises` VALUES (?,?,?,NULL)",
+              (promid, decider_vatid, UNRESOLVED))
+
+def get_promise(db, promid):
+    """Return (decider_vatid, state, resolution_json), or None for a promise
+    this vat has never heard of."""
+    c = db.cursor()
+    c.execute("SELECT `decider_vatid`,`state`,`resolution_json`"
+              " FROM `promises` WHERE `promid`=?", (promid,))
+    row = c.fetchone()
+    if not row:
+        return None
+    return tuple(row)
+
+def get_reference(resolution_json):
+    """If the resolution is a reference or a promise, return its
+    (power_type, swissnum). Otherwise return None."""
+    data = json.loads(resolution_json)
+    if (isinstance(data, dict)
+        and data.get("__power__") in ("reference", "promise")):
+        return (data["__power__"], tuple(data["swissnum"]))
+    return None
+
+def check_result(db, promid, vatid, from_vatid):
+    """May a message from from_vatid ask this vat (vatid) to resolve
+    'promid' as its result? Only if the promise is new to us, or if it is
+    one we decide, still unresolved, and the message came from one of our
+    own turns (which recorded it when it sent the message to us)."""
+    promise = get_promise(db, promid)
+    if not promise:
+        return True
+    return (from_vatid == vatid and promise[0] == vatid
+            and promise[1] == UNRESOLVED)
+
+def _set_resolution(db, promid, decider_vatid, state, resolution_json):
+    # returns False if the promise is already resolved, or decided by
+    # someone else
+    c = db.cursor()
+    c.execute("UPDATE `promises` SET `state`=?, `resolution_json`=?"
+              " WHERE `promid`=? AND `decider_vatid`=? AND `state`=?",
+              (state, resolution_json, promid, decider_vatid, UNRESOLVED))
+    if c.rowcount:
+        return True
+    if get_promise(db, promid):
+        return False
+    c.execute("INSERT INTO `promises` VALUES (?,?,?,?)",
+              (promid, decider_vatid, state, resolution_json))
+    return True
+
+def resolved_message(promid, state, resolution_json):
+    return {"command": "resolved",
+            "promid": promid,
+            "state": state,
+            "resolution_json": resolution_json}
+
+def resolve_promise(db, server, promid, reply_to, state, resolution_json):
+    """Record the resolution of a promise that this vat decided, tell the
+    vat that holds it, and forward any messages that were waiting for it.
+    Nothing is committed."""
+    if not _set_resolution(db, promid, server.vatid, state, resolution_json):
+        log.msg("not resolving %s: already resolved, or not ours to decide"
+                % promid)
+        return
+    if reply_to != server.vatid:
+        server.send_message(reply_to, resolved_message(promid, state,
+                                                       resolution_json))
+    c = db.cursor()
+    c.execute("SELECT `message_json` FROM `promise_messages`"
+              " WHERE `promid`=? ORDER BY `seqnum`", (promid,))
+    waiting = [json.loads(message_json) for (message_json,) in c.fetchall()]
+    c.execute("DELETE FROM `promise_messages` WHERE `promid`=?", (promid,))
+    for msg in waiting:
+        deliver_to_promise(db, server, msg)
+
+def deliver_to_promise(db, server, msg):
+    """Handle a send_promise message, for a promise this vat decides."""
+    promid = msg["promid"]
+    promise = get_promise(db, promid)
+    if promise and promise[1] == UNRESOLVED and promise[0] != server.vatid:
+        # we only hold it: the decider is elsewhere
+        server.send_message(promise[0], msg)
+        return
+    if not promise and count_unknown_messages(db) >= MAX_UNKNOWN_MESSAGES:
+        log.msg("rejecting message to unknown promise %s" % promid)
+        if msg.get("result"):
+            problem = json.dumps("unknown promise %s" % promid)
+            resolve_promise(db, server, msg["result"], msg["reply_to"],
+                            BROKEN, problem)
+        return
+    if not promise or promise[1] == UNRESOLVED:
+        c = db.cursor()
+        c.execute("INSERT INTO `promise_messages` (`promid`,`message_json`)"
+                  " VALUES (?,?)", (promid, dumps_message(msg)))
+        return
+    (decider_vatid, state, resolution_json) = promise
+    result = msg.get("result")
+    if state == BROKEN:
+        if result:
+            resolve_promise(db, server, result, msg["reply_to"], BROKEN,
+                            resolution_json)
+        return
+    target = get_reference(resolution_json)
+    if not target:
+        if result:
+            problem = json.dumps("promise %s resolved to data, not a"
+                                 " reference" % promid)
+            resolve_promise(db, server, result, msg["reply_to"], BROKEN,
+                            problem)
+        return
+    (power_type, (target_vatid, target_id)) = target
+    try:
+        server.check_vatid(target_vatid)
+    except BadVatid, e:
+        # the turn that resolved it returned a reference it was given
+        if result:
+            resolve_promise(db, server, result, msg["reply_to"], BROKEN,
+                            json.dumps(str(e)))
+        return
+    forward = dict(msg)
+    if power_type == "reference":
+        del forward["promid"]
+        forward["command"] = "invoke"
+        forward["urbjid"] = target_id
+    else:
+        forward["promid"] = target_id
+    server.send_message(target_vatid, forward)
+
+def count_unknown_messages(db):
+    c = db.cursor()
+    c.execute("SELECT COUNT(*) FROM `promise_messages`"
+              " WHERE `promid` NOT IN (SELECT `promid` FROM `promises`)")
+    return c.fetchone()[0]
+
+def promise_resolved(db, msg, from_vatid):
+    """Handle a resolved message, for a promise this vat holds."""
+    promise = get_promise(db, msg["promid"])
+    if not promise:
+        return # not one of ours
+    if promise[0] != from_vatid:
+        log.msg("ignoring resolution of %s from %s, not its decider"
+                % (msg["promid"], from_vatid))
+        return
+    if not _set_resolution(db, msg["promid"], promise[0], msg["state"],
+                           msg["resolution_json"]):
+        log.msg("ignoring resolution of %s: already resolved"
+                % msg["promid"])
+
+def process_promise_message(db, server, msg, from_vatid):
+    command = str(msg["command"])
+    if command == "send_promise":
+        result = msg.get("result")
+        if result:
+            try:
+                server.check_vatid(msg.get("reply_to"))
+            except BadVatid, e:
+                log.msg("ignoring message from %s: bad reply_to: %s"
+                        % (from_vatid, e))
+                return
+        if result and not check_result(db, result, server.vatid, from_vatid):
+            log.msg("ignoring message from %s: result %s is already in use"
+                    % (from_vatid, result))
+            return
+        deliver_to_promise(db, server, msg)
+    elif command == "resolved":
+        promise_resolved(db, msg, from_vatid)
+    else:
+        raise ValueError("unknown promise command '%s'" % command)
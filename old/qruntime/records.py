@@ -0,0 +1,75 @@
+from collections import OrderedDict
+from .serialization import to_template, from_db
+
+# Urbject records (code and powid) and power records (power_json) are never
+# changed once created, so the ExecutionServer keeps the recently-used ones
+# in RAM across turns. Powers are kept decoded, as the to_template() of
+# their power_json: each Turn rebinds that template to its own
+# InnerReference/NativePower/Memory objects (see pack.rebind_power), so it
+# needs neither SQL nor JSON parsing. Templates are shared between turns and
+# must never be modified.
+#
+# The cache is bounded by the approximate size of its records (the length
+# of their code or power_json), and evicts the least-recently-used ones.
+
+class RecordCache:
+    def __init__(self, db, max_bytes=16*1000*1000):
+        self.db = db
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict() # (kind, id) -> (record, size)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _get(self, key):
+        if key in self._entries:
+            self.hits += 1
+            entry = self._entries.pop(key)
+            self._entries[key] = entry # most-recently-used goes last
+            return entry[0]
+        self.misses += 1
+        return None
+
+    def _add(self, key, record, size):
+        while self._entries and self.size + size > self.max_bytes:
+            (_, (_, old_size)) = self._entries.popitem(last=False)
+            self.size -= old_size
+            self.evictions += 1
+        self._entries[key] = (record, size)
+        self.size += size
+
+    def get_urbject(self, urbjid):
+        """Return (code, powid)."""
+        record = self._get(("urbject", urbjid))
+        if record is None:
+            c = self.db.cursor()
+            c.execute("SELECT `code`,`powid` FROM `urbjects`"
+                      " WHERE `urbjid`=?", (urbjid,))
+            res = c.fetchall()
+            if not res:
+                raise KeyError("unknown urbjid %s" % urbjid)
+            record = tuple(res[0])
+            self._add(("urbject", urbjid), record, len(record[0]))
+        return record
+
+    def get_power_template(self, powid):
+        template = self._get(("power", powid))
+        if template is None:
+            c = self.db.cursor()
+            c.execute("SELECT `power_json` FROM `power` WHERE `powid`=?",
+                      (powid,))
+            results = c.fetchall()
+            assert results, "no powid %s" % powid
+            power_json = from_db(results[0][0])
+            template = to_template(power_json)
+            self._add(("power", powid), template, len(power_json))
+        return template
+
+    def get_stats(self):
+        return {"entries": len(self._entries),
+                "bytes": self.size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                }
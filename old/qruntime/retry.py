@@ -0,0 +1,131 @@
+from twisted.application import service
+from twisted.internet import reactor
+from .eventual import eventually
+
+# This implements the retry schedule described at the top of server.py.
+# Every Vat with pending (unACKed) outbound messages has a row in the
+# `outbound_schedule` table, holding its backoff level (the number of
+# consecutive failed delivery attempts) and the time of its next retry.
+# Since the schedule lives in the DB, a node that was asleep through several
+# retries wakes up doing the slow-poll, not the fast-poll. We arm a single
+# reactor timer, for the earliest next_retry of any Vat, and only attempt
+# delivery to the Vats that are actually due when it fires.
+#
+# Queueing a new message for a Vat makes an immediate attempt, but does not
+# change its schedule. A failed attempt doubles the delay (INITIAL_DELAY,
+# then twice that, etc, up to MAX_DELAY). Any ACK resets the backoff.
+
+INITIAL_DELAY = 5
+MAX_DELAY = 2*60*60
+
+class RetryScheduler(service.Service):
+    def __init__(self, db, deliver, clock=reactor):
+        self.db = db
+        self._deliver = deliver # called with a vatid
+        self._clock = clock
+        self._timer = None
+        self._timer_when = None
+        self._immediate = set() # vatids with an attempt already queued
+
+    def startService(self):
+        service.Service.startService(self)
+        # vats with pending messages but no schedule (i.e. queued by an
+        # older version) get an attempt right away
+        now = self._clock.seconds()
+        c = self.db.cursor()
+        c.execute("SELECT DISTINCT `to_vatid` FROM `outbound_messages`"
+                  " WHERE `to_vatid` NOT IN"
+                  "  (SELECT `to_vatid` FROM `outbound_schedule`)")
+        for (vatid,) in c.fetchall():
+            c.execute("INSERT INTO `outbound_schedule` VALUES (?,?,?)",
+                      (vatid, 0, now))
+        self.db.commit()
+        self.reschedule()
+
+    def stopService(self):
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        return service.Service.stopService(self)
+
+    def get_delay(self, backoff_level):
+        if backoff_level <= 0:
+            return INITIAL_DELAY
+        return min(INITIAL_DELAY * 2**(backoff_level-1), MAX_DELAY)
+
+    def _get_level(self, vatid):
+        c = self.db.cursor()
+        c.execute("SELECT `backoff_level` FROM `outbound_schedule`"
+                  " WHERE `to_vatid`=?", (vatid,))
+        row = c.fetchone()
+        if row:
+            return row[0]
+        return None
+
+    def _set(self, vatid, backoff_level, next_retry):
+        c = self.db.cursor()
+        c.execute("INSERT OR REPLACE INTO `outbound_schedule` VALUES (?,?,?)",
+                  (vatid, backoff_level, next_retry))
+        self.db.commit()
+
+    def message_queued(self, vatid):
+        if self._get_level(vatid) is None:
+            # a safety net, in case the immediate attempt never completes
+            self._set(vatid, 0, self._clock.seconds() + INITIAL_DELAY)
+            self.reschedule()
+        if vatid not in self._immediate:
+            self._immediate.add(vatid)
+            eventually(self._attempt, vatid)
+
+    def _attempt(self, vatid):
+        self._immediate.discard(vatid)
+        self._deliver(vatid)
+
+    def delivery_failed(self, vatid):
+        level = (self._get_level(vatid) or 0) + 1
+        self._set(vatid, level, self._clock.seconds() + self.get_delay(level))
+        self.reschedule()
+
+    def delivery_succeeded(self, vatid, more_pending):
+        if more_pending:
+            self._set(vatid, 0, self._clock.seconds() + INITIAL_DELAY)
+        else:
+            c = self.db.cursor()
+            c.execute("DELETE FROM `outbound_schedule` WHERE `to_vatid`=?",
+                      (vatid,))
+            self.db.commit()
+        self.reschedule()
+
+    def reschedule(self):
+        c = self.db.cursor()
+        c.execute("SELECT MIN(`next_retry`) FROM `outbound_schedule`")
+        when = c.fetchone()[0]
+        if when == self._timer_when and self._timer:
+            return
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        self._timer_when = when
+        if when is None or not self.running:
+            return
+        delay = max(when - self._clock.seconds(), 0)
+        self._timer = self._clock.callLater(delay, self._fire)
+
+    def _fire(self):
+        self._timer = None
+        now = self._clock.seconds()
+        c = self.db.cursor()
+        c.execute("SELECT `to_vatid`,`backoff_level` FROM `outbound_schedule`"
+                  " WHERE `next_retry` <= ?", (now,))
+        due = c.fetchall()
+        # push each one out by its current delay, so a delivery attempt that
+        # never completes doesn't leave us spinning. The outcome of the
+        # attempt will update the schedule.
+        for (vatid, level) in due:
+            c.execute("UPDATE `outbound_schedule` SET `next_retry`=?"
+                      " WHERE `to_vatid`=?", (now + self.get_delay(level),
+                                               vatid))
+        self.db.commit()
+        self.reschedule()
+        for (vatid, level) in due:
+            self._deliver(vatid)
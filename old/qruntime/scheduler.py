@@ -0,0 +1,89 @@
+
+# With a WorkerPool, the ExecutionServer runs several turns at once, as
+# long as they don't touch the same Memories. This is optimistic: before
+# starting a turn we predict its footprint (the memids it will load) from
+# the powers it holds, and hold it back while a running turn's predicted
+# footprint overlaps. The prediction can miss Memories reached through
+# references stored inside a Memory, so when each turn finishes, the
+# ExecutionServer also checks the footprint the worker actually observed
+# against the Memories changed by turns applied since it started (the
+# ConflictTracker below). A turn that conflicts is run again, from the
+# current state, instead of being applied. Messages from each sender are
+# still executed one at a time, in order (see Server.deliver_inbound_messages).
+
+def _walk(template, vatid, memids, urbjids):
+    if isinstance(template, dict):
+        ptype = template.get("__power__")
+        if ptype == "memory":
+            memids.add(template["swissnum"])
+        elif ptype == "reference":
+            (ref_vatid, urbjid) = template["swissnum"]
+            if ref_vatid == vatid:
+                urbjids.add(urbjid)
+        else:
+            for value in template.values():
+                _walk(value, vatid, memids, urbjids)
+    elif isinstance(template, list):
+        for value in template:
+            _walk(value, vatid, memids, urbjids)
+
+def predict_footprint(records, vatid, urbjid, depth=2):
+    """Return the set of memids that a turn of 'urbjid' will probably load:
+    the Memory in its power, and those of the local urbjects its power
+    refers to (which it might call synchronously), up to 'depth' levels."""
+    memids = set()
+    seen = set()
+    frontier = set([urbjid])
+    for level in range(depth+1):
+        next_frontier = set()
+        for urbjid in frontier - seen:
+            seen.add(urbjid)
+            try:
+                (code, powid) = records.get_urbject(urbjid)
+            except KeyError:
+                continue
+            template = records.get_power_template(powid)
+            _walk(template, vatid, memids, next_frontier)
+        frontier = next_frontier
+    return memids
+
+class ConflictTracker:
+    """Remember which Memories each applied turn changed, so a turn that
+    ran concurrently can tell if it saw stale data."""
+    def __init__(self):
+        self.seqnum = 0 # number of turns applied
+        self._changed = {} # memid -> seqnum of the last turn to change it
+        self._running = {} # token -> (start seqnum, predicted footprint)
+        self.conflicts = 0
+
+    def overlaps(self, footprint):
+        for (start, predicted) in self._running.values():
+            if footprint & predicted:
+                return True
+        return False
+
+    def running(self):
+        return len(self._running)
+
+    def start(self, token, footprint):
+        self._running[token] = (self.seqnum, footprint)
+
+    def conflicted(self, token, observed):
+        """Did any turn applied since 'token' started change a Memory in its
+        observed footprint?"""
+        (start, predicted) = self._running[token]
+        for memid in observed:
+            if self._changed.get(memid, -1) > start:
+                self.conflicts += 1
+                return True
+        return False
+
+    def applied(self, changed_memids):
+        self.seqnum += 1
+        for memid in changed_memids:
+            self._changed[memid] = self.seqnum
+
+    def finished(self, token):
+        del self._running[token]
+        if not self._running:
+            self._changed.clear() # nobody left who could conflict
@@ -30,7 +30,8 @@ def gossip(so, out, err):
         sqlite, db = database.get_db(dbfile, err)
         c = db.cursor()
         for vatid,url in vatids_and_urls:
-            c.execute("INSERT INTO `vat_urls` VALUES (?,?)", (vatid, url))
+            c.execute("INSERT OR IGNORE INTO `vat_urls` VALUES (?,?)",
+                      (vatid, url))
         db.commit()
         print "%s updated" % basedir
 
@@ -1,6 +1,7 @@
 
 import os, json
 from .. import memory, urbject, database, util
+from ..serialization import to_json
 
 def get_db(so, err, basedir=None):
     if basedir is None:
@@ -45,10 +46,11 @@ def list_memory(so, out, err):
     if not db:
         return 1
     c = db.cursor()
-    c.execute("SELECT `memid`,`data_json` FROM `memory`")
+    c.execute("SELECT `memid` FROM `memory`")
     mems = c.fetchall()
     print >>out, "memid: size"
-    for (memid, data_json) in sorted(mems):
+    for (memid,) in sorted(mems):
+        data_json = memory.Memory(db, memid).get_raw_data()
         print >>out, "%s: %d" % (memid, len(data_json))
     print >>out, "%d memory slots total" % len(mems)
     return 0
@@ -59,12 +61,12 @@ def dump_memory(so, out, err):
         return 1
     memid = so["memid"]
     c = db.cursor()
-    c.execute("SELECT `data_json` FROM `memory` WHERE `memid`=?", (memid,))
+    c.execute("SELECT `memid` FROM `memory` WHERE `memid`=?", (memid,))
     mems = c.fetchall()
     if not mems:
         print >>out, "memid not found"
         return 0
-    (data_json,) = mems[0]
+    data_json = memory.Memory(db, memid).get_raw_data()
     print >>out, "DATA:", data_json.strip()
     return 0
 
@@ -118,7 +120,7 @@ def dump_urbject(so, out, err):
     print >>out, "power:", powid
     c.execute("SELECT `power_json` FROM `power` WHERE `powid`=?", (powid,))
     (power_json,) = c.fetchone()
-    print >>out, "POWER:", power_json.strip()
+    print >>out, "POWER:", to_json(power_json).strip()
     print >>out, "CODE:"
     print >>out, code.strip()
     return 0
@@ -0,0 +1,351 @@
+import json, struct, base64, sqlite3, codecs
+
+# Packed values (Memory contents, powers, args, and promise resolutions) can
+# be stored in more than one format. The format is recorded in the value
+# itself, so every row (or message) says how to read it, and a vat can
+# switch formats without converting anything:
+#
+#  JSON: JSON text, with {"__power__": TYPE, "swissnum": ..} markers for
+#        powers (see pack.py). This is untagged: every value written before
+#        formats existed is JSON, and so is anything sent to another vat.
+#  BINARY: a compact binary encoding, tagged by a first byte of 1. It has
+#        its own type for powers, so they need no marker dicts (and inner
+#        data can't forge one), and it writes no quotes, separators, or
+#        escapes, so values are about a third smaller. Stored as a BLOB.
+#        It is pure Python, so it costs more CPU than the C json module:
+#        compare them with 'python -m qruntime.bench codec'.
+#
+# A tag is a first byte below 0x20. JSON text can start with one of those
+# too (tab, newline, or carriage return, as whitespace), so only the tags
+# in TAGS count, and anything else is JSON. New formats get new tags, which
+# must never be reused for something else.
+# The vat's `value_format` (in the node config) chooses the format for the
+# Memories and powers that its turns write. Existing values are rewritten
+# in that format when a turn loads and writes back their Memory (see
+# same_packed()). Args and promise resolutions are always JSON, since
+# another vat has to read them.
+#
+# JSON is decoded with simplejson, when it is installed with its C
+# speedups, since that is usually faster than the stdlib json module (it
+# may return ASCII strings as str rather than unicode, which compare equal).
+# Encoding uses the stdlib C encoder directly (see pack.py).
+
+JSON = 0
+BINARY = 1
+
+FORMATS = {"json": JSON, "binary": BINARY}
+TAGS = set([chr(BINARY)])
+
+try:
+    import simplejson
+    simplejson._speedups # only faster with these
+    json_loads = simplejson.loads
+    JSON_BACKEND = "simplejson"
+except (ImportError, AttributeError):
+    json_loads = json.loads
+    JSON_BACKEND = "json"
+
+def get_format(data):
+    if data and data[0] in TAGS:
+        return ord(data[0])
+    return JSON
+
+class PowerRef(object):
+    """A power to be packed, as (type, swissnum)."""
+    __slots__ = ["ptype", "swissnum"]
+    def __init__(self, ptype, swissnum):
+        self.ptype = ptype
+        self.swissnum = swissnum
+
+# the BINARY format: a tag byte, then one value, where each value is a type
+# byte followed by its contents. Counts, lengths, and (zigzag-encoded)
+# integers are varints. Strings are UTF-8, and come back as unicode, like
+# JSON. Map keys are strings, converted the way json.dumps() does.
+
+_NONE, _TRUE, _FALSE = "N", "T", "F"
+_INT = "I" # varint
+_FLOAT = "D" # 8-byte big-endian double
+_STRING = "S" # length, bytes
+_LIST = "L" # count, values
+_MAP = "M" # count, (length, key bytes, value)*
+_POWER = "P" # length, type bytes, swissnum value
+
+_double = struct.Struct(">d")
+_encode_utf8 = codecs.utf_8_encode # faster than .encode("utf-8")
+
+# most lengths, counts, and integers fit in one varint byte, so these are
+# precomputed, with and without the type byte
+_BYTE = [chr(n) for n in range(0x80)]
+_SHORT_STRING = [_STRING + c for c in _BYTE]
+_SHORT_LIST = [_LIST + c for c in _BYTE]
+_SHORT_MAP = [_MAP + c for c in _BYTE]
+_SHORT_INT = [_INT + c for c in _BYTE]
+
+def _varint(n):
+    out = []
+    while n > 0x7f:
+        out.append(chr(0x80 | (n & 0x7f)))
+        n >>= 7
+    out.append(chr(n))
+    return "".join(out)
+
+def _utf8(s):
+    if isinstance(s, unicode):
+        return s.encode("utf-8")
+    s.decode("utf-8") # like json.dumps(), reject bad str
+    return s
+
+def _key(key):
+    if isinstance(key, basestring):
+        return _utf8(key)
+    if isinstance(key, bool) or key is None or isinstance(key, (int, long,
+                                                                  float)):
+        return json.dumps(key)
+    raise TypeError("key %r is not a string" % (key,))
+
+def binary_encoder(default):
+    """Return a function that encodes a value in the BINARY format, for
+    encoding many values. default(obj) is called for anything else (like
+    json's default=), and returns a replacement, or a PowerRef."""
+    containers = set() # ids, to detect cycles
+    strs = [] # str values, checked together at the end
+    keys = {} # string key -> bytes: most Memories repeat their keys
+
+    def encode(value, append):
+        t = type(value)
+        if t is unicode or t is str:
+            if t is unicode:
+                s = _encode_utf8(value)[0]
+            else:
+                s = value
+                strs.append(s)
+            n = len(s)
+            append(_SHORT_STRING[n] if n < 0x80 else _STRING + _varint(n))
+            append(s)
+        elif t is dict:
+            if id(value) in containers:
+                raise ValueError("Circular reference detected")
+            containers.add(id(value))
+            n = len(value)
+            append(_SHORT_MAP[n] if n < 0x80 else _MAP + _varint(n))
+            for (key, v) in value.iteritems():
+                k = keys.get(key) if isinstance(key, basestring) else None
+                if k is None:
+                    k = _key(key)
+                    if k == "__power__":
+                        raise ValueError("forbidden __power__ in"
+                                         " serializing data")
+                    if isinstance(key, basestring):
+                        keys[key] = k
+                n = len(k)
+                append(_BYTE[n] if n < 0x80 else _varint(n))
+                append(k)
+                encode(v, append)
+            containers.remove(id(value))
+        elif t is list or t is tuple:
+            if id(value) in containers:
+                raise ValueError("Circular reference detected")
+            containers.add(id(value))
+            n = len(value)
+            append(_SHORT_LIST[n] if n < 0x80 else _LIST + _varint(n))
+            for v in value:
+                encode(v, append)
+            containers.remove(id(value))
+        elif value is None:
+            append(_NONE)
+        elif value is True:
+            append(_TRUE)
+        elif value is False:
+            append(_FALSE)
+        elif t is int or t is long:
+            n = (value << 1) if value >= 0 else ((-value << 1) - 1) # zigzag
+            append(_SHORT_INT[n] if n < 0x80 else _INT + _varint(n))
+        elif t is float:
+            append(_FLOAT)
+            append(_double.pack(value))
+        elif t is PowerRef:
+            p = _utf8(value.ptype)
+            append(_POWER)
+            append(_varint(len(p)))
+            append(p)
+            encode(value.swissnum, append)
+        else:
+            # subclasses are encoded as their base type, like json does
+            if id(value) in containers:
+                raise ValueError("Circular reference detected")
+            containers.add(id(value))
+            for base in (dict, list, tuple, unicode, str, int, long, float):
+                if isinstance(value, base):
+                    replacement = base(value)
+                    break
+            else:
+                replacement = default(value)
+            encode(replacement, append)
+            containers.remove(id(value))
+
+    def encode_value(value):
+        containers.clear() # in case the last one raised
+        del strs[:]
+        if len(keys) > 10000:
+            keys.clear()
+        out = [chr(BINARY)]
+        encode(value, out.append)
+        # like json.dumps(), reject bad str. The newlines keep the pieces
+        # of a multi-byte sequence from being split across two of them.
+        unicode("\n".join(strs), "utf-8")
+        return "".join(out)
+    return encode_value
+
+def encode_binary(value, default):
+    """Encode one value in the BINARY format (see binary_encoder)."""
+    return binary_encoder(default)(value)
+
+def decode_binary(data, power_hook=None):
+    """Decode a BINARY value. Powers become marker dicts, or whatever
+    power_hook(marker) returns."""
+    keys = {} # key bytes -> unicode: most Memories repeat their keys
+
+    def varint(offset):
+        n = shift = 0
+        while True:
+            b = ord(data[offset])
+            offset += 1
+            n |= (b & 0x7f) << shift
+            if b < 0x80:
+                return (n, offset)
+            shift += 7
+
+    def length(offset):
+        # a varint, usually one byte
+        n = ord(data[offset])
+        if n < 0x80:
+            return (n, offset+1)
+        return varint(offset)
+
+    def decode(offset):
+        t = data[offset]
+        if t == _STRING:
+            n = ord(data[offset+1])
+            if n < 0x80:
+                offset += 2
+            else:
+                (n, offset) = varint(offset+1)
+            end = offset + n
+            if end > len(data):
+                raise ValueError("truncated value")
+            return (unicode(data[offset:end], "utf-8"), end)
+        if t == _MAP:
+            (count, offset) = length(offset+1)
+            value = {}
+            for i in xrange(count):
+                n = ord(data[offset])
+                if n < 0x80:
+                    offset += 1
+                else:
+                    (n, offset) = varint(offset)
+                k = data[offset:offset+n]
+                key = keys.get(k)
+                if key is None:
+                    key = keys[k] = unicode(k, "utf-8")
+                (value[key], offset) = decode(offset+n)
+            return (value, offset)
+        if t == _INT:
+            (n, offset) = length(offset+1)
+            return ((n >> 1) if not n & 1 else -((n + 1) >> 1), offset)
+        if t == _LIST:
+            (count, offset) = length(offset+1)
+            value = []
+            append = value.append
+            for i in xrange(count):
+                (v, offset) = decode(offset)
+                append(v)
+            return (value, offset)
+        if t == _FLOAT:
+            return (_double.unpack_from(data, offset+1)[0], offset + 9)
+        if t == _NONE:
+            return (None, offset+1)
+        if t == _TRUE:
+            return (True, offset+1)
+        if t == _FALSE:
+            return (False, offset+1)
+        if t == _POWER:
+            (n, offset) = length(offset+1)
+            ptype = unicode(data[offset:offset+n], "utf-8")
+            (swissnum, offset) = decode(offset+n)
+            marker = {"__power__": ptype, "swissnum": swissnum}
+            if power_hook:
+                return (power_hook(marker), offset)
+            return (marker, offset)
+        raise ValueError("unknown type %r" % (t,))
+
+    try:
+        (value, offset) = decode(1)
+    except (IndexError, struct.error):
+        raise ValueError("truncated value")
+    if offset != len(data):
+        raise ValueError("trailing data")
+    return value
+
+# These work on any packed value
+
+def to_template(data):
+    """Decode a packed value into plain data, with powers as marker dicts
+    (what json.loads() returns for JSON)."""
+    data = from_db(data)
+    fmt = get_format(data)
+    if fmt == JSON:
+        return json_loads(data)
+    if fmt == BINARY:
+        return decode_binary(data)
+    raise ValueError("unknown value format %d" % fmt)
+
+def to_json(data):
+    """Return a packed value as JSON text."""
+    data = from_db(data)
+    if get_format(data) == JSON:
+        return data
+    return json.dumps(to_template(data))
+
+def same_packed(a, b):
+    # a value stored in another format counts as changed, so it is
+    # rewritten in the current one (and a BINARY str is never compared to
+    # the unicode that sqlite returns for JSON text)
+    return get_format(a) == get_format(b) and a == b
+
+def to_db(data):
+    # tagged values aren't text, so sqlite must store them as BLOBs
+    if get_format(data) != JSON:
+        return sqlite3.Binary(data)
+    return data
+
+def from_db(value):
+    if isinstance(value, buffer):
+        return str(value)
+    return value
+
+def to_text(data):
+    # for carrying packed values inside JSON (e.g. from a worker):
+    # JSON text never starts with "="
+    if get_format(data) != JSON:
+        return "=" + base64.b64encode(data)
+    return data
+
+def from_text(text):
+    if text.startswith("="):
+        return base64.b64decode(text[1:])
+    return text
+
+# Messages are JSON. A Turn's messages carry their args as packed JSON
+# ('args_json'), which dumps_message() splices in as a nested "args"
+# object, rather than encoding that string a second time. Messages read
+# with json.loads() then hold "args" as plain data (like to_template()), so
+# the args are never parsed twice either.
+
+def dumps_message(msg):
+    if "args_json" not in msg:
+        return json.dumps(msg)
+    msg = dict(msg)
+    args_json = msg.pop("args_json")
+    body = json.dumps(msg)
+    assert body.endswith("}") and len(body) > 2, body
+    return '%s, "args": %s}' % (body[:-1], args_json)
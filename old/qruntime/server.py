@@ -1,14 +1,25 @@
-import base64, time, json
+import time, json
+import sqlite3
+from StringIO import StringIO
+from collections import deque
+from itertools import islice
 from binascii import hexlify, unhexlify
 
 from twisted.application import service
-from twisted.web.client import getPage
-from twisted.python import log
-from nacl import crypto_box, crypto_box_open, \
-     crypto_box_NONCEBYTES, crypto_box_PUBLICKEYBYTES
-from . import util
+from twisted.internet import defer
+from twisted.python import log, failure
+from nacl import crypto_box_NONCEBYTES, crypto_box_PUBLICKEYBYTES
+from . import util, compression
 from .eventual import eventually
 from .executor import ExecutionServer
+from .netstring import (make_netstring, split_netstrings, read_netstrings,
+                        TooLong)
+from .outbound import PeerSender, PeerCongested, MessageTooLarge, BadVatid
+from .httpclient import DeliveryClient
+from .urlhealth import URLHealth
+from .retry import RetryScheduler
+from .keycache import SharedKeyCache
+from .groupcommit import GroupCommitter
 
 
 # resending messages: we use Waterken's "retry-forever" style. Ideally, we'd
@@ -23,7 +34,8 @@ from .executor import ExecutionServer
 # for each VatID that has pending messages, takes the minimum of those times,
 # then sets a timer to wake up at that point. Maybe the whole retry schedule
 # should be put in the DB, so if this server sleeps through the attempts, it
-# wakes up doing the slow-poll instead of the fast-poll.
+# wakes up doing the slow-poll instead of the fast-poll. This schedule is
+# implemented by the RetryScheduler in retry.py .
 
 # also, consider the differences between TCP connection failures and
 # delayed/lost ACKs. We actually care about the ACK. But we need to give them
@@ -35,21 +47,46 @@ from .executor import ExecutionServer
 # forever, but that's their perogative, and resending early to such a vat
 # won't do any good).
 
+# The largest inbound HTTP body (one envelope) we will accept, unless the
+# node config says otherwise. This also bounds each boxed message inside it.
+MAX_MESSAGE_SIZE = 16*1000*1000
+
 class Server(service.MultiService):
-    def __init__(self, db, pubkey_s, privkey_s):
+    def __init__(self, db, pubkey_s, privkey_s, max_message_size=None):
         service.MultiService.__init__(self)
         self.db = db
+        self.max_message_size = max_message_size or MAX_MESSAGE_SIZE
 
         self.vatid = pubkey_s
         self.pubkey = util.from_ascii(pubkey_s, "pk0-", encoding="base32")
         self.privkey_s = privkey_s
         self.privkey = util.from_ascii(privkey_s, "sk0-", encoding="base32")
+        self.keys = SharedKeyCache(self.privkey)
 
         self.inbound_triggered = False
+        self.inbound_running = {} # vatid -> msgnum, in a worker. See below
         self.outbound_triggered = False
+        self.inbound_next_msgnums = {} # vatid -> next_msgnum, see below
+        self.peer_codecs = {} # vatid -> codec names they advertised
+        self.loopback_queue = deque() # (msgnum, msg), see send_loopback
+        self.blocked_senders = {} # from_vatid -> congested vatid
+        self.congested_loopback = {} # congested vatid -> [(msgnum, msg)]
+        self.uncommitted_peers = set() # see queue_message
+        self.inbound_commits = GroupCommitter(self.db,
+                                              self.inbound_commit_window,
+                                              self.inbound_commit_batch)
+        self.senders = {} # vatid -> PeerSender
+        self.client = DeliveryClient()
+        self.url_health = URLHealth()
+        self.client.setServiceParent(self)
+        self.retry = RetryScheduler(self.db,
+                                    self.deliver_outbound_messages_to_vatid)
+        self.retry.setServiceParent(self)
 
         self.executor = ExecutionServer(self.db, self.vatid, self)
         self.executor.setServiceParent(self)
+        self.code_cache = self.executor.code_cache
+        self.journal = self.executor.journal
 
     # nonce management: we need four virtual channels: one pair in each
     # direction. The Request channels deliver boxed request messages
@@ -65,9 +102,94 @@ class Server(service.MultiService):
     # The Request messages are sent in the body of an HTTP request. The
     # Response messages are returned in the HTTP response.
 
+    # Peers deliver a batch of boxed messages in a single HTTP request: the
+    # body is a series of netstrings, each containing one boxed message. A
+    # body which starts with "v0," or "v1" is a single unframed message (from
+    # an older peer), and gets an unframed response.
+    #
+    # The (boxed) response is a JSON-encoded ACK: {ack: N, sack: [M..]},
+    # which means we've safely received every message numbered below N, plus
+    # the listed (out-of-order) messages M. One response covers the whole
+    # batch: it is boxed with the response nonce of the last request we
+    # processed, and the sender can retire everything it acknowledges at
+    # once. Messages from slightly in the future (up to SACK_WINDOW beyond
+    # the next expected one) are held in `inbound_early_messages` until the
+    # gap is filled.
+    #
+    # Accepted messages are not committed one at a time: all the messages
+    # that arrive within inbound_commit_window seconds (or the first
+    # inbound_commit_batch of them) share a single commit. So
+    # inbound_envelope() returns a Deferred, which fires with the response
+    # once the messages it covers are safely on disk.
+    #
+    # Large request bodies are spooled to a temporary file by the web
+    # server, and inbound_stream() reads them from there one boxed message
+    # at a time, storing each before reading the next. So the peak memory
+    # used by an envelope is a small multiple of its largest message, rather
+    # than of the whole envelope. Each message is still decrypted in one
+    # piece, since crypto_box only authenticates the whole ciphertext.
+
+    SACK_WINDOW = 64
+    inbound_commit_window = 0.005
+    inbound_commit_batch = 100
+
+    def startService(self):
+        self.load_loopback_queue()
+        service.MultiService.startService(self)
+        self.trigger_inbound()
+
+    def stopService(self):
+        self.inbound_commits.flush()
+        return service.MultiService.stopService(self)
+
+    def inbound_envelope(self, body):
+        return self.inbound_stream(StringIO(body))
+
+    def inbound_stream(self, f):
+        start = f.tell()
+        prefix = f.read(3)
+        f.seek(start)
+        if prefix == "v0," or prefix.startswith("v1"):
+            body = f.read(self.max_message_size+1)
+            if len(body) > self.max_message_size:
+                raise TooLong("message too large")
+            return self.inbound_message(body)
+        last = None
+        try:
+            for boxed in read_netstrings(f, self.max_message_size):
+                last = self.receive_message(boxed)
+        except:
+            if last is None:
+                # nothing to ACK, so tell the peer why instead
+                raise
+            # the rest of the batch depends upon this one, so stop here and
+            # ACK what we've got so far
+            log.err()
+        if last is None:
+            return defer.succeed("")
+        their_vatid, nonce_number, version = last
+        d = self.inbound_commits.commit_soon()
+        d.addCallback(lambda _: self._accepted())
+        d.addCallback(lambda _: make_netstring(self.make_ack(their_vatid,
+                                                             nonce_number,
+                                                             version)))
+        return d
+
     def inbound_message(self, body):
-        their_vatid, their_pubkey, nonce, encbody = self.parse_message(body)
-        # their_vatid is "pk0-base32..", while their_pubkey is binary
+        their_vatid, nonce_number, version = self.receive_message(body)
+        d = self.inbound_commits.commit_soon()
+        d.addCallback(lambda _: self._accepted())
+        d.addCallback(lambda _: self.make_ack(their_vatid, nonce_number,
+                                              version))
+        return d
+
+    def _accepted(self):
+        # the new messages are safe, so they can be executed
+        self.trigger_inbound()
+
+    def receive_message(self, body):
+        (version, their_vatid, nonce, encbody,
+         codec) = self.parse_message(body)
         assert their_vatid != self.vatid, "go away mirror"
         nonce_number = int(hexlify(nonce), 16)
         if their_vatid < self.vatid:
@@ -75,129 +197,314 @@ class Server(service.MultiService):
         else:
             offset = 0 # I am First, they are Second, msg is Second->First
         assert nonce_number % 4 == offset, "wrong nonce type %d %d" % (nonce_number, offset)
-        msg = crypto_box_open(encbody, nonce, their_pubkey, self.privkey)
-        resp = self.process_message(their_vatid, nonce_number, offset, msg)
+        msg = compression.decompress(codec,
+                                     self.keys.open(their_vatid, encbody,
+                                                    nonce),
+                                     self.max_message_size)
+        self.process_message(their_vatid, nonce_number, offset, msg)
+        return their_vatid, nonce_number, version
+
+    def make_ack(self, their_vatid, nonce_number, version):
+        # we respond in the same format as the request, so older peers can
+        # understand us
+        next_msgnum = self.get_inbound_msgnum(their_vatid)
+        c = self.db.cursor()
+        c.execute("SELECT `msgnum` FROM `inbound_early_messages`"
+                  " WHERE `from_vatid`=?"
+                  " ORDER BY `msgnum`", (their_vatid,))
+        sack = [res[0] for res in c.fetchall()]
+        resp = json.dumps({"ack": next_msgnum, "sack": sack,
+                           "codecs": compression.get_codec_names()})
         r_nonce = self.number_to_nonce(nonce_number+1)
-        return ",".join(["v0",
-                         util.to_ascii(self.pubkey, "pk0-", encoding="base32"),
-                         util.to_ascii(r_nonce, encoding="base32"),
-                         crypto_box(resp, r_nonce, their_pubkey, self.privkey)])
+        return self.build_message(version, their_vatid, r_nonce, resp)
 
     def number_to_nonce(self, number):
         nonce = unhexlify("%048x" % number)
         assert len(nonce) == crypto_box_NONCEBYTES
         return nonce
 
+    def get_inbound_msgnum(self, from_vatid):
+        # inbound_msgnums is only ever changed by this Server, so we keep a
+        # copy of each vat's next_msgnum in RAM instead of asking the DB for
+        # every message. Callers who change it must update both.
+        if from_vatid not in self.inbound_next_msgnums:
+            c = self.db.cursor()
+            c.execute("SELECT next_msgnum FROM inbound_msgnums"
+                      " WHERE from_vatid=? LIMIT 1", (from_vatid,))
+            data = c.fetchall()
+            if data:
+                next_msgnum = data[0][0]
+            else:
+                c.execute("INSERT INTO inbound_msgnums VALUES (?,?)",
+                          (from_vatid, 0))
+                next_msgnum = 0
+            self.inbound_next_msgnums[from_vatid] = next_msgnum
+        return self.inbound_next_msgnums[from_vatid]
+
+    def set_inbound_msgnum(self, from_vatid, next_msgnum):
+        c = self.db.cursor()
+        c.execute("UPDATE `inbound_msgnums`"
+                  " SET `next_msgnum`=?"
+                  " WHERE `from_vatid`=?",
+                  (next_msgnum, from_vatid))
+        self.inbound_next_msgnums[from_vatid] = next_msgnum
+
     def process_message(self, their_vatid, nonce_number, offset, msg):
-        # the message is genuine, but might be a replay, or from the future
+        # the message is genuine, but might be a replay, or from the future.
+        # Nothing is committed here: the caller is responsible for that.
         c = self.db.cursor()
-        c.execute("SELECT next_msgnum FROM inbound_msgnums"
-                  " WHERE from_vatid=? LIMIT 1", (their_vatid,))
-        data = c.fetchall()
-        if data:
-            next_msgnum = data[0][0]
-        else:
-            c.execute("INSERT INTO inbound_msgnums VALUES (?,?)",
-                      (their_vatid, 0))
-            self.db.commit()
-            next_msgnum = 0
+        next_msgnum = self.get_inbound_msgnum(their_vatid)
         expected_nonce = 4*next_msgnum+offset
+        msgnum = (nonce_number - offset) // 4
         # If the nonce is old, we remember processing this message, so just
-        # ACK it. If the nonce is too new, signal an error: that either means
+        # ACK it. If the nonce is a little bit new, hold on to it until the
+        # gap is filled. If it is too new, signal an error: that either means
         # we've been rolled back, or they're sending nonces from the future.
         # If the nonce is just right, process the message.
-        if nonce_number > expected_nonce:
+        msg_json = msg.decode("utf-8")
+        if msgnum > next_msgnum + self.SACK_WINDOW:
             log.msg("future: got %d, expected %d" % (nonce_number, expected_nonce))
             raise ValueError("begone ye futuristic demon message!")
-        if nonce_number < expected_nonce:
+        if msgnum > next_msgnum:
+            log.msg("early: got %d, expected %d" % (nonce_number, expected_nonce))
+            c.execute("INSERT OR IGNORE INTO `inbound_early_messages`"
+                      " VALUES (?,?,?)", (their_vatid, msgnum, msg_json))
+            return
+        if msgnum < next_msgnum:
             log.msg("old: got %d, current is %d" % (nonce_number, expected_nonce))
-            return "ack (old)"
+            return
         log.msg("current: %d" % nonce_number)
-        # add the message to the inbound queue. Once safe, ack.
-        msg_json = msg.decode("utf-8")
+        # add the message to the inbound queue, along with any early
+        # messages that it makes contiguous. Once safe, ack.
         c.execute("INSERT INTO `inbound_messages` VALUES (?,?,?)",
                   (their_vatid, next_msgnum, msg_json))
-        c.execute("UPDATE `inbound_msgnums`"
-                  " SET `next_msgnum`=?"
-                  " WHERE `from_vatid`=?",
-                  (next_msgnum+1, their_vatid))
-        self.db.commit()
-        self.trigger_inbound()
-        return "ack (new)"
+        next_msgnum += 1
+        while True:
+            c.execute("SELECT `message_json` FROM `inbound_early_messages`"
+                      " WHERE `from_vatid`=? AND `msgnum`=?",
+                      (their_vatid, next_msgnum))
+            data = c.fetchall()
+            if not data:
+                break
+            c.execute("INSERT INTO `inbound_messages` VALUES (?,?,?)",
+                      (their_vatid, next_msgnum, data[0][0]))
+            c.execute("DELETE FROM `inbound_early_messages`"
+                      " WHERE `from_vatid`=? AND `msgnum`=?",
+                      (their_vatid, next_msgnum))
+            next_msgnum += 1
+        self.set_inbound_msgnum(their_vatid, next_msgnum)
 
     def trigger_inbound(self):
         if not self.inbound_triggered:
             self.inbound_triggered = True
             eventually(self.deliver_inbound_messages)
 
+    # Each call to deliver_inbound_messages() processes up to
+    # inbound_batch_size messages, or as many as fit in inbound_time_budget
+    # seconds (whichever comes first), then retires them all in a single
+    # commit and yields the reactor before doing any more.
+    #
+    # When the executor uses worker processes, process_request() returns a
+    # Deferred instead. The batch stops there, and _worker_turn_done()
+    # retires that message and starts the next batch once it fires.
+    inbound_batch_size = 100
+    inbound_time_budget = 0.1
+
     def deliver_inbound_messages(self):
         self.inbound_triggered = False
         # we are now responsible for processing all queued messages, or
         # calling trigger_inbound() to reschedule ourselves for later
 
+        # Loopback messages come from our RAM queue (already parsed), the
+        # rest from the DB. When both are busy, each gets at least half of
+        # the batch. Messages from each vat are processed in order, and we
+        # service First-er remote vats first, no particular reason.
+        # Senders whose next message is waiting for a congested peer are
+        # skipped entirely, until that peer catches up. Loopback messages
+        # are all "from" us, so instead we set aside just the turn that was
+        # waiting, and keep running the rest.
+        #
+        # With a WorkerPool, process_request() returns a Deferred, and we
+        # move on to the next sender while the worker runs that turn. Each
+        # sender has at most one turn running (so its messages still run in
+        # order), and a sender whose next turn might touch the same Memories
+        # as a running one waits for it (see scheduler.py). Once every
+        # worker is busy we stop, and _worker_turn_done() calls us again.
+        size = self.inbound_batch_size
+        local = []
+        if self.vatid not in self.inbound_running:
+            local = list(islice(self.loopback_queue, size))
+        skip = ([self.vatid] + self.blocked_senders.keys()
+                + self.inbound_running.keys())
         c = self.db.cursor()
-        c.execute("SELECT `from_vatid` FROM `inbound_messages`")
-        vatids = sorted([res[0] for res in c.fetchall()])
-        if not vatids:
+        c.execute("SELECT `from_vatid`, `msgnum`, `message_json`"
+                  " FROM `inbound_messages`"
+                  " WHERE `from_vatid` NOT IN (%s)"
+                  " ORDER BY `from_vatid`, `msgnum`"
+                  " LIMIT ?" % ",".join(["?"]*len(skip)),
+                  skip + [size - min(len(local), size//2)])
+        remote = c.fetchall()
+        local = local[:size - len(remote)]
+        batch = ([(self.vatid, msgnum, msg) for (msgnum, msg) in local]
+                 + remote)
+        if not batch:
             return
-        vatid = vatids[0] # service First-er vat first, no particular reason
-        c.execute("SELECT `msgnum` FROM `inbound_messages`"
-                  " WHERE `from_vatid` = ?", (vatid,))
-        msgnum = sorted([res[0] for res in c.fetchall()])[0]
-        c.execute("SELECT `message_json` FROM `inbound_messages`"
-                  " WHERE `from_vatid`=? AND `msgnum`=?",
-                  (vatid, msgnum))
-        (msg_json,) = c.fetchone()
-        msg = json.loads(msg_json)
-
-        # TODO: catch errors in process_request(), specifically inside the
-        # eval() and call() that it performs. Those failures (which are
-        # repeatable) still allow us to retire the message. It's only system
-        # failures (loss of power, node shutdown) that allow messages to be
-        # tried again.
-        self.executor.process_request(msg, vatid)
-
-        # if that completes, we can retire the message
-        c.execute("DELETE FROM `inbound_messages`"
-                  " WHERE `from_vatid`=? and `msgnum`=?",
-                  (vatid, msgnum))
-        self.db.commit()
+        deadline = time.time() + self.inbound_time_budget
+        processed = []
+        held = set()
+        try:
+            for (vatid, msgnum, msg) in batch:
+                if (vatid in self.blocked_senders
+                    or vatid in self.inbound_running or vatid in held):
+                    continue # keep its messages in order
+                if vatid != self.vatid:
+                    msg = json.loads(msg)
+                if not self.executor.can_start(msg):
+                    held.add(vatid)
+                    continue
+                if self.executor.is_saturated():
+                    break
+                # TODO: catch errors in process_request(), specifically
+                # inside the eval() and call() that it performs. Those
+                # failures (which are repeatable) still allow us to retire
+                # the message. It's only system failures (loss of power,
+                # node shutdown) that allow messages to be tried again.
+                try:
+                    d = self.executor.process_request(msg, vatid)
+                except PeerCongested, e:
+                    # the turn stopped before writing anything. Try it
+                    # again once that peer has caught up.
+                    self._turn_congested(vatid, e.vatid)
+                    continue
+                if d is not None:
+                    self.inbound_running[vatid] = msgnum
+                    d.addBoth(self._worker_turn_done, vatid, msgnum)
+                    continue
+                processed.append((vatid, msgnum))
+                if vatid == self.vatid:
+                    self.loopback_queue.popleft()
+                if time.time() > deadline:
+                    break
+        finally:
+            # whatever completed can be retired
+            c.executemany("DELETE FROM `inbound_messages`"
+                          " WHERE `from_vatid`=? AND `msgnum`=?",
+                          processed)
+            # this commits the whole batch of turns, too
+            self.executor.commits.flush()
 
-        # now, do we have more work to do?
-        c.execute("SELECT `from_vatid` FROM `inbound_messages`")
-        vatids = [res[0] for res in c.fetchall()]
-        if vatids:
+        # now, do we have more work to do? Anything which arrived while we
+        # were working has already called trigger_inbound()
+        if self.inbound_running:
+            return # _worker_turn_done() will call us again
+        if (len(processed) < len(batch)
+            or len(batch) == self.inbound_batch_size):
             self.trigger_inbound() # more work to do, later
 
-    def send_loopback(self, msg):
-        c = self.db.cursor()
-        c.execute("SELECT next_msgnum FROM inbound_msgnums"
-                  " WHERE from_vatid=? LIMIT 1", (self.vatid,))
-        data = c.fetchall()
-        if data:
-            next_msgnum = data[0][0]
+    def _worker_turn_done(self, result, vatid, msgnum):
+        del self.inbound_running[vatid]
+        if (isinstance(result, failure.Failure)
+            and result.check(PeerCongested)):
+            self._turn_congested(vatid, result.value.vatid)
         else:
-            c.execute("INSERT INTO inbound_msgnums VALUES (?,?)",
-                      (self.vatid, 0))
-            self.db.commit()
-            next_msgnum = 0
-        msg_json = msg.decode("utf-8")
+            if isinstance(result, failure.Failure):
+                # the turn (or its worker) failed. Running it again would
+                # only fail again, and hold up this sender's later
+                # messages, so it is retired like any other.
+                log.err(result, "turn failed")
+            c = self.db.cursor()
+            c.execute("DELETE FROM `inbound_messages`"
+                      " WHERE `from_vatid`=? AND `msgnum`=?", (vatid, msgnum))
+            if vatid == self.vatid:
+                self.loopback_queue.popleft()
+        self.executor.commits.flush()
+        self.trigger_inbound()
+
+    def _turn_congested(self, vatid, congested_vatid):
+        if vatid == self.vatid:
+            # it is at the head of the loopback queue
+            waiting = self.congested_loopback.setdefault(congested_vatid, [])
+            waiting.append(self.loopback_queue.popleft())
+        else:
+            self.blocked_senders[vatid] = congested_vatid
+
+    # Messages to ourselves (mostly sendOnly() to a local reference) skip
+    # the boxing and the outbound queue. queue_loopback() takes the parsed
+    # message, writes it unchanged (args_json and all) to `inbound_messages`
+    # (so it survives a crash), and appends it to loopback_queue, from which
+    # deliver_inbound_messages() hands it directly to the executor. It does
+    # not commit: a Turn queues its messages in the same transaction as the
+    # rest of its changes. At startup, any loopback messages left in the DB
+    # are loaded back into the queue.
+
+    def load_loopback_queue(self):
+        self.loopback_queue.clear()
+        c = self.db.cursor()
+        c.execute("SELECT `msgnum`, `message_json` FROM `inbound_messages`"
+                  " WHERE `from_vatid`=?"
+                  " ORDER BY `msgnum`", (self.vatid,))
+        for (msgnum, msg_json) in c.fetchall():
+            self.loopback_queue.append((msgnum, json.loads(msg_json)))
+
+    def queue_loopback(self, msg):
+        next_msgnum = self.get_inbound_msgnum(self.vatid)
+        c = self.db.cursor()
         c.execute("INSERT INTO `inbound_messages` VALUES (?,?,?)",
-                  (self.vatid, next_msgnum, msg_json))
-        c.execute("UPDATE `inbound_msgnums`"
-                  " SET `next_msgnum`=?"
-                  " WHERE `from_vatid`=?",
-                  (next_msgnum+1, self.vatid))
-        self.db.commit()
+                  (self.vatid, next_msgnum, json.dumps(msg)))
+        self.set_inbound_msgnum(self.vatid, next_msgnum+1)
+        self.loopback_queue.append((next_msgnum, msg))
         self.trigger_inbound()
 
+    def send_loopback(self, msg):
+        self.queue_loopback(json.loads(msg))
+        self.db.commit()
+
     def send_message(self, their_vatid, msg):
         assert isinstance(msg, (str, unicode)), "should be a json object, not %s" % type(msg)
         assert msg.startswith("{")
         if their_vatid == self.vatid:
             self.send_loopback(msg)
             return
+        self.queue_message(their_vatid, msg)
+        self.db.commit()
+        self.messages_committed()
+
+    # queue_message() adds a message to the outbound queue without
+    # committing (a Turn commits it along with the rest of the turn). It
+    # must not be sent until then: if we crashed before the commit, the same
+    # msgnum (and nonce) would be used again for a different message. So
+    # delivery only starts when the committer calls messages_committed().
+
+    def check_vatid(self, vatid):
+        # vatids arrive in messages (as a reply_to, or inside a reference),
+        # so a turn checks each one before it queues anything for it
+        if vatid == self.vatid:
+            return
+        try:
+            pubkey = util.from_ascii(vatid, "pk0-", encoding="base32")
+        except (util.BadPrefixError, AttributeError, TypeError, ValueError):
+            raise BadVatid(vatid)
+        if (len(pubkey) != crypto_box_PUBLICKEYBYTES
+            or util.to_ascii(pubkey, "pk0-", encoding="base32") != vatid):
+            raise BadVatid(vatid)
+
+    def check_message_size(self, their_vatid, size):
+        # a peer reads (and decompresses) at most its max_message_size of
+        # each message, which we assume matches ours. PeerSender sends at
+        # least one message per envelope, so a larger one would be refused
+        # on every retry, and wedge the queue behind it. The message also
+        # gains a v1 header, a MAC, and netstring framing on the way.
+        if their_vatid == self.vatid:
+            return
+        if size + self.V1_HEADER_LENGTH + 16 + 20 > self.max_message_size:
+            raise MessageTooLarge(their_vatid, size)
 
+    def queue_message(self, their_vatid, msg):
+        self.check_vatid(their_vatid)
+        self.check_message_size(their_vatid, len(msg))
+        # a new PeerSender counts the queue from the DB, so it must see it
+        # before we add this message
+        sender = self.get_sender(their_vatid)
         c = self.db.cursor()
         c.execute("SELECT `next_msgnum` FROM `outbound_msgnums`"
                   " WHERE `to_vatid`=? LIMIT 1", (their_vatid,))
@@ -207,7 +514,6 @@ class Server(service.MultiService):
         else:
             c.execute("INSERT INTO outbound_msgnums VALUES (?,?)",
                       (their_vatid, 0))
-            self.db.commit()
             next_msgnum = 0
         # add the boxed message to the outbound queue
         if their_vatid < self.vatid:
@@ -215,19 +521,32 @@ class Server(service.MultiService):
         else:
             offset = 2 # I am First, they are Second, msg is First->Second
         nonce = self.number_to_nonce(4*next_msgnum+offset)
-        their_pubkey = util.from_ascii(their_vatid, "pk0-", encoding="base32")
-        boxed = ",".join(["v0",
-                          util.to_ascii(self.pubkey, "pk0-", encoding="base32"),
-                          util.to_ascii(nonce, encoding="base32"),
-                          crypto_box(msg, nonce, their_pubkey, self.privkey)])
+        codec = compression.NONE
+        if len(msg) >= self.compress_threshold:
+            codec = compression.choose_codec(self.peer_codecs.get(their_vatid,
+                                                                  []))
+        if codec != compression.NONE:
+            if isinstance(msg, unicode):
+                msg = msg.encode("utf-8")
+            compressed = compression.compress(codec, msg)
+            if len(compressed) < len(msg):
+                msg = compressed
+            else:
+                codec = compression.NONE
+        boxed = self.build_message("v1", their_vatid, nonce, msg, codec)
         c.execute("INSERT INTO `outbound_messages` VALUES (?,?,?,?)",
-                  (their_vatid, 0, next_msgnum, base64.b64encode(boxed)))
+                  (their_vatid, 0, next_msgnum, sqlite3.Binary(boxed)))
         c.execute("UPDATE `outbound_msgnums`"
                   " SET `next_msgnum`=?"
                   " WHERE `to_vatid`=?",
                   (next_msgnum+1, their_vatid))
-        self.db.commit()
-        self.trigger_outbound()
+        sender.message_queued(len(boxed))
+        self.uncommitted_peers.add(their_vatid)
+
+    def messages_committed(self):
+        peers, self.uncommitted_peers = self.uncommitted_peers, set()
+        for vatid in peers:
+            self.retry.message_queued(vatid)
 
     def trigger_outbound(self):
         if not self.outbound_triggered:
@@ -236,67 +555,128 @@ class Server(service.MultiService):
 
     def deliver_outbound_messages(self):
         self.outbound_triggered = False
-        # we are now responsible for transmitting all queued messages. Hm,
-        # not sure this is a good way.
+        # we are now responsible for transmitting all queued messages. Each
+        # peer's PeerSender sends everything it has in a single request.
         c = self.db.cursor()
-        now = time.time()
-        not_recent = now - 60; # for now, retry every minute
-        c.execute("SELECT `to_vatid` FROM `outbound_messages`"
-                  " WHERE `last_sent` < ?", (not_recent,))
+        c.execute("SELECT DISTINCT `to_vatid` FROM `outbound_messages`")
         vatids = [res[0] for res in c.fetchall()]
         for vatid in vatids:
             self.deliver_outbound_messages_to_vatid(vatid)
 
     def deliver_outbound_messages_to_vatid(self, vatid):
-        c = self.db.cursor()
-        c.execute("SELECT `msgnum` FROM `outbound_messages`"
-                  " WHERE `to_vatid` = ?", (vatid,))
-        msgnums = [res[0] for res in c.fetchall()]
-        c.execute("SELECT `url` FROM `vat_urls`"
-                  " WHERE `vatid` = ?", (vatid,))
-        urls = [str(res[0]) for res in c.fetchall()]
-        if not urls:
-            log.msg("warning: sending msg to vatid %s but have no URL" % vatid)
-        for msgnum in sorted(msgnums):
-            c.execute("SELECT `message_b64` FROM `outbound_messages`"
-                      " WHERE `to_vatid`=? AND `msgnum`=?",
-                      (vatid, msgnum))
-            (msg_b64,) = c.fetchone()
-            msg = base64.b64decode(msg_b64)
-            for url in urls:
-                d = getPage(url, method="POST", postdata=msg,
-                            followRedirect=True, timeout=60)
-                d.addCallback(self._outbound_response, vatid, msgnum)
-                d.addErrback(self._outbound_error)
-
-    def _outbound_response(self, response, their_vatid, msgnum):
+        self.get_sender(vatid).flush()
+
+    def get_sender(self, vatid):
+        if vatid not in self.senders:
+            self.senders[vatid] = PeerSender(self, vatid)
+        return self.senders[vatid]
+
+    # Outbound flow control (see outbound.py). These limits apply to each
+    # peer separately.
+    max_inflight_messages = 100 # per envelope
+    max_queued_messages = 1000
+    max_queued_bytes = 10*1000*1000
+
+    def is_congested(self, vatid):
+        if vatid == self.vatid:
+            return False
+        return self.get_sender(vatid).congested
+
+    def check_message(self, vatid, msg):
+        # for Turns that use us as their server (mostly in tests)
+        self.executor.check_message(vatid, msg)
+
+    def peer_decongested(self, vatid):
+        for (from_vatid, waiting_for) in self.blocked_senders.items():
+            if waiting_for == vatid:
+                del self.blocked_senders[from_vatid]
+        self.loopback_queue.extend(self.congested_loopback.pop(vatid, []))
+        self.trigger_inbound()
+
+    def _outbound_response(self, response, their_vatid, msgnums):
+        # the response is a boxed ACK (see inbound_envelope), in a netstring
         if their_vatid < self.vatid:
             offset = 0 # they are First, I am Second, msg is Second->First
         else:
             offset = 2 # I am First, they are Second, msg is First->Second
-        expected_nonce = self.number_to_nonce(4*msgnum+offset+1)
-        pubkey_s, pubkey, nonce, encbody = self.parse_message(response)
-        assert pubkey_s == their_vatid, (pubkey_s, their_vatid)
-        assert nonce == expected_nonce, (int(hexlify(nonce),16), 4*msgnum+offset+1)
-        msg = crypto_box_open(encbody, nonce, pubkey, self.privkey)
-        log.msg("response msg: %s" % msg)
-        # we don't actually look at the contents, just getting a valid boxed
-        # response back is proof of success. We can now retire it.
+        expected = dict([(4*msgnum+offset+1, msgnum) for msgnum in msgnums])
+        responses = split_netstrings(response)
+        if not responses:
+            raise ValueError("no ACK from %s" % their_vatid)
         c = self.db.cursor()
-        c.execute("DELETE FROM `outbound_messages`"
-                  " WHERE `to_vatid`=? AND `msgnum`=?",
-                  (their_vatid, msgnum))
+        for boxed in responses:
+            (version, pubkey_s, nonce, encbody,
+             codec) = self.parse_message(boxed)
+            assert pubkey_s == their_vatid, (pubkey_s, their_vatid)
+            nonce_number = int(hexlify(nonce), 16)
+            assert nonce_number in expected, (nonce_number, msgnums)
+            msg = compression.decompress(codec,
+                                         self.keys.open(their_vatid, encbody,
+                                                        nonce),
+                                         self.max_message_size)
+            log.msg("response msg: %s" % msg)
+            if not msg.startswith("{"):
+                # an older peer, which ACKs one message at a time. Just
+                # getting a valid boxed response back is proof of success.
+                c.execute("DELETE FROM `outbound_messages`"
+                          " WHERE `to_vatid`=? AND `msgnum`=?",
+                          (their_vatid, expected[nonce_number]))
+                continue
+            ack = json.loads(msg)
+            if "codecs" in ack:
+                self.peer_codecs[their_vatid] = ack["codecs"]
+            c.execute("DELETE FROM `outbound_messages`"
+                      " WHERE `to_vatid`=? AND `msgnum`<?",
+                      (their_vatid, ack["ack"]))
+            for msgnum in ack["sack"]:
+                c.execute("DELETE FROM `outbound_messages`"
+                          " WHERE `to_vatid`=? AND `msgnum`=?",
+                          (their_vatid, msgnum))
         self.db.commit()
+        self.get_sender(their_vatid).messages_acked()
 
     def _outbound_error(self, f):
         print f
 
+    # Boxed messages come in two formats. v0 is mostly text:
+    #  "v0,pk0-pubkey_b32,nonce_b32,encbody" (encbody is binary)
+    # v1 has a fixed-length binary header:
+    #  "v1" + flags (1 byte) + pubkey (32 bytes) + nonce (24 bytes) + encbody
+    # We send v1, but accept both. The flags byte holds the compression codec
+    # that was applied to the body before boxing (see compression.py). We
+    # only compress messages of at least compress_threshold bytes, for peers
+    # that have advertised a codec, and only when it actually helps.
+
+    V1_HEADER_LENGTH = 2+1+crypto_box_PUBLICKEYBYTES+crypto_box_NONCEBYTES
+
+    compress_threshold = 1024
+
+    def build_message(self, version, their_vatid, nonce, msg,
+                      codec=compression.NONE):
+        encbody = self.keys.box(their_vatid, msg, nonce)
+        if version == "v0":
+            assert codec == compression.NONE
+            # vatids come out of the DB as unicode, but encbody is binary
+            return ",".join(["v0",
+                             str(self.vatid),
+                             util.to_ascii(nonce, encoding="base32"),
+                             encbody])
+        assert version == "v1", version
+        return "".join(["v1", chr(codec), self.pubkey, nonce, encbody])
+
     def parse_message(self, body):
-        # msg is "v0,pk0-pubkey_b32,nonce_b32,encbody", encbody is binary
+        if body.startswith("v1"):
+            assert len(body) >= self.V1_HEADER_LENGTH, "truncated message"
+            codec = ord(body[2])
+            pubkey_end = 3+crypto_box_PUBLICKEYBYTES
+            pubkey = body[3:pubkey_end]
+            nonce = body[pubkey_end:self.V1_HEADER_LENGTH]
+            encbody = body[self.V1_HEADER_LENGTH:]
+            return ("v1", self.keys.get_vatid(pubkey), nonce, encbody, codec)
         v0_s, pubkey_s, nonce_s, encbody = body.split(",",3)
         assert v0_s == "v0"
-        pubkey = util.from_ascii(pubkey_s, "pk0-", encoding="base32")
+        # the pubkey itself is decoded (and checked) by self.keys, and
+        # cached along with the shared key
         nonce = util.from_ascii(nonce_s, encoding="base32")
-        assert len(pubkey) == crypto_box_PUBLICKEYBYTES
         assert len(nonce) == crypto_box_NONCEBYTES
-        return (pubkey_s, pubkey, nonce, encbody)
+        return ("v0", pubkey_s, nonce, encbody, compression.NONE)
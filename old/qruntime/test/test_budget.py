@@ -0,0 +1,84 @@
+import sqlite3, time
+import unittest
+from ..database import get_schema
+from ..budget import Budget, Budgets, Meter, BudgetExceeded
+from .. import budget
+
+class Metering(unittest.TestCase):
+    def test_wall(self):
+        m = Meter(Budget(wall_limit=0.05))
+        m.start()
+        try:
+            def wait():
+                while True:
+                    time.sleep(0.001)
+            self.failUnlessRaises(BudgetExceeded, wait)
+        finally:
+            m.stop()
+        self.failUnless(m.exceeded.startswith("wall time"), m.exceeded)
+        self.failUnless(m.get_usage()["wall_time"] < 1.0)
+
+    def test_cpu(self):
+        m = Meter(Budget(cpu_limit=0.05))
+        m.start()
+        try:
+            def spin():
+                while True:
+                    try:
+                        pass
+                    except Exception:
+                        pass
+            self.failUnlessRaises(BudgetExceeded, spin)
+        finally:
+            m.stop()
+        self.failUnless(m.exceeded.startswith("cpu time"), m.exceeded)
+
+    def test_hold(self):
+        m = Meter(Budget(wall_limit=0.05))
+        m.start()
+        try:
+            m.hold()
+            # ticks are postponed while held
+            deadline = time.time() + 0.1
+            while time.time() < deadline:
+                time.sleep(0.001)
+            self.failUnlessEqual(m.exceeded, None)
+            self.failUnlessRaises(BudgetExceeded, m.release)
+        finally:
+            m.stop()
+        self.failUnless(m.exceeded.startswith("wall time"), m.exceeded)
+
+    def test_within_budget(self):
+        m = Meter(Budget())
+        m.start()
+        m.stop()
+        m.check()
+        self.failUnlessEqual(m.exceeded, None)
+
+class Limits(unittest.TestCase):
+    def setUp(self):
+        self.db = sqlite3.connect(":memory:")
+        self.db.executescript(get_schema(2))
+
+    def test_budgets(self):
+        b = Budgets(self.db)
+        self.failUnlessEqual(b.get_budget("urb1").wall_limit,
+                             budget.DEFAULT_WALL_LIMIT)
+        b.set_defaults(wall_limit=1.0, cpu_limit=0.5)
+        b.set_budget("urb1", cpu_limit=2.0)
+        b1 = b.get_budget("urb1")
+        self.failUnlessEqual((b1.wall_limit, b1.cpu_limit, b1.memory_limit),
+                             (1.0, 2.0, budget.DEFAULT_MEMORY_LIMIT))
+        self.failUnlessEqual(b.get_budget("urb2").cpu_limit, 0.5)
+        self.failUnlessEqual(b.get_budget().cpu_limit, 0.5)
+
+    def test_usage(self):
+        b = Budgets(self.db)
+        self.failUnlessEqual(b.get_usage("urb1"), None)
+        b.record_usage("urb1", {"wall_time": 1.0, "cpu_time": 0.5,
+                                "max_memory": 100}, False)
+        b.record_usage("urb1", {"wall_time": 2.0, "cpu_time": 0.5,
+                                "max_memory": 50}, True)
+        self.failUnlessEqual(b.get_usage("urb1"),
+                             {"turns": 2, "aborted": 1, "wall_time": 3.0,
+                              "cpu_time": 1.0, "max_memory": 100})
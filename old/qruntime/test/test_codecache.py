@@ -0,0 +1,40 @@
+import sqlite3
+import unittest
+from ..database import get_schema
+from ..codecache import CodeCache
+
+def run(code_obj):
+    namespace = {}
+    eval(code_obj, namespace, namespace)
+    return namespace["call"]()
+
+CODE = ["def call():\n    return %d\n" % i for i in range(3)]
+
+class Cache(unittest.TestCase):
+    def test_lru(self):
+        cache = CodeCache(max_entries=2)
+        self.failUnlessEqual(run(cache.get(CODE[0])), 0)
+        self.failUnless(cache.get(CODE[0]) is cache.get(CODE[0]))
+        cache.get(CODE[1])
+        cache.get(CODE[0]) # now CODE[1] is least-recently-used
+        cache.get(CODE[2]) # evicts CODE[1]
+        cache.get(CODE[0])
+        self.failUnlessEqual(run(cache.get(CODE[1])), 1)
+        stats = cache.get_stats()
+        self.failUnlessEqual((stats["entries"], stats["hits"],
+                              stats["misses"], stats["evictions"]),
+                             (2, 4, 4, 2))
+        self.failUnlessEqual(stats["hit_ratio"], 0.5)
+
+    def test_persist(self):
+        db = sqlite3.connect(":memory:")
+        db.executescript(get_schema(2))
+        cache = CodeCache(db=db)
+        cache.get(CODE[0])
+        self.failUnlessEqual(cache.loads, 0)
+        # a new cache (i.e. after a restart) doesn't need to compile it
+        cache2 = CodeCache(db=db)
+        self.failUnlessEqual(run(cache2.get(CODE[0])), 0)
+        self.failUnlessEqual(cache2.loads, 1)
+        self.failUnlessEqual(cache2.get_codeid(CODE[0]),
+                             cache.get_codeid(unicode(CODE[0])))
@@ -0,0 +1,33 @@
+import unittest
+from .. import compression
+
+class Codecs(unittest.TestCase):
+    def test_names(self):
+        self.failUnless("zlib" in compression.get_codec_names())
+
+    def test_choose(self):
+        self.failUnlessEqual(compression.choose_codec([]), compression.NONE)
+        self.failUnlessEqual(compression.choose_codec(["unknown"]),
+                             compression.NONE)
+        self.failIfEqual(compression.choose_codec(["unknown", "zlib"]),
+                         compression.NONE)
+
+    def test_roundtrip(self):
+        codec = compression.choose_codec(["zlib"])
+        data = '{"args": [' + '"spam", '*1000 + '"eggs"]}'
+        compressed = compression.compress(codec, data)
+        self.failUnless(len(compressed) < len(data))
+        self.failUnlessEqual(compression.decompress(codec, compressed,
+                                                    len(data)), data)
+        self.failUnlessEqual(compression.decompress(compression.NONE, data,
+                                                    len(data)), data)
+
+    def test_limits(self):
+        codec = compression.choose_codec(["zlib"])
+        compressed = compression.compress(codec, "a"*10000)
+        self.failUnlessRaises(ValueError,
+                              compression.decompress, codec, compressed, 9999)
+        self.failUnlessRaises(ValueError,
+                              compression.decompress, codec, "garbage", 100)
+        self.failUnlessRaises(ValueError,
+                              compression.decompress, 200, compressed, 10000)
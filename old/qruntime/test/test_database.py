@@ -0,0 +1,57 @@
+import os, base64, sqlite3
+from twisted.trial import unittest
+from ..database import get_db, get_schema, VERSION
+from ..memory import Memory
+
+def describe(db):
+    tables = {}
+    c = db.cursor()
+    c.execute("SELECT `name` FROM `sqlite_master` WHERE `type`='table'"
+              " AND `name` NOT LIKE 'sqlite_%'")
+    for (name,) in c.fetchall():
+        c.execute("PRAGMA table_info(`%s`)" % name)
+        tables[name] = [(row[1], row[2]) for row in c.fetchall()]
+    c.execute("SELECT `name` FROM `sqlite_master` WHERE `type`='index'"
+              " AND `name` NOT LIKE 'sqlite_%'")
+    indices = sorted([name for (name,) in c.fetchall()])
+    return tables, indices
+
+class Upgrade(unittest.TestCase):
+    def test_v1(self):
+        basedir = self.mktemp()
+        os.mkdir(basedir)
+        dbfile = os.path.join(basedir, "control.db")
+        db = sqlite3.connect(dbfile)
+        db.executescript(get_schema(1))
+        db.execute("INSERT INTO `version` VALUES (1)")
+        db.execute("INSERT INTO `node` VALUES (?,?,?)",
+                   ("tcp:0", "pk0-abc", "sk0-abc"))
+        db.execute("INSERT INTO `vat_urls` VALUES ('pk0-x', 'http://x/')")
+        db.execute("INSERT INTO `vat_urls` VALUES ('pk0-x', 'http://x/')")
+        db.execute("INSERT INTO `outbound_messages` VALUES (?,?,?,?)",
+                   ("pk0-x", 0, 0, base64.b64encode("v0,boxed\x00\xff")))
+        db.execute("INSERT INTO `memory` VALUES (?,?)",
+                   ("mem0-1", '{"a": 1}'))
+        db.commit()
+        db.close()
+
+        sqlite, db = get_db(dbfile)
+        self.failUnlessEqual(VERSION, 2)
+        self.failUnlessEqual(db.execute("SELECT `version` FROM `version`")
+                             .fetchall(), [(2,)])
+        fresh = sqlite3.connect(":memory:")
+        fresh.executescript(get_schema(2))
+        self.failUnlessEqual(describe(db), describe(fresh))
+
+        self.failUnlessEqual(db.execute("SELECT `max_message_size`"
+                                        " FROM `node`").fetchall(), [(None,)])
+        self.failUnlessEqual(db.execute("SELECT * FROM `vat_urls`")
+                             .fetchall(), [("pk0-x", "http://x/")])
+        rows = db.execute("SELECT `to_vatid`, `msgnum`, `message`"
+                          " FROM `outbound_messages`").fetchall()
+        self.failUnlessEqual([(vatid, msgnum, str(message))
+                              for (vatid, msgnum, message) in rows],
+                             [("pk0-x", 0, "v0,boxed\x00\xff")])
+        # old Memories are still readable, and are split when written
+        m = Memory(db, "mem0-1")
+        self.failUnlessEqual(m.get_data(), {"a": 1})
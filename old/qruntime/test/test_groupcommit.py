@@ -0,0 +1,33 @@
+import sqlite3
+from twisted.trial import unittest
+from twisted.internet import task
+from ..groupcommit import GroupCommitter
+
+class Commits(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.db = sqlite3.connect(":memory:")
+        self.db.execute("CREATE TABLE `t` (`a` INTEGER)")
+        self.db.commit()
+        self.gc = GroupCommitter(self.db, window=0.1, max_pending=3,
+                                 clock=self.clock)
+
+    def test_window(self):
+        fired = []
+        for i in range(2):
+            self.db.execute("INSERT INTO `t` VALUES (?)", (i,))
+            self.gc.commit_soon().addCallback(fired.append)
+        self.failUnlessEqual(fired, [])
+        self.clock.advance(0.1)
+        self.failUnlessEqual(fired, [None, None])
+        self.failUnlessEqual(self.gc.commits, 1)
+
+    def test_batch_size(self):
+        fired = []
+        for i in range(3):
+            self.db.execute("INSERT INTO `t` VALUES (?)", (i,))
+            self.gc.commit_soon().addCallback(fired.append)
+        # the third waiter fills the batch, so it doesn't wait for the timer
+        self.failUnlessEqual(fired, [None, None, None])
+        self.failUnlessEqual(self.gc.commits, 1)
+        self.failIf(self.clock.getDelayedCalls())
@@ -0,0 +1,77 @@
+from twisted.trial import unittest
+from twisted.application import service
+from twisted.internet import reactor, defer
+from twisted.web import server, resource, error
+from ..httpclient import DeliveryClient
+
+class Echo(resource.Resource):
+    isLeaf = True
+    def render_POST(self, request):
+        if request.postpath == ["fail"]:
+            request.setResponseCode(500)
+        return "echo:" + request.content.read()
+
+class Client(unittest.TestCase):
+    def setUp(self):
+        self.s = service.MultiService()
+        self.s.startService()
+        self.port = reactor.listenTCP(0, server.Site(Echo()),
+                                      interface="127.0.0.1")
+        self.url = "http://127.0.0.1:%d/" % self.port.getHost().port
+        self.client = DeliveryClient()
+        self.client.setServiceParent(self.s)
+
+    def tearDown(self):
+        d = defer.maybeDeferred(self.s.stopService)
+        d.addCallback(lambda _: self.port.stopListening())
+        return d
+
+    def test_reuse(self):
+        d = self.client.post(self.url, "one")
+        def _then(body):
+            self.failUnlessEqual(body, "echo:one")
+            return self.client.post(self.url, "two")
+        d.addCallback(_then)
+        def _then2(body):
+            self.failUnlessEqual(body, "echo:two")
+            stats = self.client.get_stats()
+            self.failUnlessEqual(stats["requests"], 2)
+            self.failUnlessEqual(stats["new_connections"], 1)
+            self.failUnlessEqual(stats["reused_connections"], 1)
+            self.failUnlessEqual(stats["failures"], 0)
+        d.addCallback(_then2)
+        return d
+
+    def test_error(self):
+        d = self.client.post(self.url+"fail", "one")
+        d = self.assertFailure(d, error.Error)
+        def _then(e):
+            self.failUnlessEqual(e.status, "500")
+            self.failUnlessEqual(self.client.get_stats()["failures"], 1)
+        d.addCallback(_then)
+        return d
+
+    def test_per_host_limit(self):
+        self.client.max_connections_per_host = 1
+        d1 = self.client.post(self.url, "one")
+        d2 = self.client.post(self.url, "two")
+        # only one request may be in flight, so the second one waits
+        limit = self.client._get_limit(self.url)
+        self.failUnlessEqual(limit.tokens, 0)
+        self.failUnlessEqual(len(limit.waiting), 1)
+        d = defer.gatherResults([d1, d2])
+        d.addCallback(self.failUnlessEqual, ["echo:one", "echo:two"])
+        return d
+
+    def test_stop_while_posting(self):
+        d1 = self.client.post(self.url, "one")
+        # the post finishes before the pool is closed, so its connection
+        # doesn't outlive the client
+        d = self.client.stopService()
+        d.addCallback(lambda _: d1)
+        def _then(body):
+            self.failUnlessEqual(body, "echo:one")
+            self.failUnlessEqual(self.client.get_stats()["idle_connections"],
+                                 0)
+        d.addCallback(_then)
+        return d
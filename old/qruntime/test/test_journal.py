@@ -0,0 +1,58 @@
+import sqlite3
+from twisted.trial import unittest
+from twisted.internet import task
+from ..database import get_schema
+from ..memory import create_memory, Memory
+from ..groupcommit import GroupCommitter
+from ..journal import MemoryJournal, read_journal
+
+class Journal(unittest.TestCase):
+    def setUp(self):
+        self.db = sqlite3.connect(":memory:")
+        self.db.executescript(get_schema(2))
+        self.clock = task.Clock()
+        self.commits = GroupCommitter(self.db, clock=self.clock)
+
+    def test_journal(self):
+        memid = create_memory(self.db, {"a": 1, "b": 2})
+        m = Memory(self.db, memid)
+        j = MemoryJournal(self.db, self.commits, max_entries=3,
+                          clock=self.clock)
+        # converting a single-string Memory journals all of its keys
+        j.append(m, {"a": "1", "b": "2"}, ())
+        j.append(m, {"a": "10"}, ())
+        self.failUnlessEqual(m.get_blob(), None)
+        self.failUnlessEqual(m.get_data(), {"a": 10, "b": 2})
+        self.failUnlessEqual(m.get_raw_value("a"), "10")
+        rows = read_journal(self.db)
+        self.failUnlessEqual([(key, value_json)
+                              for (seqnum, memid_, key, value_json) in rows],
+                             [("a", "1"), ("b", "2"), ("a", "10")])
+        self.failUnlessEqual(read_journal(self.db, rows[1][0]), rows[2:])
+        j.append(m, {}, ["b"])
+        self.failUnlessEqual(m.get_keys(), ["a"])
+        self.failUnlessEqual(m.get_data(), {"a": 10})
+        # that was the fourth entry, so the Memory is folded soon
+        self.failUnlessEqual(j.get_stats()["entries"], 4)
+        self.clock.advance(0)
+        self.failUnlessEqual(j.compactions, 1)
+        self.failUnlessEqual(read_journal(self.db), [])
+        self.failUnlessEqual(m.get_data(), {"a": 10})
+        self.clock.advance(self.commits.window)
+        self.failUnlessEqual(self.commits.commits, 1)
+
+    def test_restart(self):
+        memid = create_memory(self.db, {})
+        m = Memory(self.db, memid)
+        j = MemoryJournal(self.db, self.commits, max_bytes=5,
+                          clock=self.clock)
+        j.append(m, {"a": "1234"}, ())
+        self.clock.advance(0)
+        self.failUnlessEqual(j.compactions, 0)
+        # a new MemoryJournal picks up where the old one left off
+        j = MemoryJournal(self.db, self.commits, max_bytes=5,
+                          clock=self.clock)
+        j.append(m, {"a": "5678"}, ())
+        self.clock.advance(0)
+        self.failUnlessEqual(j.compactions, 1)
+        self.failUnlessEqual(m.get_data(), {"a": 5678})
@@ -0,0 +1,40 @@
+import unittest
+import nacl
+from .. import util
+from ..keycache import SharedKeyCache
+
+def make_keypair():
+    pk, sk = nacl.crypto_box_keypair()
+    return util.to_ascii(pk, "pk0-", encoding="base32"), sk
+
+class Cache(unittest.TestCase):
+    def test_box(self):
+        vatid1, sk1 = make_keypair()
+        vatid2, sk2 = make_keypair()
+        keys1 = SharedKeyCache(sk1)
+        keys2 = SharedKeyCache(sk2)
+        nonce = "\x00"*nacl.crypto_box_NONCEBYTES
+        boxed = keys1.box(vatid2, "hello", nonce)
+        self.failUnlessEqual(keys2.open(vatid1, boxed, nonce), "hello")
+        # the precomputed key is compatible with plain crypto_box
+        pk2 = util.from_ascii(vatid2, "pk0-", encoding="base32")
+        self.failUnlessEqual(boxed, nacl.crypto_box("hello", nonce, pk2, sk1))
+        self.failUnlessEqual(keys1.get_pubkey(vatid2), pk2)
+        self.failUnlessEqual(keys1.get_stats(),
+                             {"entries": 1, "hits": 1, "misses": 1,
+                              "evictions": 0})
+
+    def test_lru(self):
+        vatid, sk = make_keypair()
+        peers = [make_keypair()[0] for i in range(3)]
+        keys = SharedKeyCache(sk, max_entries=2)
+        keys.get_shared_key(peers[0])
+        keys.get_shared_key(peers[1])
+        keys.get_shared_key(peers[0]) # now peers[1] is least-recently-used
+        keys.get_shared_key(peers[2]) # evicts peers[1]
+        self.failUnlessEqual(keys.evictions, 1)
+        keys.get_shared_key(peers[0])
+        self.failUnlessEqual((keys.hits, keys.misses), (2, 3))
+        keys.get_shared_key(peers[1])
+        self.failUnlessEqual((keys.hits, keys.misses), (2, 4))
+        self.failUnlessEqual(keys.get_stats()["entries"], 2)
@@ -1,6 +1,8 @@
 import unittest
+from StringIO import StringIO
 
-from ..netstring import make_netstring, split_netstrings
+from ..netstring import (make_netstring, split_netstrings, read_netstrings,
+                         TooLong)
 
 class Netstring(unittest.TestCase):
     def test_create(self):
@@ -16,3 +18,20 @@ class Netstring(unittest.TestCase):
     def test_leftover(self):
         self.failUnlessRaises(ValueError,
                               split_netstrings, "3:abc,extra")
+    def test_large(self):
+        big = "a"*200000
+        self.failUnlessEqual(split_netstrings(make_netstring(big)+
+                                              make_netstring("b")),
+                             [big, "b"])
+    def test_read(self):
+        f = StringIO(make_netstring("abc")+make_netstring("")+
+                     make_netstring(":,"))
+        self.failUnlessEqual(list(read_netstrings(f, 10)), ["abc", "", ":,"])
+    def test_read_limits(self):
+        def read(s, max_length=10):
+            return list(read_netstrings(StringIO(s), max_length))
+        self.failUnlessRaises(TooLong, read, make_netstring("a"*11))
+        self.failUnlessRaises(TooLong, read, "123456:abc,")
+        self.failUnlessRaises(ValueError, read, "3:abc")
+        self.failUnlessRaises(ValueError, read, "3:abc,4")
+        self.failUnlessRaises(ValueError, read, "x:abc,")
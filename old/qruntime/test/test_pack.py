@@ -6,6 +6,7 @@ from ..common import NativePower, InnerReference
 from ..memory import create_memory, Memory
 from ..urbject import create_urbject, create_power_for_memid
 from ..turn import Turn, Invocation
+from ..serialization import JSON, BINARY, to_template
 from .. import pack
 
 class _UnpackBase(ServerBase):
@@ -37,6 +38,25 @@ class UnpackPower(_UnpackBase, unittest.TestCase):
         self.failUnless(isinstance(p["ref"], InnerReference), p["ref"])
         self.failUnlessEqual(t.get_swissnum_for_object(p["ref"]), refid)
 
+    def test_rebind(self):
+        t, memid, powid, urbjid, refid = self.prepare()
+        template = {"static": {"foo": ["bar"]},
+                    "power": {"__power__": "native",
+                              "swissnum": "make_urbject"},
+                    "memory": {"__power__": "memory", "swissnum": memid},
+                    "ref": {"__power__": "reference",
+                            "swissnum": list(refid)},
+                    }
+        original = json.loads(json.dumps(template))
+        p = pack.rebind_power(t, template)
+        self.failUnlessEqual(template, original) # not modified
+        self.failUnlessEqual(p["static"], {"foo": ["bar"]})
+        self.failIf(p["static"] is template["static"])
+        self.failUnlessEqual(p["memory"], {"counter": 0})
+        self.failUnlessEqual(t.memory_data_to_memid[id(p["memory"])], memid)
+        self.failUnless(p["power"] is t.get_native_power("make_urbject"))
+        self.failUnless(p["ref"] is t.get_reference(refid))
+
     def test_bad_only_one_memory(self):
         t, memid, powid, urbjid, refid = self.prepare()
         data = {"static": {"foo": "bar"},
@@ -162,6 +182,24 @@ class PackArgs(_PackBase, unittest.TestCase):
                  }
         e = self.failUnlessRaises(ValueError, pack.pack_args, t, child)
         self.failUnlessEqual(str(e), "forbidden __power__ in serializing data")
+        # also when there is no real power to hide behind, or when it's
+        # inside an unshared Memory
+        child = {"bad": [{"__power__": "reference", "swissnum": 0}]}
+        self.failUnlessRaises(ValueError, pack.pack_args, t, child)
+        memory_data["bad"] = {u"__power__": "reference", "swissnum": 0}
+        self.failUnlessRaises(ValueError, pack.pack_args, t,
+                              {"memory": memory_data})
+
+    def test_plain(self):
+        t, native, memid, memory_data, refid, ref = self.prepare()
+        # "__power__" is only special as a key
+        child = {"name": "__power__", "list": ["__power__", '"__power__": ']}
+        packed = pack.pack_args(t, child)
+        self.failUnlessEqual(packed, json.dumps(child))
+        # and the Turn's packer is reused
+        packer = t.packers[(False, JSON)]
+        pack.pack_args(t, {"ref": ref})
+        self.failUnlessIdentical(t.packers[(False, JSON)], packer)
 
     def test_good_memory_in_args(self):
         t, native, memid, memory_data, refid, ref = self.prepare()
@@ -276,11 +314,12 @@ class PackPower(_PackBase, unittest.TestCase):
                               "ref": {"__power__": "reference",
                                       "swissnum": list(refid)},
                               })
-        mem = Memory(self.db, new_memid)
-        self.failUnlessEqual(mem.get_data(),
+        # the new Memory is only written when the turn commits
+        new_json = t._new_records[("memory", new_memid)]
+        self.failUnlessEqual(json.loads(new_json),
                              {"new-memory": {"__power__": "reference",
                                              "swissnum": list(refid)}})
-        newmem_data = pack.unpack_memory(t, mem.get_raw_data())
+        newmem_data = pack.unpack_memory(t, new_json)
         self.failUnlessEqual(newmem_data, {"new-memory": ref})
         self.failUnlessIdentical(newmem_data["new-memory"], ref)
 
@@ -294,6 +333,50 @@ class PackPower(_PackBase, unittest.TestCase):
         e = self.failUnlessRaises(ValueError, pack.pack_power, t, child)
         self.failUnlessEqual(str(e), "forbidden __power__ in serializing data")
 
+    def test_binary(self):
+        t, native, memid, memory_data, refid, ref = self.prepare()
+        t.value_format = BINARY
+        child = {"static": {"foo": "bar"},
+                 "native": native,
+                 "memory": memory_data,
+                 "ref": ref,
+                 }
+        packed = pack.pack_power(t, child)
+        self.failUnlessEqual(packed[0], chr(BINARY))
+        self.failUnlessEqual(to_template(packed),
+                             {"static": {"foo": "bar"},
+                              "native": {"__power__": "native",
+                                         "swissnum": "make_urbject"},
+                              "memory": {"__power__": "memory",
+                                         "swissnum": memid},
+                              "ref": {"__power__": "reference",
+                                      "swissnum": list(refid)},
+                              })
+        self.failUnlessEqual(pack.list_authorities(packed, False),
+                             set([("native", "make_urbject"),
+                                  ("memory", memid),
+                                  ("reference", refid)]))
+        p = pack.unpack_power(t, packed)
+        self.failUnlessIdentical(p["native"], native)
+        self.failUnlessIdentical(p["memory"], memory_data)
+        self.failUnlessIdentical(p["ref"], ref)
+        # args are always JSON
+        self.failUnlessEqual(json.loads(pack.pack_args(t, {"ref": ref})),
+                             {"ref": {"__power__": "reference",
+                                      "swissnum": list(refid)}})
+
+    def test_binary_bad_forged_power(self):
+        t, native, memid, memory_data, refid, ref = self.prepare()
+        t.value_format = BINARY
+        child = {"static": {"foo": "bar"},
+                 "ref": ref,
+                 "bad": {"__power__": "reference", "swissnum": list(refid)},
+                 }
+        e = self.failUnlessRaises(ValueError, pack.pack_power, t, child)
+        self.failUnlessEqual(str(e), "forbidden __power__ in serializing data")
+        e = self.failUnlessRaises(ValueError, pack.pack_memory, t, child)
+        self.failUnlessEqual(str(e), "forbidden __power__ in serializing data")
+
     def OFF_test_bad_native_below_top_level(self):
         # this isn't actually forbidden yet, but I might change my mind
         t, native, memid, memory_data, refid, ref = self.prepare()
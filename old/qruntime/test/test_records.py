@@ -0,0 +1,38 @@
+import sqlite3, json
+import unittest
+from ..database import get_schema
+from ..records import RecordCache
+
+class Cache(unittest.TestCase):
+    def setUp(self):
+        self.db = sqlite3.connect(":memory:")
+        self.db.executescript(get_schema(2))
+        for i in range(3):
+            self.db.execute("INSERT INTO `urbjects` VALUES (?,?,?)",
+                            ("urb%d" % i, "pow%d" % i, "x"*100))
+            self.db.execute("INSERT INTO `power` VALUES (?,?)",
+                            ("pow%d" % i, json.dumps({"n": i})))
+
+    def test_cached(self):
+        r = RecordCache(self.db)
+        self.failUnlessEqual(r.get_urbject("urb0"), ("x"*100, "pow0"))
+        self.failUnlessEqual(r.get_power_template("pow0"), {"n": 0})
+        # later lookups don't touch the db
+        self.db.execute("DELETE FROM `urbjects`")
+        self.db.execute("DELETE FROM `power`")
+        self.failUnlessEqual(r.get_urbject("urb0"), ("x"*100, "pow0"))
+        self.failUnlessEqual(r.get_power_template("pow0"), {"n": 0})
+        self.failUnlessEqual((r.hits, r.misses), (2, 2))
+        self.failUnlessRaises(KeyError, r.get_urbject, "urb1")
+
+    def test_evict(self):
+        r = RecordCache(self.db, max_bytes=250)
+        r.get_urbject("urb0")
+        r.get_urbject("urb1")
+        r.get_urbject("urb0") # now urb1 is least-recently-used
+        r.get_urbject("urb2") # evicts urb1
+        self.failUnlessEqual(r.get_stats(),
+                             {"entries": 2, "bytes": 200, "hits": 1,
+                              "misses": 3, "evictions": 1})
+        r.get_urbject("urb0")
+        self.failUnlessEqual(r.hits, 2)
@@ -0,0 +1,93 @@
+import sqlite3
+from twisted.trial import unittest
+from twisted.internet import task
+from ..database import get_schema
+from ..eventual import flushEventualQueue
+from .. import retry
+
+class Schedule(unittest.TestCase):
+    def setUp(self):
+        self.db = sqlite3.connect(":memory:")
+        self.db.executescript(get_schema(2))
+        self.clock = task.Clock()
+        self.clock.advance(1000)
+        self.attempts = []
+        self.r = retry.RetryScheduler(self.db, self.attempts.append,
+                                      self.clock)
+        self.r.startService()
+
+    def tearDown(self):
+        self.r.stopService()
+
+    def queue(self, vatid):
+        self.db.execute("INSERT INTO `outbound_messages` VALUES (?,?,?,?)",
+                        (vatid, 0, 0, ""))
+        self.db.commit()
+        self.r.message_queued(vatid)
+
+    def schedule(self):
+        c = self.db.execute("SELECT * FROM `outbound_schedule`")
+        return sorted(c.fetchall())
+
+    def test_delays(self):
+        self.failUnlessEqual([self.r.get_delay(i) for i in range(5)],
+                             [5, 5, 10, 20, 40])
+        self.failUnlessEqual(self.r.get_delay(100), retry.MAX_DELAY)
+
+    def test_backoff(self):
+        self.queue("vat1")
+        d = flushEventualQueue()
+        def _then(_):
+            # queueing a message makes an immediate attempt
+            self.failUnlessEqual(self.attempts, ["vat1"])
+            self.failUnlessEqual(self.schedule(), [("vat1", 0, 1005)])
+            self.r.delivery_failed("vat1")
+            self.failUnlessEqual(self.schedule(), [("vat1", 1, 1005)])
+            self.clock.advance(4)
+            self.failUnlessEqual(self.attempts, ["vat1"])
+            self.clock.advance(1)
+            self.failUnlessEqual(self.attempts, ["vat1", "vat1"])
+            self.r.delivery_failed("vat1")
+            self.failUnlessEqual(self.schedule(), [("vat1", 2, 1015)])
+            # a new message makes an immediate attempt, but leaves the
+            # schedule alone
+            self.queue("vat1")
+            return flushEventualQueue()
+        d.addCallback(_then)
+        def _then2(_):
+            self.failUnlessEqual(self.attempts, ["vat1"]*3)
+            self.failUnlessEqual(self.schedule(), [("vat1", 2, 1015)])
+            # an ACK resets the schedule
+            self.r.delivery_succeeded("vat1", False)
+            self.failUnlessEqual(self.schedule(), [])
+            self.clock.advance(100)
+            self.failUnlessEqual(self.attempts, ["vat1"]*3)
+        d.addCallback(_then2)
+        return d
+
+    def test_only_due_vats(self):
+        self.r.delivery_failed("vat1") # due at 1005
+        self.r.delivery_failed("vat2")
+        self.r.delivery_failed("vat2") # due at 1010
+        self.clock.advance(5)
+        self.failUnlessEqual(self.attempts, ["vat1"])
+        self.r.delivery_failed("vat1") # due at 1015
+        self.clock.advance(5)
+        self.failUnlessEqual(self.attempts, ["vat1", "vat2"])
+
+    def test_restart(self):
+        self.r.delivery_failed("vat1")
+        self.r.stopService()
+        # a restarted node picks up the schedule from the DB, and makes an
+        # immediate attempt for anything queued without a schedule
+        self.db.execute("INSERT INTO `outbound_messages` VALUES (?,?,?,?)",
+                        ("vat2", 0, 0, ""))
+        self.db.commit()
+        self.r = retry.RetryScheduler(self.db, self.attempts.append,
+                                      self.clock)
+        self.r.startService()
+        self.clock.advance(0)
+        self.failUnlessEqual(self.attempts, ["vat2"])
+        self.r.delivery_succeeded("vat2", False)
+        self.clock.advance(5)
+        self.failUnlessEqual(self.attempts, ["vat2", "vat1"])
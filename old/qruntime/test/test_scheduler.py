@@ -0,0 +1,62 @@
+import json, sqlite3
+from twisted.trial import unittest
+from ..database import get_schema
+from ..memory import create_memory
+from ..urbject import create_urbject, create_power
+from ..records import RecordCache
+from ..scheduler import predict_footprint, ConflictTracker
+
+def memory_power(memid):
+    return {"__power__": "memory", "swissnum": memid}
+
+def reference_power(vatid, urbjid):
+    return {"__power__": "reference", "swissnum": [vatid, urbjid]}
+
+class Footprint(unittest.TestCase):
+    def test_predict(self):
+        db = sqlite3.connect(":memory:")
+        db.executescript(get_schema(2))
+        def make(power):
+            powid = create_power(db, json.dumps(power))
+            return create_urbject(db, powid, "code")
+        mem1 = create_memory(db)
+        mem2 = create_memory(db)
+        mem3 = create_memory(db)
+        leaf = make({"memory": memory_power(mem3)})
+        middle = make({"memory": memory_power(mem2),
+                       "leaf": reference_power("vat1", leaf),
+                       "remote": reference_power("vat2", "urb0-remote")})
+        top = make({"memory": memory_power(mem1),
+                    "others": [reference_power("vat1", middle)]})
+        records = RecordCache(db)
+        self.failUnlessEqual(predict_footprint(records, "vat1", leaf),
+                             set([mem3]))
+        self.failUnlessEqual(predict_footprint(records, "vat1", top),
+                             set([mem1, mem2, mem3]))
+        self.failUnlessEqual(predict_footprint(records, "vat1", top, 1),
+                             set([mem1, mem2]))
+        # references to other vats are not followed
+        self.failUnlessEqual(predict_footprint(records, "vat2", middle),
+                             set([mem2]))
+        self.failUnlessEqual(predict_footprint(records, "vat1", "urb0-nope"),
+                             set())
+
+    def test_conflicts(self):
+        t = ConflictTracker()
+        t.start(1, set(["m1"]))
+        t.start(2, set(["m2"]))
+        self.failUnlessEqual(t.running(), 2)
+        self.failUnless(t.overlaps(set(["m1", "m3"])))
+        self.failIf(t.overlaps(set(["m3"])))
+        # 2 finishes first, having changed m2
+        self.failIf(t.conflicted(2, ["m2"]))
+        t.applied(["m2"])
+        t.finished(2)
+        # 1 didn't predict it, but read m2 too, so it must run again
+        self.failUnless(t.conflicted(1, ["m1", "m2"]))
+        self.failUnlessEqual(t.conflicts, 1)
+        t.start(1, set(["m1"]))
+        self.failIf(t.conflicted(1, ["m1", "m2"]))
+        t.applied(["m1"])
+        t.finished(1)
+        self.failUnlessEqual(t.running(), 0)
@@ -0,0 +1,114 @@
+import json, sqlite3
+from twisted.trial import unittest
+from ..database import get_schema
+from ..memory import create_raw_memory, Memory
+from ..serialization import (JSON, BINARY, PowerRef, get_format,
+                             encode_binary, decode_binary, to_template,
+                             to_json, to_db, from_db, to_text, from_text,
+                             same_packed, dumps_message)
+
+def no_default(obj):
+    raise TypeError(repr(obj))
+
+class Binary(unittest.TestCase):
+    def roundtrip(self, value):
+        packed = encode_binary(value, no_default)
+        self.failUnlessEqual(get_format(packed), BINARY)
+        return decode_binary(packed)
+
+    def test_values(self):
+        for value in [None, True, False, 0, 1, -1, 63, 64, -65, 2**70,
+                      -2**70, 0.0, 1.5, -1e300, u"", u"abc", u"\u2603",
+                      [], [1, [2, [3]]], {}, {u"a": {u"b": [None]}}]:
+            self.failUnlessEqual(self.roundtrip(value), value)
+            self.failUnlessEqual(type(self.roundtrip(value)), type(value))
+
+    def test_like_json(self):
+        # the same plain data as a JSON roundtrip
+        value = {"str": "abc", "tuple": (1, 2), 1: "int key",
+                 None: "null key", "nested": {"list": ["x", ("y",)]}}
+        self.failUnlessEqual(self.roundtrip(value),
+                             json.loads(json.dumps(value)))
+
+    def test_powers(self):
+        packed = encode_binary({"ref": PowerRef("reference", ("vat", "urb")),
+                                "memory": PowerRef("memory", "mem0-1")},
+                               no_default)
+        self.failUnlessEqual(to_template(packed),
+                             {"ref": {"__power__": "reference",
+                                      "swissnum": ["vat", "urb"]},
+                              "memory": {"__power__": "memory",
+                                         "swissnum": "mem0-1"}})
+
+    def test_default(self):
+        class Thing:
+            pass
+        thing = Thing()
+        def default(obj):
+            self.failUnlessIdentical(obj, thing)
+            return PowerRef("native", "thing")
+        packed = encode_binary([thing], default)
+        self.failUnlessEqual(to_template(packed),
+                             [{"__power__": "native", "swissnum": "thing"}])
+        self.failUnlessRaises(TypeError, encode_binary, [thing], no_default)
+
+    def test_bad(self):
+        e = self.failUnlessRaises(ValueError, encode_binary,
+                                  {"a": {"__power__": "memory"}}, no_default)
+        self.failUnlessEqual(str(e), "forbidden __power__ in serializing data")
+        loop = []
+        loop.append(loop)
+        e = self.failUnlessRaises(ValueError, encode_binary, loop, no_default)
+        self.failUnlessEqual(str(e), "Circular reference detected")
+        self.failUnlessRaises(UnicodeDecodeError, encode_binary, "\xff",
+                              no_default)
+        packed = encode_binary({"a": [1, 2]}, no_default)
+        e = self.failUnlessRaises(ValueError, decode_binary, packed[:-1])
+        self.failUnlessEqual(str(e), "truncated value")
+        e = self.failUnlessRaises(ValueError, decode_binary, packed + "N")
+        self.failUnlessEqual(str(e), "trailing data")
+
+class Formats(unittest.TestCase):
+    def test_format(self):
+        packed = encode_binary({"a": 1}, no_default)
+        self.failUnlessEqual(get_format('{"a": 1}'), JSON)
+        self.failUnlessEqual(get_format(u'{"a": 1}'), JSON)
+        self.failUnlessEqual(to_template('{"a": 1}'), {"a": 1})
+        self.failUnlessEqual(to_json(packed), '{"a": 1}')
+        self.failUnlessEqual(to_json('{"a": 1}'), '{"a": 1}')
+        self.failUnlessEqual(from_text(to_text(packed)), packed)
+        self.failUnlessEqual(to_text('{"a": 1}'), '{"a": 1}')
+        self.failUnless(same_packed(u'{"a": 1}', '{"a": 1}'))
+        self.failIf(same_packed(packed, u'{"a": 1}'))
+        # JSON may start with whitespace, which is below 0x20 too
+        text = u'\n\t{"a": 1}\n'
+        self.failUnlessEqual(get_format(text), JSON)
+        self.failUnlessEqual(to_db(text), text)
+        self.failUnlessEqual(to_template(to_db(text)), {"a": 1})
+        # an unknown tag isn't JSON either
+        self.failUnlessRaises(ValueError, to_template, "\x1f")
+
+    def test_db(self):
+        db = sqlite3.connect(":memory:")
+        db.executescript(get_schema(2))
+        packed = encode_binary({"a": u"\u2603", "b": [1.5]}, no_default)
+        memid = create_raw_memory(db, packed)
+        m = Memory(db, memid)
+        self.failUnlessEqual(m.get_blob(), packed)
+        self.failUnlessEqual(m.get_data(), {"a": u"\u2603", "b": [1.5]})
+        # keys may be in different formats
+        m.save_keys({"a": encode_binary(2, no_default), "b": "3"}, ())
+        self.failUnlessEqual(m.get_raw_value("a"),
+                             encode_binary(2, no_default))
+        self.failUnlessEqual(m.get_data(), {"a": 2, "b": 3})
+        self.failUnlessEqual(from_db(to_db("3")), "3")
+
+    def test_dumps_message(self):
+        msg = {"command": "invoke", "urbjid": "urb0-1",
+               "args_json": '{"x": [1, 2]}'}
+        self.failUnlessEqual(json.loads(dumps_message(msg)),
+                             {"command": "invoke", "urbjid": "urb0-1",
+                              "args": {"x": [1, 2]}})
+        self.failUnless("args_json" in msg) # not modified
+        msg = {"command": "invoke", "args": {"x": 1}}
+        self.failUnlessEqual(dumps_message(msg), json.dumps(msg))
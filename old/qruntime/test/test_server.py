@@ -1,11 +1,17 @@
 
-import json
+import os, json
+import nacl
 from twisted.trial import unittest
+from twisted.web import error
 from .common import ServerBase, TwoServerBase
 from .pollmixin import PollMixin
-from ..util import make_spid
+from ..util import make_spid, to_ascii
+from ..netstring import make_netstring, TooLong
 from ..memory import create_memory, Memory
-from ..urbject import create_urbject, create_power_for_memid
+from ..urbject import create_urbject, create_power, create_power_for_memid
+from ..outbound import MessageTooLarge, BadVatid
+from ..promise import get_promise, BROKEN
+from ..workers import TurnFailed
 
 
 F1 = """
@@ -45,6 +51,12 @@ def call(args, power):
     args['callback'].sendOnly({'response': 34})
 """
 
+F5 = """
+def call(args, power):
+    power['memory']['congested'] = args['ref'].congested()
+    args['ref'].sendOnly({'foo': 1})
+"""
+
 
 class Local(ServerBase, PollMixin, unittest.TestCase):
 
@@ -98,6 +110,169 @@ class Local(ServerBase, PollMixin, unittest.TestCase):
         d.addCallback(_then)
         return d
 
+    def test_loopback_queue(self):
+        memid = create_memory(self.db)
+        powid = create_power_for_memid(self.db, memid)
+        urbjid = create_urbject(self.db, powid, F1)
+        msg = {"command": "invoke",
+               "urbjid": urbjid,
+               "args_json": json.dumps({"foo": 123}),
+               }
+        # local sends are queued in RAM, and written (but not committed)
+        # alongside the turn that made them
+        self.executor.send_message(self.server.vatid, msg)
+        self.failUnlessEqual(list(self.server.loopback_queue), [(0, msg)])
+        self.db.commit()
+        # a restarted server reloads them from the DB
+        self.server.load_loopback_queue()
+        self.failUnlessEqual(list(self.server.loopback_queue), [(0, msg)])
+        d = self.poll(lambda: self.executor._debug_processed_counter >= 1)
+        def _then(ign):
+            m = Memory(self.db, memid)
+            self.failUnlessEqual(m.get_data()["argfoo"], 123)
+            self.failUnlessEqual(list(self.server.loopback_queue), [])
+            c = self.db.execute("SELECT * FROM `inbound_messages`")
+            self.failUnlessEqual(c.fetchall(), [])
+        d.addCallback(_then)
+        return d
+
+    def test_congestion(self):
+        # a peer with no URLs never ACKs anything
+        pk, sk = nacl.crypto_box_keypair()
+        peer = to_ascii(pk, "pk0-", encoding="base32")
+        self.server.max_queued_messages = 2
+        self.server.send_message(peer, json.dumps({"command": "x"}))
+        self.failIf(self.server.is_congested(peer))
+        self.server.send_message(peer, json.dumps({"command": "x"}))
+        self.failUnless(self.server.is_congested(peer))
+
+        memid = create_memory(self.db)
+        powid = create_power_for_memid(self.db, memid)
+        urbjid = create_urbject(self.db, powid, F5)
+        args = {"ref": {"__power__": "reference",
+                        "swissnum": (peer, "urbjid")}}
+        msg = {"command": "invoke",
+               "urbjid": urbjid,
+               "args_json": json.dumps(args),
+               }
+        self.server.send_message(self.server.vatid, json.dumps(msg))
+        # later loopback messages are not held up by it
+        memid2 = create_memory(self.db)
+        powid2 = create_power_for_memid(self.db, memid2)
+        urbjid2 = create_urbject(self.db, powid2, F1)
+        msg2 = {"command": "invoke",
+                "urbjid": urbjid2,
+                "args_json": json.dumps({"foo": 2}),
+                }
+        self.server.send_message(self.server.vatid, json.dumps(msg2))
+        d = self.poll(lambda: not self.server.loopback_queue)
+        def _then(ign):
+            # the turn was deferred: it remains in the DB, and changed
+            # nothing
+            self.failUnlessEqual(self.server.blocked_senders, {})
+            self.failUnlessEqual(self.server.congested_loopback.keys(),
+                                 [peer])
+            self.failUnlessEqual(Memory(self.db, memid).get_data(), {})
+            self.failUnlessEqual(Memory(self.db, memid2).get_data(),
+                                 {"argfoo": 2})
+            c = self.db.execute("SELECT COUNT(*) FROM `outbound_messages`")
+            self.failUnlessEqual(c.fetchone()[0], 2)
+            c = self.db.execute("SELECT COUNT(*) FROM `inbound_messages`")
+            self.failUnlessEqual(c.fetchone()[0], 1)
+            # once the peer catches up, the turn runs
+            self.db.execute("DELETE FROM `outbound_messages`")
+            self.db.commit()
+            self.server.get_sender(peer).messages_acked()
+            self.failIf(self.server.is_congested(peer))
+            return self.poll(lambda: not self.server.loopback_queue)
+        d.addCallback(_then)
+        def _then2(ign):
+            self.failUnlessEqual(self.server.congested_loopback, {})
+            m = Memory(self.db, memid)
+            self.failUnlessEqual(m.get_data()["congested"], False)
+            c = self.db.execute("SELECT COUNT(*) FROM `outbound_messages`")
+            self.failUnlessEqual(c.fetchone()[0], 1)
+        d.addCallback(_then2)
+        return d
+
+    def test_too_large_to_send(self):
+        pk, sk = nacl.crypto_box_keypair()
+        peer = to_ascii(pk, "pk0-", encoding="base32")
+        self.server.max_message_size = 100
+        # the peer would refuse it on every retry, so it is never queued
+        self.failUnlessRaises(MessageTooLarge, self.server.send_message,
+                              peer, json.dumps({"command": "x"}))
+        memid = create_memory(self.db)
+        powid = create_power_for_memid(self.db, memid)
+        urbjid = create_urbject(self.db, powid, F5)
+        args = {"ref": {"__power__": "reference",
+                        "swissnum": (peer, "urbjid")}}
+        self.executor.process_request({"command": "invoke",
+                                       "urbjid": urbjid,
+                                       "args_json": json.dumps(args),
+                                       "result": "prm0-r",
+                                       "reply_to": self.server.vatid},
+                                      self.server.vatid)
+        self.failUnlessEqual(len(self.flushLoggedErrors(MessageTooLarge)), 1)
+        # the turn failed before writing anything, and broke its promise
+        self.failUnlessEqual(Memory(self.db, memid).get_data(), {})
+        c = self.db.execute("SELECT COUNT(*) FROM `outbound_messages`")
+        self.failUnlessEqual(c.fetchone()[0], 0)
+        self.failUnlessEqual(get_promise(self.db, "prm0-r")[1], BROKEN)
+
+    def test_bad_vatids(self):
+        memid = create_memory(self.db)
+        powid = create_power_for_memid(self.db, memid)
+        urbjid = create_urbject(self.db, powid, F1)
+        # with a reply_to that isn't a vatid, the message is dropped before
+        # it runs, however often it is delivered
+        for foo in range(2):
+            self.executor.process_request({"command": "invoke",
+                                           "urbjid": urbjid,
+                                           "args_json": json.dumps({"foo":
+                                                                    foo}),
+                                           "result": "prm0-r",
+                                           "reply_to": "bogus"},
+                                          "pk0-sender")
+        self.failUnlessEqual(Memory(self.db, memid).get_data(), {})
+        self.failUnlessEqual(get_promise(self.db, "prm0-r"), None)
+        # a turn that sends to a bogus vat fails before writing anything
+        memid2 = create_memory(self.db)
+        powid2 = create_power_for_memid(self.db, memid2)
+        urbjid2 = create_urbject(self.db, powid2, F5)
+        args = {"ref": {"__power__": "reference",
+                        "swissnum": ("pk0-bogus", "urbjid")}}
+        self.executor.process_request({"command": "invoke",
+                                       "urbjid": urbjid2,
+                                       "args_json": json.dumps(args)},
+                                      self.server.vatid)
+        self.failUnlessEqual(Memory(self.db, memid2).get_data(), {})
+        c = self.db.execute("SELECT COUNT(*) FROM `outbound_messages`")
+        self.failUnlessEqual(c.fetchone()[0], 0)
+        self.failUnlessRaises(BadVatid, self.server.send_message,
+                              "pk0-bogus", json.dumps({"command": "x"}))
+
+    def test_drain_in_batches(self):
+        memid = create_memory(self.db)
+        powid = create_power_for_memid(self.db, memid)
+        urbjid = create_urbject(self.db, powid, F1)
+        self.server.inbound_batch_size = 2
+        for foo in range(5):
+            msg = {"command": "invoke",
+                   "urbjid": urbjid,
+                   "args_json": json.dumps({"foo": foo}),
+                   }
+            self.server.send_message(self.server.vatid, json.dumps(msg))
+        d = self.poll(lambda: self.executor._debug_processed_counter >= 5)
+        def _then(ign):
+            # they must be processed in order
+            m = Memory(self.db, memid)
+            self.failUnlessEqual(m.get_data()["argfoo"], 4)
+            c = self.db.execute("SELECT * FROM `inbound_messages`")
+            self.failUnlessEqual(c.fetchall(), [])
+        d.addCallback(_then)
+        return d
+
     def test_sendonly_from_sandbox(self):
         memid_1 = create_memory(self.db)
         powid_1 = create_power_for_memid(self.db, memid_1)
@@ -147,6 +322,110 @@ class Local(ServerBase, PollMixin, unittest.TestCase):
         d.addCallback(_then)
         return d
 
+F6 = """
+def call(args, power):
+    raise ValueError("nope")
+"""
+
+F7 = """
+def call(args, power):
+    power['memory']['log'] = power['memory']['log'] + [args['entry']]
+"""
+
+F7a = """
+def call(args, power):
+    power['memory']['appender'].call(args)
+"""
+
+class Workers(ServerBase, PollMixin, unittest.TestCase):
+    _poll_should_ignore_these_errors = [TurnFailed]
+
+    def setUp(self):
+        ServerBase.setUp(self)
+        self.executor.use_workers(2, os.path.join(self.basedir, "control.db"))
+        self.executor.pool.start()
+
+    def inject(self, from_vatid, msgnum, urbjid, args):
+        msg = {"command": "invoke",
+               "urbjid": urbjid,
+               "args_json": json.dumps(args),
+               }
+        self.db.execute("INSERT INTO `inbound_messages` VALUES (?,?,?)",
+                        (from_vatid, msgnum, json.dumps(msg)))
+        self.db.commit()
+
+    def test_failed_turn(self):
+        memid = create_memory(self.db)
+        powid = create_power_for_memid(self.db, memid)
+        bad_urbjid = create_urbject(self.db, powid, F6)
+        memid2 = create_memory(self.db)
+        powid2 = create_power_for_memid(self.db, memid2)
+        urbjid2 = create_urbject(self.db, powid2, F1)
+        self.inject("pk0-a", 0, bad_urbjid, {})
+        self.inject("pk0-a", 1, urbjid2, {"foo": 1})
+        self.inject("pk0-b", 0, urbjid2, {"foo": 2})
+        self.server.trigger_inbound()
+        # the failed turn is retired, and both senders carry on without
+        # waiting for another message to arrive
+        def _done():
+            c = self.db.execute("SELECT COUNT(*) FROM `inbound_messages`")
+            return c.fetchone()[0] == 0
+        d = self.poll(_done)
+        def _then(ign):
+            self.failUnlessEqual(len(self.flushLoggedErrors(TurnFailed)), 1)
+            self.failUnlessEqual(self.server.inbound_running, {})
+            self.failUnlessEqual(self.server.blocked_senders, {})
+            self.failUnlessEqual(Memory(self.db, memid).get_data(), {})
+            self.failUnless(Memory(self.db, memid2).get_data()["argfoo"]
+                            in (1, 2))
+        d.addCallback(_then)
+        return d
+
+    def test_shared_memory(self):
+        vatid = self.server.vatid
+        def make(power, code):
+            powid = create_power(self.db, json.dumps(power))
+            return create_urbject(self.db, powid, code)
+        shared = create_memory(self.db, {"log": []})
+        appender = make({"memory": {"__power__": "memory",
+                                    "swissnum": shared}}, F7)
+        # this one reaches the shared Memory through a reference kept in
+        # its own Memory, which predict_footprint() can't see
+        private = create_memory(self.db,
+                                {"appender": {"__power__": "reference",
+                                              "swissnum": [vatid, appender]}})
+        indirect = make({"memory": {"__power__": "memory",
+                                    "swissnum": private}}, F7a)
+        memid = create_memory(self.db)
+        powid = create_power_for_memid(self.db, memid)
+        other = create_urbject(self.db, powid, F1)
+        for i in range(3):
+            self.inject("pk0-a", i, indirect, {"entry": ["a", i]})
+            self.inject("pk0-b", i, appender, {"entry": ["b", i]})
+            self.inject("pk0-c", i, appender, {"entry": ["c", i]})
+            self.inject("pk0-d", i, other, {"foo": i})
+        # a0 and b0 start together. c0 would touch the same Memory as b0,
+        # so it is held, and d0 waits for a free worker. Whichever of a0
+        # and b0 finishes second saw the shared Memory before the other
+        # changed it, so it must run again.
+        self.server.trigger_inbound()
+        def _done():
+            c = self.db.execute("SELECT COUNT(*) FROM `inbound_messages`")
+            return c.fetchone()[0] == 0
+        d = self.poll(_done)
+        def _then(ign):
+            log = Memory(self.db, shared).get_data()["log"]
+            # nothing was lost, and each sender's turns ran in order
+            self.failUnlessEqual(len(log), 9)
+            for sender in "abc":
+                self.failUnlessEqual([i for (s, i) in log if s == sender],
+                                     [0, 1, 2])
+            self.failUnless(self.executor.tracker.conflicts >= 1)
+            self.failUnlessEqual(Memory(self.db, memid).get_data()["argfoo"],
+                                 2)
+        d.addCallback(_then)
+        return d
+
 class Remote(TwoServerBase, PollMixin, unittest.TestCase):
 
     def test_basic(self):
@@ -181,6 +460,185 @@ class Remote(TwoServerBase, PollMixin, unittest.TestCase):
         d.addCallback(_then2)
         return d
 
+    def test_batch(self):
+        memid = create_memory(self.db)
+        powid = create_power_for_memid(self.db, memid)
+        urbjid = create_urbject(self.db, powid, F1)
+
+        # queue several messages before the outbound queue gets a chance to
+        # run: they should all be delivered in a single batch
+        for foo in [1, 2, 3]:
+            msg = {"command": "invoke",
+                   "urbjid": urbjid,
+                   "args_json": json.dumps({"foo": foo}),
+                   }
+            self.server2.send_message(self.server.vatid, json.dumps(msg))
+        d = self.poll(lambda: self.executor._debug_processed_counter >= 3)
+        def _then(ign):
+            m = Memory(self.db, memid)
+            self.failUnlessEqual(m.get_data()["argfoo"], 3)
+            # and all three should be retired from the outbound queue
+            return self.poll(lambda: not self.db2.execute(
+                "SELECT * FROM `outbound_messages`").fetchall())
+        d.addCallback(_then)
+        return d
+
+    def test_out_of_order(self):
+        memid = create_memory(self.db)
+        powid = create_power_for_memid(self.db, memid)
+        urbjid = create_urbject(self.db, powid, F1)
+        # we deliver these by hand, so server2 must not send them itself
+        self.db2.execute("DELETE FROM `vat_urls` WHERE `vatid`=?",
+                         (self.server.vatid,))
+        self.db2.commit()
+        for foo in [1, 2]:
+            msg = {"command": "invoke",
+                   "urbjid": urbjid,
+                   "args_json": json.dumps({"foo": foo}),
+                   }
+            self.server2.send_message(self.server.vatid, json.dumps(msg))
+        def outbound():
+            c = self.db2.execute("SELECT `msgnum`, `message`"
+                                 " FROM `outbound_messages`"
+                                 " ORDER BY `msgnum`")
+            return [(msgnum, str(boxed)) for (msgnum, boxed) in c.fetchall()]
+        boxed = [boxed_msg for (msgnum, boxed_msg) in outbound()]
+        # deliver the second message first: it is held, and selectively
+        # ACKed
+        d = self.server.inbound_message(boxed[1])
+        def _then(resp):
+            self.server2._outbound_response(make_netstring(resp),
+                                            self.server.vatid, [0, 1])
+            self.failUnlessEqual([msgnum for (msgnum, _) in outbound()], [0])
+            # delivering the first one fills the gap, and ACKs both
+            return self.server.inbound_message(boxed[0])
+        d.addCallback(_then)
+        def _then2(resp):
+            self.server2._outbound_response(make_netstring(resp),
+                                            self.server.vatid, [0, 1])
+            self.failUnlessEqual(outbound(), [])
+            return self.poll(lambda:
+                             self.executor._debug_processed_counter >= 2)
+        d.addCallback(_then2)
+        def _then3(ign):
+            m = Memory(self.db, memid)
+            self.failUnlessEqual(m.get_data()["argfoo"], 2)
+        d.addCallback(_then3)
+        return d
+
+    def test_formats(self):
+        nonce = self.server2.number_to_nonce(0)
+        # we send v1, with a fixed-size binary header
+        v1 = self.server2.build_message("v1", self.server.vatid, nonce, "hi")
+        self.failUnless(v1.startswith("v1\x00"+self.server2.pubkey+nonce))
+        # but accept both
+        v0 = self.server2.build_message("v0", self.server.vatid, nonce, "hi")
+        self.failUnless(v0.startswith("v0,"+str(self.server2.vatid)+","))
+        for boxed, version in [(v1, "v1"), (v0, "v0")]:
+            parsed = self.server.parse_message(boxed)
+            self.failUnlessEqual(parsed[:3],
+                                 (version, self.server2.vatid, nonce))
+            self.failUnlessEqual(self.server.keys.open(self.server2.vatid,
+                                                       parsed[3], nonce),
+                                 "hi")
+        # and responses use the request's format
+        ack = self.server.make_ack(self.server2.vatid, 0, "v0")
+        self.failUnless(ack.startswith("v0,"))
+        ack = self.server.make_ack(self.server2.vatid, 0, "v1")
+        self.failUnless(ack.startswith("v1\x00"))
+
+    def test_v0(self):
+        # an older peer sends us a v0 message, and gets a v0 ACK back
+        memid = create_memory(self.db)
+        powid = create_power_for_memid(self.db, memid)
+        urbjid = create_urbject(self.db, powid, F1)
+        msg = {"command": "invoke",
+               "urbjid": urbjid,
+               "args_json": json.dumps({"foo": 1}),
+               }
+        if self.server.vatid < self.server2.vatid:
+            offset = 0
+        else:
+            offset = 2
+        nonce = self.server2.number_to_nonce(offset)
+        v0 = self.server2.build_message("v0", self.server.vatid, nonce,
+                                        json.dumps(msg))
+        d = self.server.inbound_envelope(v0)
+        def _then(resp):
+            (version, vatid, r_nonce, encbody,
+             codec) = self.server2.parse_message(resp)
+            self.failUnlessEqual((version, vatid), ("v0", self.server.vatid))
+            ack = json.loads(self.server2.keys.open(self.server.vatid,
+                                                    encbody, r_nonce))
+            self.failUnlessEqual(ack["ack"], 1)
+            return self.poll(lambda:
+                             self.executor._debug_processed_counter >= 1)
+        d.addCallback(_then)
+        def _then2(ign):
+            m = Memory(self.db, memid)
+            self.failUnlessEqual(m.get_data()["argfoo"], 1)
+        d.addCallback(_then2)
+        return d
+
+    def test_compression(self):
+        memid = create_memory(self.db)
+        powid = create_power_for_memid(self.db, memid)
+        urbjid = create_urbject(self.db, powid, F1)
+        def send(foo):
+            msg = {"command": "invoke",
+                   "urbjid": urbjid,
+                   "args_json": json.dumps({"foo": foo}),
+                   }
+            self.server2.send_message(self.server.vatid, json.dumps(msg))
+        def last_flags():
+            c = self.db2.execute("SELECT `message` FROM `outbound_messages`"
+                                 " ORDER BY `msgnum` DESC LIMIT 1")
+            return ord(str(c.fetchone()[0])[2])
+        big = "spam"*1000
+        # nothing is compressed until the peer has advertised a codec
+        send(big)
+        self.failUnlessEqual(last_flags(), 0)
+        d = self.poll(lambda: self.executor._debug_processed_counter >= 1)
+        def _then(ign):
+            codecs = self.server2.peer_codecs[self.server.vatid]
+            self.failUnless("zlib" in codecs, codecs)
+            send("small")
+            self.failUnlessEqual(last_flags(), 0)
+            send(big+"eggs")
+            self.failIfEqual(last_flags(), 0)
+            return self.poll(lambda:
+                             self.executor._debug_processed_counter >= 3)
+        d.addCallback(_then)
+        def _then2(ign):
+            m = Memory(self.db, memid)
+            self.failUnlessEqual(m.get_data()["argfoo"], big+"eggs")
+        d.addCallback(_then2)
+        return d
+
+    def test_too_large(self):
+        nonce = self.server2.number_to_nonce(0)
+        boxed = self.server2.build_message("v1", self.server.vatid, nonce,
+                                           "x"*100)
+        self.server.max_message_size = 100
+        self.failUnlessRaises(TooLong, self.server.inbound_envelope, boxed)
+        # inside an envelope, oversized messages are rejected before we read
+        # them
+        self.failUnlessRaises(TooLong, self.server.inbound_envelope,
+                              make_netstring(boxed))
+        # and the peer is told why
+        url = "http://localhost:%d/messages" % self.node._debug_webport
+        d = self.server2.client.post(url, make_netstring(boxed))
+        d = self.assertFailure(d, error.Error)
+        def _then(e):
+            self.failUnlessEqual(e.status, "413")
+            d2 = self.server2.client.post(url, "x:abc,")
+            return self.assertFailure(d2, error.Error)
+        d.addCallback(_then)
+        def _then2(e):
+            self.failUnlessEqual(e.status, "400")
+        d.addCallback(_then2)
+        return d
+
     def test_callback(self):
         # create F4 in server1, and F4b in server2, then invoke F4. F4 will
         # create F4a as a callback handler, then send a message (containing a
@@ -3,9 +3,13 @@ import json
 from twisted.trial import unittest
 from .common import ServerBase
 from ..memory import create_memory, Memory
-from ..urbject import create_urbject, create_power_for_memid, Urbject
+from ..urbject import (create_urbject, create_power,
+                       create_power_for_memid, Urbject)
 from ..pack import list_authorities
 from ..turn import Turn
+from ..budget import Budget, BudgetExceeded, Meter
+from ..records import RecordCache
+from .. import promise
 
 F1 = """
 def call(args, power):
@@ -119,6 +123,91 @@ def call(args, power):
     assert power['memory']['counter'] == 10, power['memory']['counter']
 """ % F8a
 
+F9 = """
+F9a = '''
+def call(args, power):
+    power['make_urbject']("def call(args, power): pass", power)
+    raise ValueError("nope")
+'''
+
+def call(args, power):
+    u2 = power['make_urbject'](F9a, add(power, {'memory': {}}))
+    try:
+        u2.call({})
+    except ValueError:
+        power['memory']['caught'] = True
+    if args.get('fail'):
+        raise ValueError("turn failed")
+"""
+
+F10 = """
+def call(args, power):
+    power['memory']['counter'] += 1
+    if args.get('drop'):
+        del power['memory']['big']
+"""
+
+F11 = """
+def call(args, power):
+    power['memory']['counter'] = 1
+    power['make_urbject']("def call(args, power): pass", power)
+    while True:
+        try:
+            pass
+        except Exception:
+            pass
+"""
+
+F12 = """
+def call(args, power):
+    return {"doubled": args["x"] * 2}
+"""
+
+F13 = """
+def call(args, power):
+    return power['next']
+"""
+
+F14 = """
+def call(args, power):
+    m = power['memory']
+    if args.get('go'):
+        # pipelined: q is sent before p is resolved
+        m['p'] = power['next'].send({})
+        m['q'] = m['p'].send({"x": 21})
+        m['data'] = m['q'].send({})
+        m['early'] = m['q'].is_resolved()
+    else:
+        m['result'] = m['q'].get_result()
+        try:
+            m['data'].get_result()
+        except ValueError, e:
+            m['broken'] = str(e)
+"""
+
+F15 = """
+def call(args, power):
+    m = power['memory']
+    if args.get('go'):
+        m['p'] = power['next'].send({})
+    else:
+        try:
+            m['p'].get_result()
+        except ValueError, e:
+            m['broken'] = str(e)
+"""
+
+F16 = """
+def call(args, power):
+    raise ValueError('oops')
+"""
+
+F17 = """
+def call(args, power):
+    power['memory']['ran'] = True
+    return 'forged'
+"""
+
 class Test(ServerBase, unittest.TestCase):
 
     def test_basic(self):
@@ -213,6 +302,28 @@ class Test(ServerBase, unittest.TestCase):
         self.failUnlessEqual(m.get_data()["counter"], 18)
         self.failUnlessEqual(m.get_data()["rc"], 20)
 
+    def count_rows(self):
+        return [self.db.execute("SELECT COUNT(*) FROM `%s`" % table)
+                .fetchone()[0]
+                for table in ("urbjects", "power", "memory")]
+
+    def test_call_rollback(self):
+        memid = create_memory(self.db, {})
+        powid = create_power_for_memid(self.db, memid, grant_make_urbject=True)
+        urbjid = create_urbject(self.db, powid, F9)
+        before = self.count_rows()
+        self.invoke_urbjid(urbjid, "{}")
+        # the failed nested call's urbject was rolled back, but u2 (and its
+        # power and memory) remain
+        after = self.count_rows()
+        self.failUnlessEqual(after, [n+1 for n in before])
+        self.failUnlessEqual(Memory(self.db, memid).get_data(),
+                             {"caught": True})
+        # and a failed turn leaves nothing behind at all
+        self.failUnlessRaises(ValueError,
+                              self.invoke_urbjid, urbjid, '{"fail": true}')
+        self.failUnlessEqual(self.count_rows(), after)
+
     def test_call_no_shared_memory(self):
         memid = create_memory(self.db, {"counter": 0})
         powid = create_power_for_memid(self.db, memid, grant_make_urbject=True)
@@ -262,3 +373,203 @@ class Test(ServerBase, unittest.TestCase):
         self.failIf(a6)
         # TODO: way to much boilerplate. Needs to to be simpler. This test
         # should drive the API for Memory, Power, etc
+
+    def test_clean_memory(self):
+        memid = create_memory(self.db, {"counter": 0})
+        powid = create_power_for_memid(self.db, memid)
+        urbjid = create_urbject(self.db, powid, F4)
+        t = self.invoke_urbjid(urbjid, "{}", debug=lambda msg: None)
+        # F4 only reads its memory, so nothing was written
+        report = t.get_report()
+        self.failUnlessEqual(report["memories_loaded"], 1)
+        self.failUnlessEqual(report["memories_written"], 0)
+        self.failUnlessEqual(report["bytes_written"], 0)
+
+        urbjid = create_urbject(self.db, powid, F2)
+        t = self.invoke_urbjid(urbjid, '{"delta": 1}')
+        report = t.get_report()
+        self.failUnlessEqual(report["memories_written"], 1)
+        self.failUnlessEqual(report["bytes_written"], len("1"))
+
+    def test_memory_keys(self):
+        big = dict([("k%d" % i, i) for i in range(100)])
+        memid = create_memory(self.db, {"counter": 0, "big": big})
+        powid = create_power_for_memid(self.db, memid)
+        urbjid = create_urbject(self.db, powid, F10)
+        m = Memory(self.db, memid)
+        # the first change converts the Memory to one row per key
+        t = self.invoke_urbjid(urbjid, "{}")
+        self.failUnlessEqual(m.get_blob(), None)
+        self.failUnlessEqual(sorted(m.get_keys()), ["big", "counter"])
+        self.failUnlessEqual(m.get_data(), {"counter": 1, "big": big})
+        # after that, untouched keys are neither loaded nor written
+        t = self.invoke_urbjid(urbjid, "{}")
+        data = t.get_memory(memid)
+        self.failUnlessEqual([key for (key, value, value_json)
+                              in data.get_touched()], ["counter"])
+        self.failUnlessEqual(t.get_report()["bytes_written"], len("2"))
+        self.failUnlessEqual(m.get_data(), {"counter": 2, "big": big})
+        t = self.invoke_urbjid(urbjid, '{"drop": true}')
+        self.failUnlessEqual(m.get_keys(), ["counter"])
+        self.failUnlessEqual(m.get_raw_data(), '{"counter": 3}')
+
+    def test_budget(self):
+        memid = create_memory(self.db, {"counter": 0})
+        powid = create_power_for_memid(self.db, memid, grant_make_urbject=True)
+        before = self.count_rows()
+        t = self._make_turn()
+        self.failUnlessRaises(BudgetExceeded, t.start_turn, F11, powid, "{}",
+                              "from_vatid", budget=Budget(cpu_limit=0.05))
+        # the runaway turn was stopped, and left nothing behind
+        self.failUnless(t.meter.exceeded.startswith("cpu time"))
+        self.failUnlessEqual(self.count_rows(), before)
+        self.failUnlessEqual(Memory(self.db, memid).get_data(),
+                             {"counter": 0})
+
+    def test_caches_hold_meter(self):
+        # a budget tick must not interrupt the caches that every turn shares
+        held = []
+        class Records(RecordCache):
+            def _get(self, key):
+                held.append(t.meter._held)
+                return RecordCache._get(self, key)
+        urbjid = create_urbject(self.db, create_power(self.db, "{}"), F12)
+        t = Turn(self.server, self.db, Records(self.db))
+        t.meter = Meter(Budget())
+        code, powid = t.get_code_and_powid(urbjid)
+        t.get_power(powid)
+        self.failUnlessEqual(held, [1, 1])
+        self.failUnlessEqual(t.meter._held, 0)
+
+    def test_promises(self):
+        vatid = self.server.vatid
+        def ref(urbjid):
+            return {"__power__": "reference", "swissnum": [vatid, urbjid]}
+        cid = create_urbject(self.db, create_power(self.db, "{}"), F12)
+        bpowid = create_power(self.db, json.dumps({"next": ref(cid)}))
+        bid = create_urbject(self.db, bpowid, F13)
+        memid = create_memory(self.db, {})
+        apowid = create_power(self.db, json.dumps(
+            {"next": ref(bid),
+             "memory": {"__power__": "memory", "swissnum": memid}}))
+        aid = create_urbject(self.db, apowid, F14)
+        def invoke(urbjid, args):
+            self.executor.process_request({"command": "invoke",
+                                           "urbjid": urbjid,
+                                           "args_json": json.dumps(args)},
+                                          vatid)
+            while self.server.loopback_queue:
+                self.server.deliver_inbound_messages()
+        invoke(aid, {"go": True})
+        data = Memory(self.db, memid).get_data()
+        self.failUnlessEqual(data["early"], False)
+        self.failUnlessEqual(data["p"]["__power__"], "promise")
+        invoke(aid, {})
+        data = Memory(self.db, memid).get_data()
+        self.failUnlessEqual(data["result"], {"doubled": 42})
+        self.failUnless(data["broken"].startswith("broken promise"),
+                        data["broken"])
+        # nothing is left waiting for a resolution
+        c = self.db.execute("SELECT COUNT(*) FROM `promise_messages`")
+        self.failUnlessEqual(c.fetchone()[0], 0)
+
+    def test_failed_turn_breaks_promise(self):
+        vatid = self.server.vatid
+        bid = create_urbject(self.db, create_power(self.db, "{}"), F16)
+        memid = create_memory(self.db, {})
+        apowid = create_power(self.db, json.dumps(
+            {"next": {"__power__": "reference", "swissnum": [vatid, bid]},
+             "memory": {"__power__": "memory", "swissnum": memid}}))
+        aid = create_urbject(self.db, apowid, F15)
+        def invoke(args):
+            self.executor.process_request({"command": "invoke",
+                                           "urbjid": aid,
+                                           "args_json": json.dumps(args)},
+                                          vatid)
+            while self.server.loopback_queue:
+                self.server.deliver_inbound_messages()
+        invoke({"go": True})
+        self.failUnlessEqual(len(self.flushLoggedErrors(ValueError)), 1)
+        # the failed turn's message was retired
+        c = self.db.execute("SELECT COUNT(*) FROM `inbound_messages`")
+        self.failUnlessEqual(c.fetchone()[0], 0)
+        invoke({})
+        data = Memory(self.db, memid).get_data()
+        self.failUnless("turn failed: ValueError: oops" in data["broken"],
+                        data["broken"])
+
+    def test_unknown_promise(self):
+        self.patch(promise, "MAX_UNKNOWN_MESSAGES", 1)
+        vatid = self.server.vatid
+        def send(promid, result):
+            self.executor.process_request({"command": "send_promise",
+                                           "promid": promid,
+                                           "args": {},
+                                           "result": result,
+                                           "reply_to": vatid}, "pk0-other")
+        def waiting():
+            c = self.db.execute("SELECT COUNT(*) FROM `promise_messages`")
+            return c.fetchone()[0]
+        # one message to a promise we've never heard of may wait
+        send("prm0-early", "prm0-r1")
+        self.failUnlessEqual(waiting(), 1)
+        # but no more
+        send("prm0-bogus", "prm0-r2")
+        self.failUnlessEqual(waiting(), 1)
+        self.failUnlessEqual(promise.get_promise(self.db, "prm0-r2")[1],
+                             promise.BROKEN)
+        # promises that we decide are not limited
+        promise.create_promise(self.db, "prm0-ours", vatid)
+        send("prm0-ours", "prm0-r3")
+        self.failUnlessEqual(waiting(), 2)
+
+    def test_promise_resolved_by_decider(self):
+        promise.create_promise(self.db, "prm0-1", "pk0-decider")
+        msg = {"command": "resolved", "promid": "prm0-1",
+               "state": promise.FULFILLED, "resolution_json": "1"}
+        # only the decider can resolve it
+        self.executor.process_request(msg, "pk0-other")
+        self.failUnlessEqual(promise.get_promise(self.db, "prm0-1"),
+                             ("pk0-decider", promise.UNRESOLVED, None))
+        self.executor.process_request(msg, "pk0-decider")
+        self.failUnlessEqual(promise.get_promise(self.db, "prm0-1"),
+                             ("pk0-decider", promise.FULFILLED, "1"))
+        # and only once
+        msg["resolution_json"] = "2"
+        self.executor.process_request(msg, "pk0-decider")
+        self.failUnlessEqual(promise.get_promise(self.db, "prm0-1"),
+                             ("pk0-decider", promise.FULFILLED, "1"))
+
+    def test_forged_result(self):
+        vatid = self.server.vatid
+        promise.create_promise(self.db, "prm0-held", "pk0-decider")
+        held = ("pk0-decider", promise.UNRESOLVED, None)
+        memid = create_memory(self.db, {})
+        powid = create_power_for_memid(self.db, memid)
+        urbjid = create_urbject(self.db, powid, F17)
+        # someone who learned the promid can't have it resolved
+        self.executor.process_request({"command": "invoke",
+                                       "urbjid": urbjid,
+                                       "args_json": "{}",
+                                       "result": "prm0-held",
+                                       "reply_to": vatid}, "pk0-attacker")
+        self.failUnlessEqual(promise.get_promise(self.db, "prm0-held"), held)
+        self.failUnlessEqual(Memory(self.db, memid).get_data(), {})
+        # or broken, by sending to a broken promise
+        promise.create_promise(self.db, "prm0-broken", vatid)
+        promise.resolve_promise(self.db, self.executor, "prm0-broken", vatid,
+                                promise.BROKEN, json.dumps("oops"))
+        self.executor.process_request({"command": "send_promise",
+                                       "promid": "prm0-broken",
+                                       "args": {},
+                                       "result": "prm0-held",
+                                       "reply_to": vatid}, "pk0-attacker")
+        self.failUnlessEqual(promise.get_promise(self.db, "prm0-held"), held)
+        # and we only ever resolve the promises we decide, once
+        promise.resolve_promise(self.db, self.executor, "prm0-held", vatid,
+                                promise.FULFILLED, "1")
+        self.failUnlessEqual(promise.get_promise(self.db, "prm0-held"), held)
+        promise.resolve_promise(self.db, self.executor, "prm0-broken", vatid,
+                                promise.FULFILLED, "1")
+        self.failUnlessEqual(promise.get_promise(self.db, "prm0-broken")[1],
+                             promise.BROKEN)
@@ -0,0 +1,101 @@
+from twisted.trial import unittest
+from twisted.internet import task, defer
+from .. import urlhealth
+from ..urlhealth import URLHealth
+from ..outbound import _HedgedDelivery
+
+class Health(unittest.TestCase):
+    def test_rank(self):
+        h = URLHealth(task.Clock())
+        # duplicates are removed, and unknown URLs keep their order
+        self.failUnlessEqual(h.rank(["a", "b", "a", "c"]), ["a", "b", "c"])
+        h.succeeded("a", 1.0)
+        h.succeeded("b", 0.1)
+        self.failUnlessEqual(h.rank(["a", "b", "c"]), ["b", "c", "a"])
+        h.failed("b")
+        self.failUnlessEqual(h.rank(["a", "b", "c"]), ["c", "a", "b"])
+        h.succeeded("b", 0.1)
+        self.failUnlessEqual(h.rank(["a", "b", "c"]), ["b", "c", "a"])
+
+    def test_ewma(self):
+        h = URLHealth(task.Clock())
+        h.succeeded("a", 1.0)
+        h.succeeded("a", 2.0)
+        ewma = h.get_stats()["urls"]["a"]["ewma"]
+        self.failUnlessAlmostEqual(ewma, 1.0 + urlhealth.EWMA_ALPHA)
+
+    def test_hedge_delay(self):
+        h = URLHealth(task.Clock())
+        self.failUnlessEqual(h.hedge_delay("a"), urlhealth.DEFAULT_HEDGE_DELAY)
+        for i in range(100):
+            h.succeeded("a", 0.1)
+        h.succeeded("a", 5.0) # one outlier doesn't move the percentile
+        self.failUnlessEqual(h.hedge_delay("a"), 0.1)
+        h.succeeded("b", 0.0)
+        self.failUnlessEqual(h.hedge_delay("b"), urlhealth.MIN_HEDGE_DELAY)
+
+class FakeClient:
+    def __init__(self):
+        self.posts = []
+    def post(self, url, body):
+        d = defer.Deferred()
+        self.posts.append((url, d))
+        return d
+
+class FakeServer:
+    def __init__(self, clock):
+        self.client = FakeClient()
+        self.url_health = URLHealth(clock)
+        self.errors = []
+    def _outbound_response(self, response, vatid, msgnums):
+        return response
+    def _outbound_error(self, f):
+        self.errors.append(f)
+
+class FakeSender:
+    vatid = "vat1"
+    def __init__(self, server):
+        self._server = server
+        self.results = []
+    def _done(self, succeeded):
+        self.results.append(succeeded)
+
+class Hedging(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.server = FakeServer(self.clock)
+        self.sender = FakeSender(self.server)
+
+    def deliver(self, urls):
+        _HedgedDelivery(self.sender, urls, "envelope", [0])
+        return self.server.client.posts
+
+    def test_hedge(self):
+        posts = self.deliver(["a", "b"])
+        self.failUnlessEqual([url for (url, d) in posts], ["a"])
+        self.clock.advance(urlhealth.DEFAULT_HEDGE_DELAY)
+        self.failUnlessEqual([url for (url, d) in posts], ["a", "b"])
+        self.failUnlessEqual(self.server.url_health.hedges, 1)
+        posts[1][1].callback("ack")
+        self.failUnlessEqual(self.sender.results, [True])
+        # the slow one finishing later doesn't complete the attempt again
+        posts[0][1].callback("ack")
+        self.failUnlessEqual(self.sender.results, [True])
+
+    def test_fast(self):
+        posts = self.deliver(["a", "b"])
+        posts[0][1].callback("ack")
+        self.clock.advance(urlhealth.DEFAULT_HEDGE_DELAY)
+        self.failUnlessEqual(len(posts), 1)
+        self.failUnlessEqual(self.sender.results, [True])
+
+    def test_failover(self):
+        posts = self.deliver(["a", "b"])
+        posts[0][1].errback(ValueError("nope"))
+        # no waiting for the hedge timer
+        self.failUnlessEqual([url for (url, d) in posts], ["a", "b"])
+        posts[1][1].errback(ValueError("nope"))
+        self.failUnlessEqual(self.sender.results, [False])
+        self.failUnlessEqual(len(self.server.errors), 2)
+        self.failUnlessEqual(self.server.url_health.rank(["a", "b", "c"]),
+                             ["c", "a", "b"])
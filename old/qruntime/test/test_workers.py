@@ -0,0 +1,104 @@
+import os, json
+from twisted.trial import unittest
+from ..database import get_db
+from ..memory import create_memory, Memory
+from ..urbject import create_power_for_memid
+from ..turn import apply_effects
+from ..workers import WorkerPool
+
+COUNTER = """
+def call(args, power):
+    power['memory']['counter'] += args['delta']
+    power['make_urbject']('def call(args, power): pass', power)
+"""
+
+SPIN = """
+def call(args, power):
+    while True:
+        pass
+"""
+
+STUBBORN = """
+def call(args, power):
+    while True:
+        try:
+            while True:
+                pass
+        except:
+            pass
+"""
+
+class FakeServer:
+    journal = None
+    def send_message(self, vatid, msg):
+        raise AssertionError("no messages expected")
+
+class Pool(unittest.TestCase):
+    def setUp(self):
+        basedir = self.mktemp()
+        os.mkdir(basedir)
+        self.dbfile = os.path.join(basedir, "control.db")
+        self.sqlite, self.db = get_db(self.dbfile)
+        self.memid = create_memory(self.db, {"counter": 0})
+        self.powid = create_power_for_memid(self.db, self.memid,
+                                            grant_make_urbject=True)
+        self.pool = WorkerPool(self.dbfile, "vat0", 1)
+        self.pool.start()
+
+    def tearDown(self):
+        return self.pool.stop()
+
+    def run_turn(self, code, args, wall_limit=5.0, cpu_limit=5.0):
+        request = {"code": code, "powid": self.powid,
+                   "args_json": json.dumps(args), "from_vatid": "vat1",
+                   "budget": [wall_limit, cpu_limit, None]}
+        return self.pool.run_turn(request, wall_limit)
+
+    def test_turn(self):
+        d = self.run_turn(COUNTER, {"delta": 2})
+        def _ran(response):
+            # the worker wrote nothing itself
+            self.failUnlessEqual(Memory(self.db, self.memid).get_data(),
+                                 {"counter": 0})
+            kinds = [effect[0] for effect in response["effects"]]
+            self.failUnlessEqual(kinds, ["urbject", "memory_keys"])
+            self.failUnlessEqual(response["report"]["memories_written"], 1)
+            apply_effects(self.db, FakeServer(), response["effects"])
+            self.db.commit()
+            self.failUnlessEqual(Memory(self.db, self.memid).get_data(),
+                                 {"counter": 2})
+            return self.run_turn(COUNTER, {"delta": 3})
+        d.addCallback(_ran)
+        def _ran2(response):
+            # the same (warm) worker sees the committed state
+            changed = response["effects"][-1][2]
+            self.failUnlessEqual(changed, {"counter": "5"})
+        d.addCallback(_ran2)
+        return d
+
+    def test_error(self):
+        d = self.run_turn(COUNTER, {})
+        def _failed(response):
+            self.failUnless("KeyError" in response["error"], response)
+        d.addCallback(_failed)
+        return d
+
+    def test_budget(self):
+        d = self.run_turn(SPIN, {}, cpu_limit=0.05)
+        def _aborted(response):
+            self.failUnless(response["aborted"].startswith("cpu time"))
+            self.failIf("effects" in response)
+        d.addCallback(_aborted)
+        return d
+
+    def test_kill(self):
+        d = self.run_turn(STUBBORN, {}, wall_limit=0.1)
+        def _killed(response):
+            self.failUnlessEqual(response["aborted"],
+                                 "wall time (worker killed)")
+            self.failUnlessEqual(self.pool.kills, 1)
+            # and a replacement takes over
+            return self.run_turn(COUNTER, {"delta": 1})
+        d.addCallback(_killed)
+        d.addCallback(lambda response: self.failUnless("effects" in response))
+        return d
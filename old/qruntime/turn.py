@@ -1,11 +1,17 @@
 
 import json, copy, weakref
+from contextlib import contextmanager
 from twisted.python import log
 from .memory import Memory, create_raw_memory
-from .common import InnerReference, NativePower
+from .common import InnerReference, InnerPromise, NativePower, MemoryProxy
 from .pack import (pack_power, pack_memory, pack_args,
-                   unpack_power, unpack_memory, unpack_args)
+                   unpack_power, unpack_memory, unpack_args, rebind_power,
+                   rebind_args)
 from .urbject import create_urbject, create_power, Urbject
+from .util import makeid
+from .budget import Meter
+from .serialization import JSON, same_packed
+from . import promise
 
 # the inner (sandboxed) code gets a power= argument which contains static
 # data, Memory-backed dicts (which behave just like static data but can be
@@ -24,15 +30,63 @@ from .urbject import create_urbject, create_power, Urbject
 # JSON serialization, but catch memory-backed dicts by comparing object
 # identities with our table, and catch InnerReferences with isinstance().
 
+# Each turn is a single transaction. A running turn only reads from the
+# database: the records it creates (urbjects, powers, and Memories) are
+# kept in RAM, where its own later lookups find them. At the end,
+# _commit_turn() collects everything the turn did into a list of effects
+# (new rows, Memory changes, and outbound messages) and writes them to the
+# open transaction with apply_effects(). Nothing here commits: the
+# ExecutionServer does that (usually along with several other turns, see
+# executor.py). Since turns run to completion without yielding, any other
+# commit of the shared connection only ever sees complete turns. A Turn
+# created with write=False leaves its effects in .effects instead, for a
+# worker process to send back to the node (see workers.py).
+#
+# sqlite3 (in python2.7) implicitly commits before a SAVEPOINT statement, so
+# we roll back within a turn ourselves: a savepoint records how many
+# records the turn has created, how many messages it has queued, and which
+# Memories it has loaded. If the whole turn, or a nested local_sync_call(),
+# raises an exception, everything it did after its savepoint is forgotten
+# before the exception propagates. (Changes that a failed nested call made
+# to Memories its caller had already loaded are visible to the caller
+# immediately, and are kept.)
+#
+# Most turns only read most of the Memories they load, so _commit_turn()
+# compares each packed Memory value with the JSON it was loaded from, and
+# only saves the ones that changed. A turn that changed nothing, created
+# nothing, and sent nothing writes nothing at all. get_report() says what
+# the turn actually wrote.
+#
+# The inner code sees each Memory as a MemoryProxy. For a Memory stored as
+# separate keys (see memory.py), values are loaded lazily and only the
+# changed keys are written back. A Memory still stored as one string is
+# loaded all at once, and converted to separate keys when it first changes.
+# If the server has a MemoryJournal (see journal.py), the changes are
+# appended to the journal instead.
+#
+# send() returns an InnerPromise (see promise.py). A turn started with a
+# result= promise resolves it with the first invocation's return value: the
+# resolution is one more effect, applied after the turn's messages.
+#
+# New and changed Memories and powers are packed in the Turn's value_format
+# (see serialization.py). Args arrive either packed (args_json), or as the
+# already-parsed "args" of a message, which is rebound directly.
 
 
 class Turn:
     """This holds all the state for a single turn of the vat."""
-    def __init__(self, server, db):
+    def __init__(self, server, db, records=None, write=True,
+                 value_format=JSON):
         self._server = server
         self._vatid = server.vatid
         self.db = db
+        self._records = records # a RecordCache, shared between turns
+        self._write = write
+        self.value_format = value_format
         self.outbound_messages = []
+        self._created = [] # (kind, id) for records we've created
+        self._new_records = {} # (kind, id) -> record, until written
+        self.effects = None # set by _commit_turn
 
         self._invocation_stack = []
         self.powid_to_power = {} # powid -> inner 'power' dict
@@ -47,24 +101,40 @@ class Turn:
         # to the parent
         self.memories = {} # memid -> (Memory, data)
         self.memory_data_to_memid = {} # id(data) -> memid
+        self.loaded_memory_json = {} # memid -> data_json, or None if keyed
+        self.footprint = set() # every memid loaded, even if rolled back
+        self.memories_written = 0
+        self.bytes_written = 0
+        self.meter = None # see budget.py
 
         self.references = {} # refid=(vatid,urbjid) -> InnerReference
+        self.promises = {} # (decider_vatid,promid) -> InnerPromise
+        self.resolution = None # (promid, reply_to, state, resolution_json)
 
         # this maps from an object (NativePower or InnerReference) to
         # swissnum, so when we see one during serialization (of args, power,
         # or a memory), we can look up the swissnum (which is otherwise
         # hidden from the inner code)
         self.swissnums = weakref.WeakKeyDictionary()
+        self.packers = {} # (allow_native, format) -> _Packer, see pack.py
 
     def get_power(self, powid):
         if powid not in self.powid_to_power:
-            c = self.db.cursor()
-            c.execute("SELECT `power_json` FROM `power` WHERE `powid`=?",
-                      (powid,))
-            results = c.fetchall()
-            assert results, "no powid %s" % powid
-            (power_json,) = results[0]
-            inner = unpack_power(self, power_json)
+            if ("power", powid) in self._new_records:
+                power_json = self._new_records[("power", powid)]
+                inner = unpack_power(self, power_json)
+            elif self._records:
+                with self.bookkeeping():
+                    template = self._records.get_power_template(powid)
+                inner = rebind_power(self, template)
+            else:
+                c = self.db.cursor()
+                c.execute("SELECT `power_json` FROM `power` WHERE `powid`=?",
+                          (powid,))
+                results = c.fetchall()
+                assert results, "no powid %s" % powid
+                (power_json,) = results[0]
+                inner = unpack_power(self, power_json)
             self.powid_to_power[powid] = inner
             self.power_to_powid[id(inner)] = (powid, inner)
         return self.powid_to_power[powid]
@@ -79,8 +149,10 @@ class Turn:
             (powid,_) = self.power_to_powid[id(child_power)]
         else:
             packed_power = pack_power(self, child_power)
-            powid = create_power(self.db, packed_power)
-        urbjid = create_urbject(self.db, powid, code)
+            powid = makeid("pow0-")
+            self._add_record("power", powid, packed_power)
+        urbjid = makeid("urb0-")
+        self._add_record("urbject", urbjid, (code, powid))
         # this will update Invocation.swissnums, so it will have the
         # ability to serialize the newly created object at the end of the
         # turn
@@ -101,14 +173,27 @@ class Turn:
 
     def get_memory(self, memid):
         if memid not in self.memories:
+            self.footprint.add(memid)
             memory = Memory(self.db, memid)
             # now extract the contents
             # unpack_memory() can add items to our swissnums: the
             # invocation gets power from Memory as well as args
-            memory_json = memory.get_raw_data()
-            data = unpack_memory(self, memory_json)
-            self.memory_data_to_memid[id(data)] = memid
-            self.memories[memid] = (memory, data)
+            if ("memory", memid) in self._new_records:
+                memory_json = self._new_records[("memory", memid)]
+            else:
+                memory_json = memory.get_blob()
+            if memory_json is not None:
+                values = unpack_memory(self, memory_json)
+                data = MemoryProxy(values.keys(), values=values)
+            else:
+                def load_value(key):
+                    value_json = memory.get_raw_value(key)
+                    return (unpack_memory(self, value_json), value_json)
+                data = MemoryProxy(memory.get_keys(), load_value)
+            with self.bookkeeping():
+                self.memory_data_to_memid[id(data)] = memid
+                self.memories[memid] = (memory, data)
+                self.loaded_memory_json[memid] = memory_json
         (memory, data) = self.memories[memid]
         return data
 
@@ -121,6 +206,14 @@ class Turn:
             self.swissnums[r] = refid
         return self.references[refid]
 
+    def get_promise(self, refid):
+        assert isinstance(refid, tuple)
+        if refid not in self.promises:
+            p = InnerPromise(self)
+            self.promises[refid] = p
+            self.swissnums[p] = refid
+        return self.promises[refid]
+
     # serialization/packing
     def put_memory(self, data):
         # if make_urbject() is called with power.memory=M, inside an
@@ -135,7 +228,8 @@ class Turn:
             # otherwise, we want to create a new Memory object, with 'data'
             # as the initial contents
             packed = pack_memory(self, data)
-            memid = create_raw_memory(self.db, packed)
+            memid = makeid("mem0-")
+            self._add_record("memory", memid, packed)
             # note: we do *not* do "self.swissnums[data] = memid" here. We
             # only re-use Memory objects that were passed into an inner
             # function via its power.memory . Passing the same initial data
@@ -145,51 +239,277 @@ class Turn:
             # call).
         return memid
 
+    def _add_record(self, kind, recid, record):
+        with self.bookkeeping():
+            self._created.append((kind, recid))
+            self._new_records[(kind, recid)] = record
+
+    @contextmanager
+    def bookkeeping(self):
+        # the budget meter must not interrupt us half-way through changing
+        # anything that rollback_to() undoes, or the caches that every turn
+        # shares (RecordCache and CodeCache)
+        if self.meter:
+            self.meter.hold()
+        try:
+            yield
+        finally:
+            if self.meter:
+                self.meter.release()
+
     def get_swissnum_for_object(self, obj):
         return self.swissnums[obj]
 
+    def get_code_object(self, code):
+        with self.bookkeeping():
+            return self._server.code_cache.get(code)
+
     # this is the real entry point. Inside start_turn(), we'll use the
     # deserialization stuff above. The inner code may end up invoking
     # local_sync_call (when it does o.call), or outbound_message (for
     # o.send). When we're all done, we commit the turn.
 
-    def start_turn(self, code, powid, args_json, from_vatid, debug=None):
+    def savepoint(self):
+        return (len(self._created), len(self.outbound_messages),
+                set(self.memories))
+
+    def rollback_to(self, savepoint):
+        (created, outbound, memids) = savepoint
+        with self.bookkeeping():
+            for key in self._created[created:]:
+                del self._new_records[key]
+            del self._created[created:]
+            del self.outbound_messages[outbound:]
+            for memid in set(self.memories) - memids:
+                (memory, data) = self.memories.pop(memid)
+                del self.memory_data_to_memid[id(data)]
+                del self.loaded_memory_json[memid]
+
+    def start_turn(self, code, powid, args_json, from_vatid, debug=None,
+                   budget=None, result=None, args=None):
+        # 'result' is (promid, reply_to), to resolve with the return value.
+        # If args_json is None, 'args' is the parsed form (a template)
         assert debug is None or callable(debug)
-        first_invocation = Invocation(self, code, powid)
-        self._invocation_stack.append(first_invocation)
-        rc = first_invocation._invoke(args_json, from_vatid, debug)
-        self._invocation_stack.pop()
-        assert not self._invocation_stack
-        self._commit_turn()
+        savepoint = self.savepoint()
+        if budget:
+            self.meter = Meter(budget)
+            self.meter.start()
+        try:
+            first_invocation = Invocation(self, code, powid)
+            self._invocation_stack.append(first_invocation)
+            rc = first_invocation._invoke(args_json, from_vatid, debug,
+                                          args)
+            self._invocation_stack.pop()
+            assert not self._invocation_stack
+            if self.meter:
+                self.meter.stop()
+                self.meter.check()
+            if result:
+                self._resolve(result, rc)
+            self._commit_turn()
+        except:
+            if self.meter:
+                self.meter.stop()
+                self.meter.measure()
+            self.rollback_to(savepoint)
+            raise
         return rc
 
+    def get_code_and_powid(self, urbjid):
+        if ("urbject", urbjid) in self._new_records:
+            return self._new_records[("urbject", urbjid)]
+        if self._records:
+            with self.bookkeeping():
+                return self._records.get_urbject(urbjid)
+        return Urbject(self.db, urbjid).get_code_and_powid()
+
     def local_sync_call(self, inner_ref, args):
         target_vatid, target_urbjid = self.swissnums[inner_ref]
         assert target_vatid == self._vatid # must be local
-        ur = Urbject(self.db, target_urbjid)
-        code, powid = ur.get_code_and_powid()
+        code, powid = self.get_code_and_powid(target_urbjid)
+        savepoint = self.savepoint()
         next_invocation = Invocation(self, code, powid)
         self._invocation_stack.append(next_invocation)
-        rc = next_invocation._execute(args, self._vatid)
-        self._invocation_stack.pop()
+        try:
+            rc = next_invocation._execute(args, self._vatid)
+        except:
+            self.rollback_to(savepoint)
+            raise
+        finally:
+            self._invocation_stack.pop()
         return rc
 
-    def sendOnly(self, inner_ref, args):
+    def _send(self, target, args, result):
+        # queue a message for delivery at the end of the turn, and return
+        # the vatid it is sent to
         packed_args = pack_args(self, args)
-        # local-only for now
+        if isinstance(target, InnerPromise):
+            (decider_vatid, promid) = self.swissnums[target]
+            resolved = self._get_resolved_reference(promid)
+            if resolved:
+                # skip the decider, it would only forward this to here
+                (power_type, swissnum) = resolved
+                if power_type == "promise":
+                    (decider_vatid, promid) = swissnum
+                else:
+                    target = self.get_reference(swissnum)
+        if isinstance(target, InnerPromise):
+            target_vatid = decider_vatid
+            msg = {"command": "send_promise",
+                   "promid": promid,
+                   "args_json": packed_args}
+        else:
+            target_vatid, target_urbjid = self.swissnums[target]
+            msg = {"command": "invoke",
+                   "urbjid": target_urbjid,
+                   "args_json": packed_args}
+        if result:
+            msg["result"] = result
+            msg["reply_to"] = self._vatid
+        self.outbound_messages.append( (target_vatid, msg) )
+        return target_vatid
+
+    def sendOnly(self, target, args):
+        self._send(target, args, None)
+        return None
+
+    def send(self, target, args):
+        promid = makeid("prm0-")
+        decider_vatid = self._send(target, args, promid)
+        self._add_record("promise", promid, decider_vatid)
+        return self.get_promise((decider_vatid, promid))
+
+    def _get_promise_record(self, promid):
+        # (decider_vatid, state, resolution_json), or None
+        if ("promise", promid) in self._new_records:
+            return (self._new_records[("promise", promid)],
+                    promise.UNRESOLVED, None)
+        return promise.get_promise(self.db, promid)
+
+    def _get_resolved_reference(self, promid):
+        record = self._get_promise_record(promid)
+        if record and record[1] == promise.FULFILLED:
+            return promise.get_reference(record[2])
+        return None
+
+    def is_resolved(self, inner_promise):
+        (decider_vatid, promid) = self.swissnums[inner_promise]
+        record = self._get_promise_record(promid)
+        return bool(record) and record[1] != promise.UNRESOLVED
+
+    def get_result(self, inner_promise):
+        (decider_vatid, promid) = self.swissnums[inner_promise]
+        record = self._get_promise_record(promid)
+        if not record or record[1] == promise.UNRESOLVED:
+            raise ValueError("promise is not resolved yet")
+        (decider_vatid, state, resolution_json) = record
+        if state == promise.BROKEN:
+            raise ValueError("broken promise: %s"
+                             % json.loads(resolution_json))
+        return unpack_args(self, resolution_json)
+
+    def _resolve(self, result, rc):
+        (promid, reply_to) = result
+        try:
+            state = promise.FULFILLED
+            resolution_json = pack_args(self, rc)
+        except (TypeError, ValueError), e:
+            state = promise.BROKEN
+            resolution_json = json.dumps("unable to serialize result: %s"
+                                         % (e,))
+        self.resolution = (promid, reply_to, state, resolution_json)
+
+    def congested(self, inner_ref):
         target_vatid, target_urbjid = self.swissnums[inner_ref]
-        msg = {"command": "invoke",
-               "urbjid": target_urbjid,
-               "args_json": packed_args}
-        # queue for delivery at the end of the turn
-        self.outbound_messages.append( (target_vatid, json.dumps(msg)) )
-        return None # no results-Promises yet
+        return self._server.is_congested(target_vatid)
 
     def _commit_turn(self):
+        # a turn that would add to a congested peer's queue is deferred
+        # (and will be retried) before it changes anything, and one with a
+        # message that could never be delivered fails
+        for (target_vatid, msg) in self.outbound_messages:
+            self._server.check_message(target_vatid, msg)
+        if self.resolution:
+            (promid, reply_to, state, resolution_json) = self.resolution
+            self._server.check_message(reply_to,
+                                       promise.resolved_message(
+                                           promid, state, resolution_json))
+        effects = []
+        for (kind, recid) in self._created:
+            record = self._new_records[(kind, recid)]
+            if kind == "urbject":
+                (code, powid) = record
+                effects.append(["urbject", recid, code, powid])
+                self.bytes_written += len(code)
+            else:
+                effects.append([kind, recid, record])
+                self.bytes_written += len(record)
         for (memid, (memory, data)) in self.memories.items():
-            memory.save(pack_memory(self, data))
+            loaded_json = self.loaded_memory_json[memid]
+            if loaded_json is not None:
+                # still a single string: compare the whole thing
+                if same_packed(pack_memory(self, data), loaded_json):
+                    continue
+                changed = dict([(key, pack_memory(self, value))
+                                for (key, value) in data.items()])
+                deleted = ()
+            else:
+                changed = {}
+                for (key, value, value_json) in data.get_touched():
+                    packed = pack_memory(self, value)
+                    if not same_packed(packed, value_json):
+                        changed[key] = packed
+                deleted = data.get_deleted()
+                if not changed and not deleted:
+                    continue
+            effects.append(["memory_keys", memid, changed, list(deleted)])
+            self.memories_written += 1
+            self.bytes_written += sum([len(value_json)
+                                       for value_json in changed.values()])
         for (target_vatid, msg) in self.outbound_messages:
-            self._server.send_message(target_vatid, msg)
+            effects.append(["message", target_vatid, msg])
+        if self.resolution:
+            effects.append(["resolve"] + list(self.resolution))
+        self.effects = effects
+        if self._write:
+            apply_effects(self.db, self._server, effects)
+
+    def get_report(self):
+        return {"memories_loaded": len(self.memories),
+                "memories_written": self.memories_written,
+                "rows_created": len(self._created),
+                "messages_sent": len(self.outbound_messages),
+                "bytes_written": self.bytes_written,
+                }
+
+def apply_effects(db, server, effects):
+    """Write a turn's effects to the open transaction. Messages are sent
+    with server.send_message(), and Memory changes go to server.journal if
+    it has one."""
+    for effect in effects:
+        kind = effect[0]
+        if kind == "power":
+            create_power(db, effect[2], commit=False, powid=effect[1])
+        elif kind == "urbject":
+            create_urbject(db, effect[3], effect[2], commit=False,
+                           urbjid=effect[1])
+        elif kind == "memory":
+            create_raw_memory(db, effect[2], commit=False, memid=effect[1])
+        elif kind == "promise":
+            promise.create_promise(db, effect[1], effect[2])
+        elif kind == "memory_keys":
+            (memid, changed, deleted) = effect[1:]
+            memory = Memory(db, memid)
+            if server.journal:
+                server.journal.append(memory, changed, deleted)
+            else:
+                memory.save_keys(changed, deleted, commit=False)
+        elif kind == "message":
+            server.send_message(effect[1], effect[2])
+        elif kind == "resolve":
+            promise.resolve_promise(db, server, *effect[1:])
+        else:
+            raise ValueError("unknown effect '%s'" % (kind,))
 
 class Invocation:
     def __init__(self, turn, code, powid):
@@ -203,16 +523,19 @@ class Invocation:
         if "memory" in self.inner_power:
             self.memory_data_id = id(self.inner_power["memory"])
 
-    def _invoke(self, args_json, from_vatid, debug=None):
+    def _invoke(self, args_json, from_vatid, debug=None, args=None):
         assert debug is None or callable(debug)
-        inner_args = unpack_args(self.turn, args_json)
+        if args_json is None:
+            inner_args = rebind_args(self.turn, args)
+        else:
+            inner_args = unpack_args(self.turn, args_json)
         return self._execute(inner_args, from_vatid, debug)
 
     def _execute(self, args, from_vatid, debug=None):
         assert debug is None or callable(debug)
         #print "EVAL <%s>" % (self.code,)
         #print " ARGS <%s>" % (args,)
-        code = compile(self.code, "<from vatid %s>" % from_vatid, "exec")
+        code = self.turn.get_code_object(self.code)
         def log2(msg):
             log.msg(msg)
             #print msg
@@ -1,22 +1,27 @@
 
 import json
 from . import util
+from .serialization import to_db, to_json
 
-def create_urbject(db, powid, code):
-    urbjid = util.makeid("urb0-")
+def create_urbject(db, powid, code, commit=True, urbjid=None):
+    urbjid = urbjid or util.makeid("urb0-")
     c = db.cursor()
     c.execute("INSERT INTO `urbjects` VALUES (?,?,?)", (urbjid, powid, code))
-    db.commit()
+    if commit:
+        db.commit()
     return urbjid
 
-def create_power(db, packed_power):
-    powid = util.makeid("pow0-")
+def create_power(db, packed_power, commit=True, powid=None):
+    powid = powid or util.makeid("pow0-")
     c = db.cursor()
-    c.execute("INSERT INTO `power` VALUES (?,?)", (powid, packed_power))
-    db.commit()
+    c.execute("INSERT INTO `power` VALUES (?,?)",
+              (powid, to_db(packed_power)))
+    if commit:
+        db.commit()
     return powid
 
-def create_power_for_memid(db, memid=None, grant_make_urbject=False):
+def create_power_for_memid(db, memid=None, grant_make_urbject=False,
+                           commit=True):
     powid = util.makeid("pow0-")
     power = {}
     if memid:
@@ -27,7 +32,8 @@ def create_power_for_memid(db, memid=None, grant_make_urbject=False):
     c = db.cursor()
     c.execute("INSERT INTO `power` VALUES (?,?)",
               (powid, json.dumps(power)))
-    db.commit()
+    if commit:
+        db.commit()
     return powid
 
 
@@ -54,4 +60,4 @@ class Urbject:
         powid = c.fetchone()[0]
         c.execute("SELECT `power_json` FROM `power` WHERE `powid`=?", (powid,))
         power_json = c.fetchone()[0]
-        return power_json
+        return to_json(power_json)
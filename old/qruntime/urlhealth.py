@@ -0,0 +1,90 @@
+from collections import deque
+from twisted.internet import reactor
+
+# A Vat may be reachable at several URLs. Rather than POSTing each envelope
+# to all of them at once, we send it to the best one, and only "hedge" (send
+# the same envelope to the next-best URL as well) if the first hasn't
+# answered within a little more than its usual response time. A failed
+# request moves on to the next URL immediately. Duplicate deliveries are
+# harmless (the receiver just ACKs them again), but they cost both sides a
+# decryption.
+#
+# URLHealth keeps the statistics for this: for each URL, an EWMA of its
+# response time, a window of recent response times (for the hedging
+# percentile), and the number of consecutive failures. URLs that have been
+# failing sort last, then the rest by EWMA latency. URLs we have never used
+# are assumed to take DEFAULT_LATENCY seconds.
+
+EWMA_ALPHA = 0.2
+DEFAULT_LATENCY = 0.5
+WINDOW = 20
+HEDGE_PERCENTILE = 95
+MIN_HEDGE_DELAY = 0.05
+DEFAULT_HEDGE_DELAY = 2.0
+
+class _URLStats:
+    def __init__(self):
+        self.ewma = None
+        self.recent = deque(maxlen=WINDOW)
+        self.consecutive_failures = 0
+        self.successes = 0
+        self.failures = 0
+
+class URLHealth:
+    def __init__(self, clock=reactor):
+        self.clock = clock
+        self._urls = {} # url -> _URLStats
+        self.hedges = 0
+
+    def _get(self, url):
+        if url not in self._urls:
+            self._urls[url] = _URLStats()
+        return self._urls[url]
+
+    def rank(self, urls):
+        """Return the distinct members of 'urls', best first."""
+        def _key(url):
+            s = self._get(url)
+            latency = s.ewma
+            if latency is None:
+                latency = DEFAULT_LATENCY
+            return (s.consecutive_failures, latency)
+        unique = []
+        for url in urls:
+            if url not in unique:
+                unique.append(url)
+        return sorted(unique, key=_key) # stable, so ties keep their order
+
+    def hedge_delay(self, url):
+        """How long to wait for 'url' before also trying the next one."""
+        recent = sorted(self._get(url).recent)
+        if not recent:
+            return DEFAULT_HEDGE_DELAY
+        index = (len(recent)-1)*HEDGE_PERCENTILE//100
+        return max(recent[index], MIN_HEDGE_DELAY)
+
+    def succeeded(self, url, latency):
+        s = self._get(url)
+        if s.ewma is None:
+            s.ewma = latency
+        else:
+            s.ewma = EWMA_ALPHA*latency + (1-EWMA_ALPHA)*s.ewma
+        s.recent.append(latency)
+        s.consecutive_failures = 0
+        s.successes += 1
+
+    def failed(self, url):
+        s = self._get(url)
+        s.consecutive_failures += 1
+        s.failures += 1
+
+    def get_stats(self):
+        urls = {}
+        for (url, s) in self._urls.items():
+            urls[url] = {"ewma": s.ewma,
+                         "hedge_delay": self.hedge_delay(url),
+                         "consecutive_failures": s.consecutive_failures,
+                         "successes": s.successes,
+                         "failures": s.failures,
+                         }
+        return {"hedges": self.hedges, "urls": urls}
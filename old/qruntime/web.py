@@ -1,8 +1,10 @@
 import os, json
 from twisted.application import service, strports
 from twisted.web import server, static, resource, http
+from twisted.internet import defer
 from twisted.python import log
 from .util import makeid, parse_spid
+from .netstring import TooLong
 
 MEDIA_DIRNAME = os.path.join(os.path.dirname(__file__), "media")
 
@@ -13,15 +15,68 @@ def read_media(fn):
     f.close()
     return data
 
+class LimitedRequest(server.Request):
+    # Request bodies are spooled to a temporary file (for anything large),
+    # but without a limit a peer could still fill our disk. Once a body
+    # exceeds site.max_body_size, we stop storing it and just remember that
+    # it was too large.
+    too_large = False
+    _received = 0
+
+    def _get_limit(self):
+        return getattr(self.channel.site, "max_body_size", None)
+
+    def gotLength(self, length):
+        limit = self._get_limit()
+        if limit is not None and length is not None and length > limit:
+            self.too_large = True
+            length = 0
+        server.Request.gotLength(self, length)
+
+    def handleContentChunk(self, data):
+        self._received += len(data)
+        limit = self._get_limit()
+        if limit is not None and self._received > limit:
+            self.too_large = True
+        if not self.too_large:
+            server.Request.handleContentChunk(self, data)
+
 class MessageInput(resource.Resource):
     def __init__(self, server):
         resource.Resource.__init__(self)
         self._server = server
 
     def render_POST(self, request):
-        msg = request.content.read()
-        resp = self._server.inbound_message(msg)
-        return resp
+        if request.too_large:
+            request.setResponseCode(http.REQUEST_ENTITY_TOO_LARGE)
+            return "message too large\n"
+        # the response (an ACK) is only available once the message has been
+        # committed, which happens in batches
+        d = defer.maybeDeferred(self._server.inbound_stream, request.content)
+        lost = []
+        request.notifyFinish().addErrback(lost.append)
+        def _respond(resp):
+            if not lost:
+                request.write(resp)
+                request.finish()
+        def _error(f):
+            # oversized or malformed envelopes are the peer's problem, not
+            # ours
+            if f.check(TooLong):
+                code = http.REQUEST_ENTITY_TOO_LARGE
+            elif f.check(ValueError):
+                code = http.BAD_REQUEST
+            else:
+                code = http.INTERNAL_SERVER_ERROR
+            if code == http.INTERNAL_SERVER_ERROR:
+                log.err(f)
+            else:
+                log.msg("rejected inbound envelope: %s" % f.value)
+            if not lost:
+                request.setResponseCode(code)
+                request.finish()
+        d.addCallbacks(_respond, _error)
+        return server.NOT_DONE_YET
 
 class Poke(resource.Resource):
     def __init__(self, executor):
@@ -147,7 +202,8 @@ class WebPort(service.MultiService):
         root.putChild("messages", mi)
         root.putChild("poke", Poke(node.server.executor))
 
-        site = server.Site(root)
+        site = server.Site(root, requestFactory=LimitedRequest)
+        site.max_body_size = node.server.max_message_size
         webport = str(node.get_node_config("webport"))
         self.port_service = strports.service(webport, site)
         self.port_service.setServiceParent(self)
@@ -0,0 +1,265 @@
+import os, sys, json, sqlite3, traceback
+from collections import deque
+from twisted.internet import reactor, defer, protocol
+from twisted.protocols.basic import NetstringReceiver
+from twisted.python import log
+from .netstring import make_netstring, read_netstrings
+from .turn import Turn
+from .budget import Budget, BudgetExceeded
+from .codecache import CodeCache
+from .records import RecordCache
+from .serialization import JSON, dumps_message, to_text, from_text
+
+# Inner code can run for a while, and while it runs on the reactor thread
+# the node can't accept messages, send ACKs, or answer the control API. So
+# the ExecutionServer can hand turns to a WorkerPool instead: a set of
+# pre-forked worker processes (running this module), each with its own
+# sqlite connection and its own warm CodeCache and RecordCache.
+#
+# A worker runs a Turn with write=False: it reads urbjects, powers, and
+# Memories from the database, but writes nothing, and sends back the turn's
+# effects (see turn.py) as JSON, along with its report and resource usage.
+# The node applies the effects in its own transaction, so the reactor only
+# does I/O and bookkeeping, and the database still has a single writer.
+# Requests and responses are netstrings on the worker's stdin and stdout.
+# Packed values in the effects may be binary (see serialization.py), so
+# they are carried with to_text().
+#
+# Each worker enforces the turn's budget itself (see budget.py). If a worker
+# doesn't answer within KILL_FACTOR times the wall-clock limit (plus
+# KILL_GRACE seconds), the pool kills it, reports the turn as aborted, and
+# starts a replacement.
+
+KILL_FACTOR = 2
+KILL_GRACE = 1.0
+MAX_RESPONSE_SIZE = 256*1000*1000
+
+class TurnFailed(Exception):
+    """The inner code raised an exception. The argument is the traceback."""
+
+class _Responses(NetstringReceiver):
+    MAX_LENGTH = MAX_RESPONSE_SIZE
+    def __init__(self, worker):
+        self._worker = worker
+    def stringReceived(self, s):
+        self._worker.responseReceived(json.loads(s))
+
+class _Worker(protocol.ProcessProtocol):
+    def __init__(self, pool):
+        self._pool = pool
+        self._responses = _Responses(self)
+        self._responses.makeConnection(self)
+        self.current = None # (Deferred, kill timer), while busy
+        self.killed = False
+
+    def run(self, request, kill_after):
+        d = defer.Deferred()
+        timer = self._pool._clock.callLater(kill_after, self.kill)
+        self.current = (d, timer)
+        self.kill_after = kill_after
+        # args_json from a parsed message is unicode, which would make the
+        # whole request unicode
+        request_json = dumps_message(request).encode("utf-8")
+        self.transport.write(make_netstring(request_json))
+        return d
+
+    def loseConnection(self):
+        # the _Responses parser calls this if the worker sends garbage
+        self.kill()
+
+    def kill(self):
+        log.msg("turn worker %s stopped responding, killing it"
+                % self.transport.pid)
+        self.killed = True
+        self.transport.signalProcess("KILL")
+
+    def outReceived(self, data):
+        self._responses.dataReceived(data)
+
+    def errReceived(self, data):
+        log.msg("turn worker: %s" % data.rstrip())
+
+    def responseReceived(self, response):
+        (d, timer), self.current = self.current, None
+        timer.cancel()
+        self._pool._worker_idle(self)
+        d.callback(response)
+
+    def processEnded(self, reason):
+        current, self.current = self.current, None
+        self._pool._worker_ended(self)
+        if current:
+            (d, timer) = current
+            if timer.active():
+                timer.cancel()
+            if self.killed:
+                # it didn't get to say how much it used
+                usage = {"wall_time": self.kill_after, "cpu_time": 0.0,
+                         "max_memory": 0}
+                d.callback({"aborted": "wall time (worker killed)",
+                            "usage": usage})
+            else:
+                d.errback(reason)
+
+class WorkerPool:
+    def __init__(self, dbfile, vatid, size, clock=reactor):
+        self.dbfile = dbfile
+        self.vatid = vatid
+        self.size = size
+        self._clock = clock
+        self.running = False
+        self._workers = set()
+        self._idle = []
+        self._waiting = deque() # (request, kill_after, Deferred)
+        self._stopped = None
+        self.turns = 0
+        self.kills = 0
+
+    def start(self):
+        self.running = True
+        for i in range(self.size):
+            self._spawn()
+
+    def _spawn(self):
+        w = _Worker(self)
+        env = os.environ.copy()
+        # the workers must import this same copy of qruntime
+        top = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env["PYTHONPATH"] = os.pathsep.join(filter(None, [
+            top, env.get("PYTHONPATH")]))
+        reactor.spawnProcess(w, sys.executable,
+                             [sys.executable, "-m", "qruntime.workers",
+                              self.dbfile, self.vatid],
+                             env=env)
+        self._workers.add(w)
+        self._worker_idle(w)
+
+    def stop(self):
+        """Shut down the workers (after they finish their current turns).
+        Returns a Deferred that fires when they have all exited."""
+        self.running = False
+        if not self._workers:
+            return defer.succeed(None)
+        self._stopped = defer.Deferred()
+        for w in self._workers:
+            w.transport.closeStdin()
+        return self._stopped
+
+    def run_turn(self, request, wall_limit):
+        """Run a turn in the next free worker. Returns a Deferred that fires
+        with the worker's response: a dict with 'effects', 'report', and
+        'usage', or with 'aborted' (a description of the budget it
+        exceeded), or with 'error' (the traceback, if the inner code raised
+        an exception). All but a killed worker's response include
+        'footprint', the memids that the turn loaded."""
+        d = defer.Deferred()
+        kill_after = wall_limit * KILL_FACTOR + KILL_GRACE
+        self._waiting.append((request, kill_after, d))
+        self.turns += 1
+        self._dispatch()
+        return d
+
+    def _dispatch(self):
+        while self._idle and self._waiting:
+            w = self._idle.pop()
+            request, kill_after, d = self._waiting.popleft()
+            w.run(request, kill_after).chainDeferred(d)
+
+    def _worker_idle(self, w):
+        self._idle.append(w)
+        self._dispatch()
+
+    def _worker_ended(self, w):
+        if w.killed:
+            self.kills += 1
+        self._workers.discard(w)
+        if w in self._idle:
+            self._idle.remove(w)
+        if self.running:
+            self._spawn()
+        elif not self._workers and self._stopped:
+            self._stopped.callback(None)
+
+    def get_stats(self):
+        return {"workers": len(self._workers),
+                "idle": len(self._idle),
+                "waiting": len(self._waiting),
+                "turns": self.turns,
+                "kills": self.kills,
+                }
+
+# everything below runs in the worker process
+
+class _WorkerServer:
+    # what a Turn needs from its server. Congestion (and everything else
+    # check_message() looks at) is checked by the node, before it applies
+    # the effects.
+    journal = None
+    def __init__(self, vatid, code_cache):
+        self.vatid = vatid
+        self.code_cache = code_cache
+    def is_congested(self, target_vatid):
+        return False
+    def check_message(self, target_vatid, msg):
+        pass
+
+def _convert_effects(effects, convert):
+    converted = []
+    for effect in effects:
+        kind = effect[0]
+        if kind in ("power", "memory"):
+            effect = [kind, effect[1], convert(effect[2])]
+        elif kind == "memory_keys":
+            (memid, changed, deleted) = effect[1:]
+            changed = dict([(key, convert(value))
+                            for (key, value) in changed.items()])
+            effect = [kind, memid, changed, deleted]
+        converted.append(effect)
+    return converted
+
+def effects_to_text(effects):
+    return _convert_effects(effects, to_text)
+
+def effects_from_text(effects):
+    return _convert_effects(effects, from_text)
+
+def run_turn(server, db, records, request):
+    t = Turn(server, db, records, write=False,
+             value_format=request.get("value_format", JSON))
+    try:
+        result = request.get("result")
+        t.start_turn(request["code"], request["powid"],
+                     request.get("args_json"), request["from_vatid"],
+                     budget=Budget(*request["budget"]),
+                     result=result and tuple(result),
+                     args=request.get("args"))
+    except BudgetExceeded, e:
+        response = {"aborted": str(e), "usage": t.meter.get_usage()}
+    except Exception:
+        response = {"error": traceback.format_exc()}
+        if t.meter:
+            response["usage"] = t.meter.get_usage()
+    else:
+        response = {"effects": effects_to_text(t.effects),
+                    "report": t.get_report(),
+                    "usage": t.meter.get_usage()}
+    # the Memories it read, for conflict detection (see scheduler.py)
+    response["footprint"] = sorted(t.footprint)
+    return response
+
+def main(dbfile, vatid):
+    # keep the real stdout for responses: anything else written to it
+    # (e.g. by 'print' in inner code) goes to stderr instead
+    out = os.fdopen(os.dup(1), "wb")
+    os.dup2(2, 1)
+    sys.stdout = sys.stderr
+    db = sqlite3.connect(dbfile)
+    server = _WorkerServer(vatid, CodeCache())
+    records = RecordCache(db)
+    for request in read_netstrings(sys.stdin, MAX_RESPONSE_SIZE):
+        response = run_turn(server, db, records, json.loads(request))
+        out.write(make_netstring(json.dumps(response)))
+        out.flush()
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])